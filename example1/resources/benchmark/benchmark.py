@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import subprocess
+
+"""
+benchmark times the plugins helpers and, if bidsme is available,
+each bidsification stage on synthetic datasets of increasing size.
+
+    python3 resources/benchmark/benchmark.py --workdir /scratch/bench \\
+        --bidsme ~/bidsme/bidsme.py -o results.json
+
+Results are stored as json, to be compared across versions
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "plugins"))
+
+from definitions import Series, validateSeries  # noqa: E402
+from subjects import loadSubjects  # noqa: E402
+from sidecar import readFields  # noqa: E402
+from preflight import preflight, sourceSeries  # noqa: E402
+import generate  # noqa: E402
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# default dataset sizes, in number of subjects
+default_scales = (10, 1000, 10000)
+
+# bidsme stages, commands are run from dataset folder, with
+# tracing of plugins enabled
+stages = (("prepare", ["prepare",
+                       "--part-template", "resources/participants.json",
+                       "--recfolder", "nii=MRI",
+                       "--plugin", "resources/plugins/rename_plugin.py",
+                       "trace=True",
+                       "--", "source/", "renamed/"]),
+          ("map", ["map",
+                   "--plugin", "resources/plugins/bidsify_plugin.py",
+                   "trace=True",
+                   "--", "renamed/", "bids/"]),
+          ("process", ["process",
+                       "--plugin", "resources/plugins/process_plugin.py",
+                       "trace=True",
+                       "--", "renamed/", "bids/"]),
+          ("bidsify", ["bidsify",
+                       "--plugin", "resources/plugins/bidsify_plugin.py",
+                       "trace=True",
+                       "--", "renamed/", "bids/"])
+          )
+
+# trace of each stage (see instrument), relative to dataset folder
+stage_traces = {"prepare": "renamed/code/bidsme/rename_plugin_trace.jsonl",
+                "map": "bids/code/bidsme/bidsify_plugin_trace.jsonl",
+                "process": "bids/code/bidsme/process_plugin_trace.jsonl",
+                "bidsify": "bids/code/bidsme/bidsify_plugin_trace.jsonl"}
+
+# values of trace records summed per entry point
+trace_values = ("wall", "cpu", "opened", "read", "written")
+
+
+class Timer(object):
+    """
+    Context manager storing wall time of block in results
+    """
+    def __init__(self, results: dict, name: str):
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.results[self.name] = time.perf_counter() - self.start
+        logger.info("{}: {:.3f} s".format(self.name,
+                                         self.results[self.name]))
+
+
+def benchHelpers(dataset: str, workers: int) -> dict:
+    """
+    Times plugin helpers on source dataset
+    """
+    results = dict()
+    source = os.path.join(dataset, "source")
+    table = os.path.join(dataset, "resources", "Appariement.xlsx")
+    if os.path.isfile(table + ".idx"):
+        os.remove(table + ".idx")
+    with Timer(results, "subjects_compile"):
+        index = loadSubjects(table)
+    with Timer(results, "subjects_load"):
+        index = loadSubjects(table)
+
+    sessions = [os.path.join(source, sub, ses, "nii")
+                for sub in sorted(os.listdir(source))
+                for ses in sorted(os.listdir(os.path.join(source, sub)))]
+    files = [os.path.join(s, f) for s in sessions[:30]
+             for f in sorted(os.listdir(s)) if f.endswith(".json")]
+    with Timer(results, "sidecar_fields_{}".format(len(files))):
+        for f in files:
+            readFields(f)
+
+    series = [sourceSeries(s) for s in sessions[:30]]
+    series = [(ser, _sessionName(ser)) for ser in series]
+    with Timer(results, "validate_series_x1000"):
+        for _ in range(1000 // max(1, len(series)) + 1):
+            for ser, name in series:
+                validateSeries(ser, name)
+
+    with Timer(results, "preflight"):
+        preflight(source, index, "source", workers)
+    return results
+
+
+def _sessionName(series: list) -> str:
+    """
+    Returns name of session definitions matching best the
+    series of source session
+    """
+    return min(Series, key=lambda name: len(validateSeries(series, name)))
+
+
+def readTrace(path: str) -> dict:
+    """
+    Sums trace records of stage per entry point
+
+    Returns:
+    --------
+    dict:
+        entry point: dictionary with number of calls and
+        sums of trace_values
+    """
+    entry_points = dict()
+    with open(path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            ep = entry_points.setdefault(record["entry_point"],
+                                         dict.fromkeys(("calls",)
+                                                       + trace_values, 0))
+            ep["calls"] += 1
+            for name in trace_values:
+                ep[name] += record[name]
+    return entry_points
+
+
+def benchStages(dataset: str, bidsme: str) -> dict:
+    """
+    Times bidsme stages, run from dataset folder, and collects
+    time spent in each entry point from traces of plugins
+    """
+    results = dict()
+    code = os.path.join(dataset, "bids", "code", "bidsme")
+    os.makedirs(code, exist_ok=True)
+    shutil.copy2(os.path.join(dataset, "resources", "map", "bidsmap.yaml"),
+                 code)
+    for name, args in stages:
+        with Timer(results, name):
+            subprocess.run([sys.executable, bidsme] + args,
+                           cwd=dataset, check=True,
+                           stdout=subprocess.DEVNULL)
+        # trace is overwritten by next stage using same plugin
+        trace = os.path.join(dataset, stage_traces[name])
+        if os.path.isfile(trace):
+            results[name + "_entry_points"] = readTrace(trace)
+        else:
+            logger.warning("{}: No trace found in {}".format(name, trace))
+    return results
+
+
+def _version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+            description="Benchmarks plugins on synthetic datasets")
+    parser.add_argument("--workdir", required=True,
+                        help="folder where datasets are generated")
+    parser.add_argument("--scales", type=int, nargs="+",
+                        default=default_scales,
+                        help="numbers of subjects of datasets")
+    parser.add_argument("--volumes", type=int, default=0,
+                        help="number of volumes in multi-volume series")
+    parser.add_argument("--bidsme", default="",
+                        help="path to bidsme.py, stages are not "
+                             "timed if not given")
+    parser.add_argument("--clone", choices=generate.clone_methods,
+                        default="copy",
+                        help="method of cloning sidecars of "
+                             "generated datasets")
+    parser.add_argument("-j", "--workers", type=int,
+                        default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="path to json results")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s %(name)s: %(message)s")
+
+    report = {"version": _version(),
+              "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpus": os.cpu_count(),
+              "workers": args.workers,
+              "volumes": args.volumes,
+              "clone": args.clone,
+              "scales": dict()
+              }
+    templates = generate.findTemplates()
+    for scale in args.scales:
+        dataset = os.path.join(args.workdir, "scale-{}".format(scale))
+        results = dict()
+        if os.path.isdir(dataset):
+            shutil.rmtree(dataset)
+        with Timer(results, "generate"):
+            results["dataset"] = generate.generate(dataset, scale,
+                                                   args.volumes,
+                                                   templates=templates,
+                                                   clone=args.clone)
+        results.update(benchHelpers(dataset, args.workers))
+        if args.bidsme:
+            results.update(benchStages(dataset, args.bidsme))
+        report["scales"][str(scale)] = results
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
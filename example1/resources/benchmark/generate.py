@@ -0,0 +1,283 @@
+import os
+import re
+import sys
+import random
+import shutil
+import logging
+import argparse
+
+"""
+generate creates a synthetic source dataset at configurable scale,
+by cloning the sessions of example1 source dataset.
+
+Each generated subject has the three sessions defined in
+definitions.Series in random order, and belongs to patient or
+control group, patients being paired with controls. Multi-volume
+series (fMRI and diffusion) can be extended to a realistic number
+of volumes. Json sidecars are cloned from example, thus having
+realistic size, and images are placeholders, as in example.
+
+Sidecars are cloned by copy by default, so each generated file has
+its own inode, as in a real dataset. Reflink (copy-on-write) saves
+space on filesystems supporting it; hardlink shares one inode
+between all clones of a template, which does not reproduce a real
+dataset and is limited by the maximal number of links per inode
+(65000 on ext4).
+
+The generated dataset follows example1 layout: the copy of example
+resources (plugins, maps and sidecar files) is placed in resources
+folder, with the matching Appariement.xlsx table, so the example
+commands can be run directly from dataset folder.
+
+    python3 resources/benchmark/generate.py -n 1000 /tmp/scale-1000
+    python3 resources/benchmark/generate.py -n 1000 --clone reflink \
+        /tmp/scale-1000
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "plugins"))
+
+from definitions import Series, validateSeries  # noqa: E402
+from preflight import sourceSeries  # noqa: E402
+import placement  # noqa: E402
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# example1 folder
+example_root = os.path.normpath(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     "..", ".."))
+# example1 source dataset
+example_source = os.path.join(example_root, "source")
+
+# resources not copied into generated dataset
+skip_resources = ("benchmark", "__pycache__", "Appariement.xlsx")
+
+# image file name: prefix, exam, serie, acquisition, instance, echo
+_name = re.compile(r"^([a-z])(\d+)-(\d+)-(\d+)-(\d+)-(\d+)\.(nii|json)$")
+
+# methods of cloning sidecars, see placement.methods
+clone_methods = ("copy", "reflink", "hardlink")
+
+# column headers of subjects table
+table_columns = ["Patient", "Sex", "Age", "Education", 1, 2, 3,
+                 "Control", "Sex", "Age", "Education", 1, 2, 3]
+
+
+def findTemplates(source: str = example_source) -> dict:
+    """
+    Finds in source dataset one valid session of each type
+
+    Returns:
+    --------
+    dict:
+        session name: path to session folder
+    """
+    templates = dict()
+    for sub in sorted(os.listdir(source)):
+        for ses in sorted(os.listdir(os.path.join(source, sub))):
+            path = os.path.join(source, sub, ses)
+            series = sourceSeries(os.path.join(path, "nii"))
+            for name in Series:
+                if name not in templates\
+                        and not validateSeries(series, name):
+                    templates[name] = path
+    missing = set(Series) - set(templates)
+    if missing:
+        raise ValueError("No template session found for {}"
+                         .format(sorted(missing)))
+    return templates
+
+
+def _cloneSession(template: str, dest: str, exam: int,
+                  volumes: int) -> int:
+    """
+    Clones template session into dest, renaming files to given
+    exam number. Series with several acquisitions are extended
+    or truncated to given number of volumes.
+
+    Returns number of created files
+    """
+    nii_in = os.path.join(template, "nii")
+    nii_out = os.path.join(dest, "nii")
+    os.makedirs(nii_out, exist_ok=True)
+
+    # grouping files by serie
+    series = dict()
+    for name in sorted(os.listdir(nii_in)):
+        m = _name.match(name)
+        if m is None:
+            continue
+        series.setdefault(m.group(3), list()).append(m)
+
+    count = 0
+    for serie, files in series.items():
+        acqs = sorted(set(m.group(4) for m in files))
+        if volumes and len(acqs) > 1:
+            # multi-volume serie, using last volume as model
+            # for added volumes
+            model = [m for m in files if m.group(4) == acqs[-1]]
+            plan = list()
+            for vol in range(1, volumes + 1):
+                source = [m for m in files if int(m.group(4)) == vol]\
+                    or model
+                plan.extend((m, vol, vol) for m in source)
+        else:
+            plan = [(m, int(m.group(4)), int(m.group(5))) for m in files]
+
+        for m, acq, inst in plan:
+            name = "{}{}-{}-{:05d}-{:06d}-{}.{}".format(
+                    m.group(1), exam, serie, acq, inst,
+                    m.group(6), m.group(7))
+            out = os.path.join(nii_out, name)
+            if m.group(7) == "json":
+                placement.place(os.path.join(nii_in, m.group(0)), out)
+            else:
+                with open(out, "w") as f:
+                    f.write(name)
+            count += 1
+
+    inp = os.path.join(template, "inp")
+    if os.path.isdir(inp):
+        os.makedirs(os.path.join(dest, "inp"), exist_ok=True)
+        for name in sorted(os.listdir(inp)):
+            placement.place(os.path.join(inp, name),
+                            os.path.join(dest, "inp"))
+            count += 1
+    return count
+
+
+def copyResources(dest: str) -> None:
+    """
+    Copies example resources into dest, without subjects table
+    """
+    resources = os.path.join(example_root, "resources")
+    for root, dirs, files in os.walk(resources):
+        dirs[:] = sorted(d for d in dirs if d not in skip_resources)
+        out = os.path.join(dest, os.path.relpath(root, resources))
+        os.makedirs(out, exist_ok=True)
+        for name in files:
+            if name in skip_resources or name.startswith("Appariement"):
+                continue
+            shutil.copy2(os.path.join(root, name), out)
+
+
+def writeTable(path: str, rows: list) -> None:
+    """
+    Writes subjects table in format of Appariement.xlsx
+    """
+    import pandas
+    df = pandas.DataFrame(rows, columns=range(len(table_columns)))
+    df.columns = table_columns
+    df.to_excel(path, index=False)
+
+
+def generate(dest: str, subjects: int, volumes: int = 0,
+             seed: int = 0, templates: dict = None,
+             clone: str = "copy") -> dict:
+    """
+    Generates synthetic dataset
+
+    Parameters:
+    -----------
+    dest: str
+        path to created dataset, source dataset is placed in
+        source sub-folder, and resources in resources sub-folder
+    subjects: int
+        number of subjects
+    volumes: int
+        number of volumes of multi-volume series, if 0 the
+        number of volumes of template is kept
+    seed: int
+        seed of random generator
+    templates: dict
+        template sessions, as returned by findTemplates
+    clone: str
+        method of cloning sidecars, one of clone_methods
+
+    Returns:
+    --------
+    dict:
+        summary of generated dataset
+    """
+    if clone not in clone_methods:
+        raise ValueError("Invalid clone method '{}', must be one of {}"
+                         .format(clone, clone_methods))
+    rnd = random.Random(seed)
+    if templates is None:
+        templates = findTemplates()
+    strategy = placement.strategy
+    placement.setStrategy(clone)
+    try:
+        summary = _generate(dest, subjects, volumes, rnd, templates)
+    finally:
+        placement.setStrategy(strategy)
+    summary["clone"] = clone
+    return summary
+
+
+def _generate(dest: str, subjects: int, volumes: int,
+              rnd: random.Random, templates: dict) -> dict:
+    source = os.path.join(dest, "source")
+    os.makedirs(source, exist_ok=True)
+    for folder in ("renamed", "bids"):
+        os.makedirs(os.path.join(dest, folder), exist_ok=True)
+    copyResources(os.path.join(dest, "resources"))
+    width = max(3, len(str(subjects)))
+
+    rows = list()
+    files = 0
+    sessions = 0
+    exam = 1000
+    for first in range(1, subjects + 1, 2):
+        pair = [first, first + 1] if first < subjects else [first]
+        row = list()
+        for sub_id in pair:
+            order = list(Series)
+            rnd.shuffle(order)
+            sub_dir = os.path.join(source, "{:0{}d}".format(sub_id, width))
+            for ses in order:
+                exam += 1
+                ses_dir = os.path.join(sub_dir, "s{:05d}".format(exam))
+                files += _cloneSession(templates[ses], ses_dir,
+                                       exam, volumes)
+                sessions += 1
+            row += [sub_id, rnd.choice("MF"), rnd.randint(20, 60),
+                    rnd.randint(9, 20)]
+            row += [s[4:] for s in order]
+        if len(pair) == 1:
+            row += [None] * 7
+        rows.append(row)
+    writeTable(os.path.join(dest, "resources", "Appariement.xlsx"), rows)
+    logger.info("{}: {} subjects, {} sessions, {} files"
+                .format(dest, subjects, sessions, files))
+    return {"subjects": subjects, "sessions": sessions, "files": files}
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+            description="Generates synthetic dataset from example1")
+    parser.add_argument("destination",
+                        help="path to generated dataset")
+    parser.add_argument("-n", "--subjects", type=int, default=10,
+                        help="number of subjects")
+    parser.add_argument("--volumes", type=int, default=0,
+                        help="number of volumes in fMRI and diffusion "
+                             "series, default: as in example")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of random generator")
+    parser.add_argument("--clone", choices=clone_methods, default="copy",
+                        help="method of cloning sidecars, hardlink "
+                             "shares one inode between all clones")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s %(name)s: %(message)s")
+    generate(args.destination, args.subjects, args.volumes, args.seed,
+             clone=args.clone)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
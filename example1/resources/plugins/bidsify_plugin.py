@@ -1,9 +1,21 @@
 import os
-import shutil
 import logging
 import random
 
-from definitions import checkSeries
+from context import openContext, currentContext, closeContext
+from plan import loadPlan, invalid
+import placement
+import iopool
+from participants import ParticipantsTable, loadTemplate
+import instrument
+from instrument import traced
+from definitions import checkSeries, aux_files
+from bidsmap_index import loadBidsmap
+from sidecar import readFields
+import crawler
+from catalogue import Catalogue, cataloguePath
+import logqueue
+from logqueue import BraceMessage
 
 """
 bidsify_plugin defines all nessesary functions to bidsify
@@ -25,33 +37,57 @@ bidsfolder = None
 # switch if is a dry-run (test run)
 dry_run = False
 
+# participants table, filled at end of each subject and
+# written at the end of run, None if not requested
+participants = None
+# participants template
+part_json = None
 
-#####################
-# Session variables #
-#####################
+# compiled index of bidsmap rules, used to check that each
+# sequence is matched by bidsmap, None if check is not requested
+# or bidsmap not found
+bidsmap_index = None
 
-# Some sequences within session (namely fMRI and MPM structural) follows same
-# protocol, thus it is impossible to identify them only using
-# metadata
-# we will identify them by order they appear in session
+# crawled prepared dataset, queried instead of filesystem
+source_tree = None
 
-# list of sequences in order of acquisition in current session
-seq_list = list()
+# catalogue of sidecars of prepared dataset, used instead
+# of reading sidecars in bidsmap check, None if dataset is
+# not catalogued
+source_catalogue = None
 
 
 #####################
-# Sequence variable #
+# Session variables #
 #####################
 
-# The index of current sequence, corresponds to order in the sequence list
-seq_index = -1
-
+# Some sequences within session (namely fMRI and MPM structural) follows same
+# protocol, thus it is impossible to identify them only using metadata
+# we will identify them by order they appear in session
 
-def InitEP(source: str, destination: str, dry: bool) -> int:
+# the plan of session, with sequences in order of acquisition, their
+# role and IntendedFor, is built once by rename_plugin (see plan.py),
+# and is stored with index of current sequence in session context,
+# allowing to treat several sessions in parallel
+# see context.SessionContext.seq_list and seq_index
+
+
+@traced
+def InitEP(source: str, destination: str, dry: bool,
+           placement_mode: str = "auto",
+           trace: bool = False,
+           part_template: str = "",
+           io_workers: int = 0,
+           log_queue: bool = False,
+           check_bidsmap: bool = False) -> int:
     """
     Initialisation of plugin
 
     1. Saves source/destination folders and dry_run switch
+    2. Loads participants table
+    3. Loads tree of source dataset
+    4. Loads compiled index of bidsmap and catalogue of
+    source dataset, if bidsmap check is requested
 
     Parameters
     ----------
@@ -59,6 +95,24 @@ def InitEP(source: str, destination: str, dry: bool) -> int:
         path to source dataset
     destination:
         path to prepared dataset
+    placement_mode: str
+        how files are placed: auto, reflink, hardlink or copy
+    trace: bool
+        if True, entry points are traced in code/bidsme
+    part_template: str
+        path to participants json template, if set, the
+        participants.tsv is assembled by plugin and written
+        at the end of run
+    io_workers: int
+        number of threads placing files in background,
+        if 0 (default) files are placed immediately
+    log_queue: bool
+        if True, log records are written by background thread,
+        and also stored as json lines in code/bidsme
+    check_bidsmap: bool
+        if True, each sequence is checked to be matched by a run
+        of bidsmap; the check doesn't replace bidsme matching,
+        and costs a read of header for each sequence
     """
     global rawfolder
     global bidsfolder
@@ -67,8 +121,53 @@ def InitEP(source: str, destination: str, dry: bool) -> int:
     rawfolder = source
     bidsfolder = destination
     dry_run = dry
-
-
+    placement.setStrategy(placement_mode)
+    iopool.setWorkers(io_workers)
+    instrument.enabled = trace
+    logqueue.stop()
+    if log_queue:
+        logqueue.start("" if dry_run else
+                       os.path.join(bidsfolder, "code", "bidsme"),
+                       "bidsify_plugin")
+    if trace and not dry_run:
+        instrument.setOutput(os.path.join(bidsfolder, "code", "bidsme"),
+                             "bidsify_plugin")
+    else:
+        instrument.discardOutput()
+
+    # participants table is loaded once, and filled
+    # by SubjectEP
+    global participants
+    global part_json
+    participants = None
+    if part_template:
+        part_json = loadTemplate(part_template)
+        participants = ParticipantsTable()
+        participants.load(os.path.join(destination, "participants.tsv"))
+
+    global source_tree
+    source_tree = crawler.crawl(source,
+                                os.path.join(source, "code", "bidsme",
+                                             crawler.tree_name))
+
+    # bidsmap is looked in default location, the index is
+    # compiled only if bidsmap changed since last run
+    global source_catalogue
+    global bidsmap_index
+    source_catalogue = None
+    bidsmap_index = None
+    bidsmap = os.path.join(bidsfolder, "code", "bidsme", "bidsmap.yaml")
+    if check_bidsmap and not os.path.isfile(bidsmap):
+        logger.warning("{}: Bidsmap not found, sequences will not "
+                       "be checked".format(bidsmap))
+    elif check_bidsmap:
+        bidsmap_index = loadBidsmap(bidsmap)
+        path = cataloguePath(source)
+        if os.path.isfile(path):
+            source_catalogue = Catalogue.load(source, path)
+
+
+@traced
 def SubjectEP(scan):
     """
     Subject modification
@@ -108,7 +207,12 @@ def SubjectEP(scan):
     # in bidsified participant.tsv
     scan.sub_values["random"] = random.random()
 
+    if participants is not None:
+        participants.add(scan.subject, scan.sub_values)
+    logqueue.sessionSummary(scan.subject, scan.session)
+
 
+@traced
 def SessionEP(scan):
     """
     Session files modification
@@ -116,24 +220,27 @@ def SessionEP(scan):
     1. Stores the list of sequences in session
     2. Checks the sequences
     3. Copies HCL and LCL task and KSS/VAS files
-    to bidsified dataset
+    to bidsified dataset, and waits for their placement
     """
 
     ######################################
     # Initialisation of sesion variables #
     ######################################
-    # retrieving list of sequences and puttintg them into list
-    global seq_list
-    global seq_index
+    # retrieving plan of session, built by rename_plugin
     path = os.path.join(scan.in_path, "MRI")
-    seq_list = sorted(os.listdir(path))
-    seq_list = [s.split("-", 1)[1] for s in seq_list]
-    seq_index = -1
+    aux_input = os.path.join(scan.in_path, "auxiliary")
+    source_tree.refresh(path)
+    source_tree.refresh(aux_input)
+    ctx = openContext(scan.subject, scan.session)
+    plan = loadPlan(scan.in_path, scan.session, not dry_run, source_tree)
+    ctx.data["plan"] = plan["sequences"]
+    ctx.data["mri"] = path
+    ctx.seq_list = [seq["name"] for seq in plan["sequences"]]
 
     #################################
     # Checking sequences in session #
     #################################
-    checkSeries(path, scan.subject, scan.session, False)
+    checkSeries(path, scan.subject, scan.session, False, plan=plan)
 
     #############################################
     # Checking for existance of auxiliary files #
@@ -142,9 +249,8 @@ def SessionEP(scan):
     # all the copy instructions must be protected by
     # if not dry_run
 
-    aux_input = os.path.join(scan.in_path, "auxiliary")
-    if scan.session in ("ses-LCL", "ses-HCL"):
-        if not os.path.isdir(aux_input):
+    if scan.session in aux_files:
+        if not source_tree.isdir(aux_input):
             logger.error("Session {}/{} do not contain auxiliary folder"
                          .format(scan.subject, scan.session))
             raise FileNotFoundError("folder {} not found"
@@ -152,13 +258,10 @@ def SessionEP(scan):
         beh = os.path.join(scan.in_path, "beh")
         if not dry_run:
             os.makedirs(beh, exist_ok=True)
-        for old, new in (("FCsepNBack.tsv", "task-rest_events.tsv"),
-                         ("FCsepNBack.json", "task-rest_events.json"),
-                         ("VAS.tsv", "task-rest_beh.tsv"),
-                         ("VAS.json", "task-rest_beh.json")):
+        for old, new in aux_files[scan.session]:
             source = "{}/{}".format(aux_input, old)
             dest = "{}/{}_{}_{}".format(beh, scan.subject, scan.session, new)
-            if not os.path.isfile(source):
+            if not source_tree.isfile(source):
                 if dry_run:
                     logger.error("{}/{}: File {} not found"
                                  .format(scan.subject, scan.session, source))
@@ -172,80 +275,108 @@ def SessionEP(scan):
                 logger.warning("{}/{}: File {} already exists"
                                .format(scan.subject, scan.session, dest))
             if not dry_run:
-                shutil.copy2(source, dest)
+                iopool.submit((scan.subject, scan.session),
+                              placement.place, source, dest)
+        # files must be placed before bidsme treats the
+        # recordings of session
+        iopool.barrier((scan.subject, scan.session))
 
 
+@traced
 def SequenceEP(recording):
     """
     Sequence identification
-    """
-    global seq_index
 
+    1. Identifies the sequences sharing same protocol
+    2. Checks if sequence is matched by bidsmap, if requested
+    """
     # recording.custom is a dictionary for user-defined variables
     # that can be acessed from bidsmap
     # they are initialized at new sequence, and conserved for all files
     # within sequence, can be used to define sequence-global parameters
-    recording.custom["IntendedFor"] = ""
-    seq_index += 1
-    recid = seq_list[seq_index]
+    ctx = currentContext()
+    recid = ctx.nextSequence()
+    seq = ctx.data["plan"][ctx.seq_index]
 
     # checking if current sequence corresponds in correct place in list
     if recid != recording.recId():
-        logger.warning("{}: Id mismatch folder {}"
-                       .format(recording.recIdentity(False),
-                               recid))
-    # The inverted fMRI are taken just before normal fMRI
-    # looking into the following sequence will identify
-    # the current one
-    if recid == "cmrr_mbep2d_bold_mb2_invertpe":
-        mod = seq_list[seq_index + 1]
-        if mod.endswith("cmrr_mbep2d_bold_mb2_task_fat"):
-            recording.custom["IntendedFor"] = "nBack"
-        elif mod.endswith("cmrr_mbep2d_bold_mb2_task_nfat"):
-            recording.custom["IntendedFor"] = "nBack"
-        elif mod.endswith("cmrr_mbep2d_bold_mb2_rest"):
-            recording.custom["IntendedFor"] = "rest"
-        else:
-            recording.custom["IntendedFor"] = "invalid"
-            logger.warning("{}: Unknown session {}"
-                           .format(recording.recIdentity(),
-                                   mod))
-    # fmap images are taken for HCL, LCL and MPM (STROOP)
-    # sessions
-    elif recid == "gre_field_mapping":
-        if recording.sesId() in ("ses-HCL", "ses-LCL"):
-            recording.custom["IntendedFor"] = "HCL/LCL"
-        elif recording.sesId() == "ses-STROOP":
-            recording.custom["IntendedFor"] = "STROOP"
-        else:
-            logger.warning("{}: Unknown session {}"
-                           .format(recording.recIdentity(),
-                                   recording.sesId()))
-            recording.custom["IntendedFor"] = "invalid"
-    # fmaps sensBody and sensArray are taken just before
-    # structural PD , T1 and MT. Looking into next sequences
-    # will allow the identification
-    elif recid == "al_mtflash3d_sensArray":
-        det = seq_list[seq_index + 2]
-        if det.endswith("al_mtflash3d_PDw"):
-            recording.custom["IntendedFor"] = "PDw"
-        elif det.endswith("al_mtflash3d_T1w"):
-            recording.custom["IntendedFor"] = "T1w"
-        elif det.endswith("al_mtflash3d_MTw"):
-            recording.custom["IntendedFor"] = "MTw"
-        else:
-            logger.warning("{}: Unable determine modality"
-                           .format(recording.recIdentity()))
-            recording.custom["IntendedFor"] = "invalid"
-    elif recid == "al_mtflash3d_sensBody":
-        det = seq_list[seq_index + 1]
-        if det.endswith("al_mtflash3d_PDw"):
-            recording.custom["IntendedFor"] = "PDw"
-        elif det.endswith("al_mtflash3d_T1w"):
-            recording.custom["IntendedFor"] = "T1w"
-        elif det.endswith("al_mtflash3d_MTw"):
-            recording.custom["IntendedFor"] = "MTw"
-        else:
-            logger.warning("{}: Unable determine modality"
-                           .format(recording.recIdentity()))
-            recording.custom["IntendedFor"] = "invalid"
+        logger.warning(BraceMessage("{}: Id mismatch folder {}",
+                                    recording.recIdentity(False),
+                                    recid))
+
+    # The inverted fMRI, fmap and sensitivity maps are identified
+    # by session or by the sequence that follows them, resolved
+    # in session plan, see plan.resolve
+    recording.custom["IntendedFor"] = seq["intended_for"]
+    if seq["intended_for"] == invalid:
+        logger.warning(BraceMessage("{}: Unable determine IntendedFor "
+                                    "from {}",
+                                    recording.recIdentity(),
+                                    seq["reference"]))
+
+    ################################
+    # Checking matching in bidsmap #
+    ################################
+    if bidsmap_index is not None:
+        _checkBidsmap(recording, ctx)
+
+
+def _checkBidsmap(recording, ctx) -> None:
+    """
+    Looks for bidsmap rule matching the first file of sequence
+    """
+    folder = os.path.join(ctx.data["mri"],
+                          ctx.data["plan"][ctx.seq_index]["folder"])
+    # sequence folders are modified by process_plugin
+    source_tree.refresh(folder)
+    headers = source_tree.lsfiles(folder, "*.json")
+    if not headers:
+        return
+    fields = ("ProtocolName", "ImageType")
+    attributes = None
+    if source_catalogue is not None:
+        attributes = source_catalogue.get(headers[0],
+                                          *source_tree.stat(headers[0]))
+    if attributes is None:
+        attributes = readFields(headers[0], fields)
+    else:
+        attributes = {f: attributes[f] for f in fields}
+    for name, value in recording.custom.items():
+        attributes["<<custom:{}>>".format(name)] = value
+    rule = bidsmap_index.match(attributes)
+    if rule is None:
+        logger.warning(BraceMessage("{}: No matching run in bidsmap",
+                                    recording.recIdentity()))
+    else:
+        logger.debug(BraceMessage("{}: Matched {}[{}] ({})",
+                                  recording.recIdentity(),
+                                  rule.modality, rule.index, rule.suffix))
+
+
+@traced
+def SessionEndEP(scan):
+    """
+    1. Releases session context
+    2. Reports number of log records of session
+    """
+    closeContext()
+    logqueue.sessionSummary(scan.subject, scan.session)
+
+
+@traced
+def ExitEP() -> int:
+    """
+    1. Writes participants table
+    2. Reports placement statistics (entry points trace is
+    written after ExitEP, see instrument.traced)
+    3. Writes pending log records
+    """
+    if participants is not None and not dry_run:
+        # written after bidsme, values of its file are kept
+        # only where plugin table has none
+        path = os.path.join(bidsfolder, "participants.tsv")
+        participants.load(path, update=False)
+        participants.write(path, part_json)
+    iopool.shutdown()
+    placement.summary()
+    logqueue.stop()
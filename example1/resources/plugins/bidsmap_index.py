@@ -0,0 +1,236 @@
+import re
+import logging
+
+from indexcache import loadIndex
+
+"""
+bidsmap_index defines the compiled form of bidsmap rules.
+
+In bidsmap, each run (rule) matches recording attributes by regular
+expressions, and recordings are compared with rules in order, first
+matching rule being retained. Most of patterns are plain literals
+(ProtocolName, ImageType, IntendedFor), so rules are grouped by set
+of their literal attributes, and each group is hashed by the values
+of these attributes. A recording is compared only with rules found
+in hash tables and with rules containing true regular expressions,
+the order of rules in bidsmap being preserved.
+
+Compiled index is stored in binary sidecar next to bidsmap (see
+indexcache), and invalidated if bidsmap changes.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# version of index format, must be increased each time
+# the structure of index changes
+index_version = 1
+
+# regex special characters, pattern containing any of them
+# (unescaped) is not a literal
+_special = re.compile(r"[.^$*+?{}\[\]|()]")
+# escaped character
+_escaped = re.compile(r"\\(.)")
+
+
+def literal(pattern: str) -> str:
+    """
+    Returns the string matched by pattern if pattern is a plain
+    literal, None otherwise
+    """
+    pattern = str(pattern)
+    plain = _escaped.sub("", pattern)
+    if _special.search(plain) or plain.endswith("\\"):
+        return None
+    # escaped letters and digits are character classes
+    for m in _escaped.finditer(pattern):
+        if m.group(1).isalnum():
+            return None
+    return _escaped.sub(r"\1", pattern)
+
+
+class Rule(object):
+    """
+    Single run of bidsmap
+
+    Attributes:
+    -----------
+    order: int
+        position of rule in bidsmap
+    modality: str
+        modality of rule (func, dwi, __ignore__, etc.)
+    index: int
+        index of rule in modality list
+    suffix: str
+        bids suffix of rule
+    provenance: str
+        provenance of rule
+    literals: tuple
+        names of attributes with literal pattern, sorted
+    values: tuple
+        literal values of these attributes
+    patterns: tuple
+        (name, pattern) of attributes with regex pattern
+    """
+    __slots__ = ["order", "modality", "index", "suffix", "provenance",
+                 "literals", "values", "patterns"]
+
+    def __init__(self, order: int, modality: str, index: int, run: dict):
+        self.order = order
+        self.modality = modality
+        self.index = index
+        self.suffix = run.get("suffix", "")
+        self.provenance = run.get("provenance", "")
+        literals = list()
+        patterns = list()
+        for name, pattern in sorted((run.get("attributes") or {}).items()):
+            # empty attributes are not checked
+            if pattern is None or pattern == "":
+                continue
+            value = literal(pattern)
+            if value is None:
+                patterns.append((name, str(pattern)))
+            else:
+                literals.append((name, value))
+        self.literals = tuple(n for n, v in literals)
+        self.values = tuple(v for n, v in literals)
+        self.patterns = tuple(patterns)
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return "Rule({}[{}], {})".format(self.modality, self.index,
+                                         self.suffix)
+
+    def matchPatterns(self, attributes: dict) -> bool:
+        """
+        Checks regex attributes of rule
+        """
+        for name, pattern in self.patterns:
+            if re.fullmatch(pattern, _value(attributes.get(name))) is None:
+                return False
+        return True
+
+
+def _value(value) -> str:
+    """
+    Converts attribute value to matched string
+    """
+    if value is None:
+        return ""
+    return str(value).strip()
+
+
+class BidsmapIndex(object):
+    """
+    Hash index of bidsmap rules for one data format and module
+
+    Attributes:
+    -----------
+    rules: list
+        list of Rules in bidsmap order
+    tables: dict
+        key: names of literal attributes
+        value: dict of literal values to list of rules
+    """
+    def __init__(self, rules: list):
+        self.rules = rules
+        self.tables = dict()
+        for rule in rules:
+            table = self.tables.setdefault(rule.literals, dict())
+            table.setdefault(rule.values, list()).append(rule)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def candidates(self, attributes: dict) -> list:
+        """
+        Returns rules matching literal attributes, in bidsmap order
+        """
+        found = list()
+        for names, table in self.tables.items():
+            rules = table.get(tuple(_value(attributes.get(n))
+                                    for n in names))
+            if rules:
+                found.extend(rules)
+        if len(self.tables) > 1:
+            found.sort(key=lambda r: r.order)
+        return found
+
+    def match(self, attributes: dict) -> Rule:
+        """
+        Returns first rule matching attributes, None if no rule
+        matches
+
+        Parameters:
+        -----------
+        attributes: dict
+            recording attributes, custom values are passed
+            as '<<custom:name>>' keys
+        """
+        for rule in self.candidates(attributes):
+            if rule.matchPatterns(attributes):
+                return rule
+        return None
+
+
+def compileBidsmap(bidsmap_file: str,
+                   dataformat: str = "MRI",
+                   module: str = "hmriNIFTI") -> BidsmapIndex:
+    """
+    Parses bidsmap and compiles rules of given data format and
+    module
+
+    Parameters:
+    -----------
+    bidsmap_file: str
+        path to bidsmap yaml file
+    dataformat: str
+        data format section of bidsmap
+    module: str
+        module sub-section of bidsmap
+
+    Returns:
+    --------
+    BidsmapIndex
+    """
+    import yaml
+
+    with open(bidsmap_file, "r") as f:
+        bidsmap = yaml.safe_load(f)
+    section = ((bidsmap or {}).get(dataformat) or {}).get(module) or {}
+    rules = list()
+    for modality, runs in section.items():
+        for ind, run in enumerate(runs or []):
+            rules.append(Rule(len(rules), modality, ind, run))
+    return BidsmapIndex(rules)
+
+
+def loadBidsmap(bidsmap_file: str,
+                dataformat: str = "MRI",
+                module: str = "hmriNIFTI") -> BidsmapIndex:
+    """
+    Loads bidsmap index from compiled sidecar, if it is
+    up to date, otherwise compiles it from bidsmap
+
+    Parameters:
+    -----------
+    bidsmap_file: str
+        path to bidsmap yaml file
+    dataformat: str
+        data format section of bidsmap
+    module: str
+        module sub-section of bidsmap
+
+    Returns:
+    --------
+    BidsmapIndex
+    """
+    return loadIndex(bidsmap_file, (index_version, dataformat, module),
+                     compileBidsmap, dataformat, module)
@@ -0,0 +1,426 @@
+import os
+import sys
+import json
+import gzip
+import logging
+import argparse
+
+import crawler
+from parallel import runParallel
+from sidecar import readFields, hmri_fields
+from filenames import parseNames
+
+"""
+catalogue defines the columnar catalogue of sidecars metadata.
+
+Requested header fields of all json sidecars of a dataset (source
+or prepared) are harvested in one pass, by a pool of worker
+processes, into a table with one row per sidecar, keyed by subject,
+session, sequence and file, and with size and modification time of
+sidecar. Table is stored in code/bidsme of dataset as Parquet file
+if pyarrow is available, and as gzip-compressed json of columns
+otherwise.
+
+Catalogue is updated incrementally: only new or modified sidecars
+are read again. Queries are answered from columns, without reading
+json files:
+
+    python3 resources/plugins/catalogue.py build renamed/
+    python3 resources/plugins/catalogue.py query renamed/ \\
+                                           RepetitionTime=1170
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# base name of catalogue, placed in code/bidsme folder
+catalogue_base = "catalogue"
+
+# version of catalogue format, catalogue with other version
+# is rebuilt
+catalogue_version = 1
+
+# key columns, preceding fields columns
+key_columns = ("subject", "session", "sequence", "file", "size", "mtime")
+
+# top folders of dataset that are not catalogued
+skip_folders = ("code", "derivatives", "sourcedata")
+
+# number of sidecars read by one job of worker process
+batch_size = 256
+
+
+def _hasArrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def cataloguePath(dataset: str) -> str:
+    """
+    Returns path to catalogue of dataset, Parquet file if
+    pyarrow is available, json otherwise
+    """
+    ext = ".parquet" if _hasArrow() else ".json.gz"
+    return os.path.join(dataset, "code", "bidsme", catalogue_base + ext)
+
+
+def splitKey(rel: str) -> tuple:
+    """
+    Returns subject, session and sequence of sidecar from its
+    path relative to dataset.
+
+    In prepared dataset, the sequence is the name of folder
+    (ex. 001-localizer), in source dataset, where all sidecars
+    of session are in same folder, it is the series number
+    in file name (ex. 0002 for f1513-0002-00001-000001-01.json)
+    """
+    parts = rel.split(os.sep)
+    subject = parts[0]
+    session = parts[1] if len(parts) > 2 else ""
+    folder = parts[-2] if len(parts) > 2 else ""
+    prefix = folder.split("-", 1)[0]
+    if prefix.isdigit() and "-" in folder:
+        return subject, session, folder
+    parsed, unmatched = parseNames(parts[-1:])
+    if parsed:
+        return subject, session, "{:04d}".format(parsed[0].series)
+    return subject, session, folder
+
+
+def _harvest(job: tuple) -> list:
+    """
+    Reads fields of batch of sidecars, in worker process
+
+    Parameters:
+    -----------
+    job: tuple
+        dataset path, list of relative paths, fields
+
+    Returns:
+    --------
+    list:
+        list of field values for each sidecar, None for
+        unreadable sidecars
+    """
+    dataset, files, fields = job
+    values = list()
+    for rel in files:
+        try:
+            header = readFields(os.path.join(dataset, rel), fields)
+        except (OSError, ValueError) as e:
+            logger.warning("{}: Unable to read: {}".format(rel, e))
+            header = None
+        values.append(header)
+    return values
+
+
+def _normalize(values: list) -> list:
+    """
+    Converts column values to single type: lists and dicts are
+    stored as json, and mixed strings and numbers as strings
+    """
+    values = [json.dumps(v) if isinstance(v, (list, dict)) else v
+              for v in values]
+    types = set(type(v) for v in values if v is not None)
+    if str in types and len(types) > 1:
+        values = [v if v is None else str(v) for v in values]
+    elif float in types:
+        values = [v if v is None else float(v) for v in values]
+    return values
+
+
+class Catalogue(object):
+    """
+    Columnar catalogue of sidecars
+
+    Attributes:
+    -----------
+    dataset: str
+        path to dataset
+    fields: tuple
+        names of harvested fields
+    columns: dict
+        column name: list of values, key columns followed
+        by fields
+    index: dict
+        path of sidecar relative to dataset: row
+    """
+    def __init__(self, dataset: str, fields: tuple = hmri_fields):
+        self.dataset = os.path.abspath(dataset)
+        self.fields = tuple(fields)
+        self.columns = {name: list()
+                        for name in key_columns + self.fields}
+        self.index = dict()
+
+    def __len__(self):
+        return len(self.columns["file"])
+
+    def _reindex(self) -> None:
+        self.index = {f: row for row, f in enumerate(self.columns["file"])}
+
+    def row(self, row: int) -> dict:
+        """
+        Returns row as dictionary
+        """
+        return {name: col[row] for name, col in self.columns.items()}
+
+    def get(self, path: str, size: int = None, mtime: int = None) -> dict:
+        """
+        Returns fields of sidecar, None if sidecar is not in
+        catalogue, or if given size and mtime differ from
+        catalogued ones
+
+        Parameters:
+        -----------
+        path: str
+            path to sidecar
+        size, mtime: int
+            size and modification time of sidecar, if given
+            they are compared with catalogued values
+        """
+        rel = os.path.relpath(os.path.abspath(path), self.dataset)
+        row = self.index.get(rel)
+        if row is None:
+            return None
+        if size is not None and self.columns["size"][row] != size:
+            return None
+        if mtime is not None and self.columns["mtime"][row] != mtime:
+            return None
+        return {f: self.columns[f][row] for f in self.fields}
+
+    def select(self, **conditions) -> list:
+        """
+        Returns rows, as dictionaries, where each given column
+        has given value; string values are compared without
+        trailing spaces
+        """
+        rows = range(len(self))
+        for name, value in conditions.items():
+            col = self.columns[name]
+            if isinstance(value, str):
+                rows = [r for r in rows if isinstance(col[r], str)
+                        and col[r].rstrip() == value.rstrip()]
+            else:
+                rows = [r for r in rows if col[r] == value]
+        return [self.row(r) for r in rows]
+
+    def sessions(self, **conditions) -> list:
+        """
+        Returns sorted list of (subject, session) having at least
+        one sidecar matching conditions
+        """
+        return sorted(set((r["subject"], r["session"])
+                          for r in self.select(**conditions)))
+
+    def update(self, tree: crawler.Tree = None, workers: int = 0) -> int:
+        """
+        Harvests new and modified sidecars of dataset, and removes
+        from catalogue the deleted ones
+
+        Parameters:
+        -----------
+        tree: crawler.Tree
+            crawled dataset, crawled if None
+        workers: int
+            number of worker processes
+
+        Returns:
+        --------
+        int:
+            number of read sidecars
+        """
+        if tree is None:
+            tree = crawler.Tree(self.dataset)
+        found = list()
+        for top in tree.lsdirs(self.dataset):
+            if os.path.basename(top) in skip_folders:
+                continue
+            prefix = os.path.basename(top)
+            for rel, size, mtime in tree.files(top):
+                if rel.endswith(".json"):
+                    found.append((os.path.join(prefix, rel), size, mtime))
+        found.sort()
+
+        rows = list()
+        changed = list()
+        for rel, size, mtime in found:
+            row = self.index.get(rel)
+            if row is not None and self.columns["size"][row] == size\
+                    and self.columns["mtime"][row] == mtime:
+                rows.append(self.row(row))
+            else:
+                rows.append(None)
+                changed.append(len(rows) - 1)
+
+        jobs = [(self.dataset,
+                 [found[i][0] for i in changed[k:k + batch_size]],
+                 self.fields)
+                for k in range(0, len(changed), batch_size)]
+        headers = [h for res in runParallel(_harvest, jobs, workers)
+                   for h in res]
+        for i, header in zip(changed, headers):
+            rel, size, mtime = found[i]
+            if header is None:
+                continue
+            sub, ses, seq = splitKey(rel)
+            row = {"subject": sub, "session": ses, "sequence": seq,
+                   "file": rel, "size": size, "mtime": mtime}
+            row.update(header)
+            rows[i] = row
+
+        removed = len(set(self.index).difference(f[0] for f in found))
+        rows = [r for r in rows if r is not None]
+        self.columns = {name: [r[name] for r in rows]
+                        for name in self.columns}
+        self._reindex()
+        logger.info("{}: {} sidecars catalogued, {} read, {} removed"
+                    .format(self.dataset, len(rows), len(changed),
+                            removed))
+        return len(changed)
+
+    def save(self, path: str) -> None:
+        """
+        Atomically writes catalogue, as Parquet file if path ends
+        with .parquet, and as compressed json otherwise
+        """
+        columns = {name: _normalize(col)
+                   for name, col in self.columns.items()}
+        tmp_file = path + ".tmp"
+        if path.endswith(".parquet"):
+            import pyarrow
+            import pyarrow.parquet
+
+            table = pyarrow.table(columns)
+            table = table.replace_schema_metadata(
+                    {"version": str(catalogue_version),
+                     "fields": json.dumps(self.fields)})
+            pyarrow.parquet.write_table(table, tmp_file,
+                                        compression="zstd")
+        else:
+            with gzip.open(tmp_file, "wt") as f:
+                json.dump({"version": catalogue_version,
+                           "fields": self.fields,
+                           "columns": columns}, f, separators=(",", ":"))
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, dataset: str, path: str,
+             fields: tuple = hmri_fields):
+        """
+        Loads catalogue from path. If file is missing, invalid or
+        contains other fields, returns empty catalogue
+        """
+        cat = cls(dataset, fields)
+        try:
+            if path.endswith(".parquet"):
+                import pyarrow.parquet
+
+                table = pyarrow.parquet.read_table(path)
+                meta = table.schema.metadata or {}
+                version = int(meta.get(b"version", b"0"))
+                stored = tuple(json.loads(meta.get(b"fields", b"[]")))
+                columns = table.to_pydict()
+            else:
+                with gzip.open(path, "rt") as f:
+                    data = json.load(f)
+                version = data["version"]
+                stored = tuple(data["fields"])
+                columns = data["columns"]
+        except FileNotFoundError:
+            return cat
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("{}: Invalid catalogue: {}".format(path, e))
+            return cat
+        if version != catalogue_version or stored != cat.fields:
+            logger.info("{}: Catalogue outdated, rebuilding".format(path))
+            return cat
+        cat.columns = {name: list(columns[name]) for name in cat.columns}
+        cat._reindex()
+        return cat
+
+
+def build(dataset: str, fields: tuple = hmri_fields,
+          workers: int = 0, tree: crawler.Tree = None) -> Catalogue:
+    """
+    Creates or updates catalogue of dataset, and stores it
+    in code/bidsme folder of dataset
+    """
+    path = cataloguePath(dataset)
+    cat = Catalogue.load(dataset, path, fields)
+    cat.update(tree, workers)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cat.save(path)
+    return cat
+
+
+def _parseValue(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+            description="Builds and queries catalogue of sidecars "
+                        "metadata")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("build", help="creates or updates catalogue")
+    cmd.add_argument("dataset", help="path to source or prepared dataset")
+    cmd.add_argument("--fields", nargs="+", default=list(hmri_fields),
+                     help="header fields to harvest")
+    cmd.add_argument("-j", "--workers", type=int,
+                     default=os.cpu_count(),
+                     help="number of worker processes")
+
+    cmd = commands.add_parser("query", help="lists matching sessions")
+    cmd.add_argument("dataset", help="path to catalogued dataset")
+    cmd.add_argument("conditions", nargs="+",
+                     help="conditions as Field=value")
+    cmd.add_argument("--fields", nargs="+", default=list(hmri_fields),
+                     help="header fields of catalogue")
+    cmd.add_argument("--files", action="store_true",
+                     help="lists matching sidecars instead of sessions")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s %(name)s: %(message)s")
+    if args.command == "build":
+        cat = build(args.dataset, tuple(args.fields), args.workers)
+        logger.info("{}: {} sidecars catalogued"
+                    .format(args.dataset, len(cat)))
+        return 0
+
+    cat = Catalogue.load(args.dataset, cataloguePath(args.dataset),
+                         tuple(args.fields))
+    if not len(cat):
+        logger.error("{}: No catalogue".format(args.dataset))
+        return 1
+    conditions = dict()
+    for cond in args.conditions:
+        name, sep, value = cond.partition("=")
+        if not sep:
+            parser.error("Invalid condition '{}'".format(cond))
+        conditions[name] = _parseValue(value)
+    if args.files:
+        result = [row["file"] for row in cat.select(**conditions)]
+        kind = "sidecars"
+    else:
+        result = ["{}/{}".format(sub, ses)
+                  for sub, ses in cat.sessions(**conditions)]
+        kind = "sessions"
+    logger.info("{} {} matching {}".format(len(result), kind,
+                                           args.conditions))
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
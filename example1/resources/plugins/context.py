@@ -0,0 +1,124 @@
+import logging
+
+"""
+context defines the per-session state of plugins. Instead of
+module-level variables, each subject and session works with its
+own SessionContext, created by SubjectEP/SessionEP, so state can't
+leak from one session to the next. Contexts can be pickled, to be
+passed to jobs of parallel.runParallel.
+
+bidsme calls entry points of a session, and of its sequences,
+serially, so sequence entry points retrieve the context opened
+by session entry point with currentContext, and subject and
+session ids are never re-derived from recording
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+
+class SessionContext(object):
+    """
+    State of a plugin for one subject/session
+
+    Attributes:
+    -----------
+    subject: str
+        subject id
+    session: str
+        session id, empty for subject-wide context
+    seq_list: list
+        list of sequences in order of acquisition in session
+    seq_index: int
+        index of current sequence in seq_list
+    scans_map: dict
+        map of individual sessions of subject,
+        source session folder to bidsified session
+    data: dict
+        plugin-specific values
+    """
+    __slots__ = ["subject", "session",
+                 "seq_list", "seq_index",
+                 "scans_map", "data"]
+
+    def __init__(self, subject: str, session: str = ""):
+        self.subject = subject
+        self.session = session
+        self.seq_list = list()
+        self.seq_index = -1
+        self.scans_map = dict()
+        self.data = dict()
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return "SessionContext({}/{}, {}/{})".format(self.subject,
+                                                     self.session,
+                                                     self.seq_index,
+                                                     len(self.seq_list))
+
+    def nextSequence(self) -> str:
+        """
+        Advances to next sequence and returns its name
+        """
+        self.seq_index += 1
+        return self.seq_list[self.seq_index]
+
+    def following(self, offset: int = 1) -> str:
+        """
+        Returns name of sequence placed at given offset from
+        current one, or empty string if out of session
+        """
+        ind = self.seq_index + offset
+        if 0 <= ind < len(self.seq_list):
+            return self.seq_list[ind]
+        return ""
+
+
+# contexts of subject and session being treated
+#   key: "subject" or "session"
+#   value: SessionContext
+_current = dict()
+
+
+def _level(session: str) -> str:
+    return "session" if session else "subject"
+
+
+def openContext(subject: str, session: str = "") -> SessionContext:
+    """
+    Creates new context for given subject/session, replacing
+    current one; context is subject-wide if session is empty
+    """
+    ctx = SessionContext(subject, session)
+    _current[_level(session)] = ctx
+    return ctx
+
+
+def currentContext(level: str = "session") -> SessionContext:
+    """
+    Returns context of subject or session being treated,
+    raises KeyError if context was not opened
+
+    Parameters:
+    -----------
+    level: str
+        "subject" or "session"
+    """
+    try:
+        return _current[level]
+    except KeyError:
+        raise KeyError("{} context not initialized".format(level))
+
+
+def closeContext(level: str = "session") -> None:
+    """
+    Releases context of subject or session being treated
+    """
+    _current.pop(level, None)
@@ -0,0 +1,317 @@
+import os
+import gzip
+import json
+import fnmatch
+import logging
+
+"""
+crawler walks a dataset once with os.scandir, and keeps its
+structure in memory as a compact tree of folders and files
+(with size and modification time), so plugins can query the
+listing of subjects, sessions and sequences without going back
+to filesystem.
+
+Folders are stored as {"m": mtime, "c": {name: node}}, and files
+as [size, mtime]; the tree is directly serialisable into json,
+and stored as gzip-compressed file in code/bidsme of dataset,
+so the next stages reuse it. Loaded tree is checked against the
+modification time of subjects and sessions folders, and changed
+folders are crawled again. Hidden files and folders are ignored.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# name of stored tree, placed in code/bidsme folder
+tree_name = "dataset_tree.json.gz"
+
+# version of tree format, stored tree with other version is discarded
+tree_version = 1
+
+# depth of folders checked when stored tree is loaded
+# (subjects and sessions)
+check_depth = 2
+
+
+def _scan(path: str) -> dict:
+    """
+    Crawls folder, returning its node
+    """
+    children = dict()
+    node = {"m": os.stat(path).st_mtime_ns, "c": children}
+    stack = [(path, children)]
+    while stack:
+        folder, content = stack.pop()
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                st = entry.stat()
+                if entry.is_dir():
+                    sub = dict()
+                    content[entry.name] = {"m": st.st_mtime_ns, "c": sub}
+                    stack.append((entry.path, sub))
+                else:
+                    content[entry.name] = [st.st_size, st.st_mtime_ns]
+    return node
+
+
+def _isDir(node) -> bool:
+    return isinstance(node, dict)
+
+
+class Tree(object):
+    """
+    In-memory tree of dataset
+
+    Attributes:
+    -----------
+    root: str
+        absolute path to crawled folder
+    node: dict
+        node of root folder
+    """
+    def __init__(self, root: str, node: dict = None):
+        self.root = os.path.abspath(root)
+        self.node = node
+        if node is None:
+            self.node = _scan(self.root)
+
+    def _relpath(self, path: str) -> list:
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if rel == os.curdir:
+            return []
+        parts = rel.split(os.sep)
+        if parts[0] == os.pardir:
+            raise ValueError("{}: Outside of {}".format(path, self.root))
+        return parts
+
+    def _get(self, path: str):
+        """
+        Returns node of path, None if not in tree
+        """
+        node = self.node
+        for name in self._relpath(path):
+            if not _isDir(node):
+                return None
+            node = node["c"].get(name)
+            if node is None:
+                return None
+        return node
+
+    def _getDir(self, path: str) -> dict:
+        node = self._get(path)
+        if node is None:
+            raise FileNotFoundError(path)
+        if not _isDir(node):
+            raise NotADirectoryError(path)
+        return node
+
+    def exists(self, path: str) -> bool:
+        return self._get(path) is not None
+
+    def isdir(self, path: str) -> bool:
+        return _isDir(self._get(path))
+
+    def isfile(self, path: str) -> bool:
+        node = self._get(path)
+        return node is not None and not _isDir(node)
+
+    def listdir(self, path: str, pattern: str = None) -> list:
+        """
+        Returns sorted names of folder entries, optionally
+        matching glob pattern
+        """
+        names = sorted(self._getDir(path)["c"])
+        if pattern:
+            names = fnmatch.filter(names, pattern)
+        return names
+
+    def lsdirs(self, path: str, pattern: str = None) -> list:
+        """
+        Returns sorted paths to sub-folders of folder, optionally
+        matching glob pattern
+        """
+        content = self._getDir(path)["c"]
+        return [os.path.join(path, name)
+                for name in self.listdir(path, pattern)
+                if _isDir(content[name])]
+
+    def lsfiles(self, path: str, pattern: str = None) -> list:
+        """
+        Returns sorted paths to files of folder, optionally
+        matching glob pattern
+        """
+        content = self._getDir(path)["c"]
+        return [os.path.join(path, name)
+                for name in self.listdir(path, pattern)
+                if not _isDir(content[name])]
+
+    def mtime(self, path: str) -> int:
+        """
+        Returns modification time (in ns) of file or folder
+        """
+        node = self._get(path)
+        if node is None:
+            raise FileNotFoundError(path)
+        return node["m"] if _isDir(node) else node[1]
+
+    def stat(self, path: str) -> tuple:
+        """
+        Returns size and modification time (in ns) of file
+        """
+        node = self._get(path)
+        if node is None:
+            raise FileNotFoundError(path)
+        if _isDir(node):
+            raise IsADirectoryError(path)
+        return node[0], node[1]
+
+    def files(self, path: str) -> list:
+        """
+        Returns all files under folder as list of
+        (relative path, size, mtime) tuples, in no specific order
+        """
+        entries = list()
+        stack = [("", self._getDir(path))]
+        while stack:
+            rel, node = stack.pop()
+            for name, child in node["c"].items():
+                name = os.path.join(rel, name)
+                if _isDir(child):
+                    stack.append((name, child))
+                else:
+                    entries.append((name, child[0], child[1]))
+        return entries
+
+    def refresh(self, path: str, shallow: bool = False) -> bool:
+        """
+        Crawls again folder if its modification time changed,
+        removes it from tree if it no more exists.
+        If shallow, only entries of folder are listed again, and
+        nodes of its existing sub-folders are kept
+
+        Returns:
+        --------
+        bool:
+            True if folder was crawled again
+        """
+        parts = self._relpath(path)
+        parent = None
+        node = self.node
+        if parts:
+            parent = self._get(os.path.join(self.root, *parts[:-1]))
+            if not _isDir(parent):
+                raise FileNotFoundError(path)
+            node = parent["c"].get(parts[-1])
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if parent is None:
+                raise
+            parent["c"].pop(parts[-1], None)
+            return True
+        if _isDir(node) and node["m"] == mtime:
+            return False
+
+        if shallow and _isDir(node):
+            content = dict()
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    old = node["c"].get(entry.name)
+                    if entry.is_dir():
+                        content[entry.name] = old if _isDir(old)\
+                                else _scan(entry.path)
+                    else:
+                        st = entry.stat()
+                        content[entry.name] = [st.st_size, st.st_mtime_ns]
+            node = {"m": mtime, "c": content}
+        else:
+            node = _scan(path)
+        if parent is None:
+            self.node = node
+        else:
+            parent["c"][parts[-1]] = node
+        return True
+
+    def check(self, depth: int = check_depth) -> int:
+        """
+        Checks folders up to given depth against filesystem,
+        and crawls again the changed ones
+
+        Returns:
+        --------
+        int:
+            number of crawled folders
+        """
+        count = 0
+        level = [self.root]
+        for d in range(depth + 1):
+            following = list()
+            for path in level:
+                if self.refresh(path, d < depth):
+                    count += 1
+                if d < depth and self.isdir(path):
+                    following.extend(self.lsdirs(path))
+            level = following
+        return count
+
+    def save(self, path: str) -> None:
+        """
+        Atomically writes tree into gzip-compressed json file
+        """
+        tmp_file = path + ".tmp"
+        with gzip.open(tmp_file, "wt") as f:
+            json.dump({"version": tree_version,
+                       "root": self.root,
+                       "tree": self.node}, f, separators=(",", ":"))
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path: str, root: str):
+        """
+        Loads tree stored in path, returns None if file is
+        missing or invalid, or if it is a tree of another
+        dataset
+        """
+        try:
+            with gzip.open(path, "rt") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("{}: Invalid tree: {}".format(path, e))
+            return None
+        if data.get("version") != tree_version\
+                or data.get("root") != os.path.abspath(root):
+            logger.info("{}: Tree of other dataset, ignored".format(path))
+            return None
+        return cls(root, data["tree"])
+
+
+def crawl(root: str, cache: str = "") -> Tree:
+    """
+    Returns tree of dataset, loaded from cache file if it
+    exists, and crawled otherwise
+
+    Parameters:
+    -----------
+    root: str
+        path to dataset
+    cache: str
+        path to stored tree, if empty tree is always crawled
+    """
+    tree = None
+    if cache:
+        tree = Tree.load(cache, root)
+    if tree is None:
+        tree = Tree(root)
+        logger.debug("{}: Crawled".format(root))
+    else:
+        count = tree.check()
+        logger.debug("{}: Tree loaded, {} folders crawled again"
+                     .format(root, count))
+    return tree
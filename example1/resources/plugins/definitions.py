@@ -1,5 +1,10 @@
 import logging
 import os
+import json
+import hashlib
+from collections import namedtuple
+
+from logqueue import LazyMessage
 
 
 # defined this way, log messages will be formatted correctly
@@ -57,6 +62,18 @@ Series = {
         }
 
 
+# auxiliary files (in-scan task and KSS/VAS) of sessions, copied
+# from auxiliary folder of prepared session into beh folder of
+# bidsified session
+#   key: session name
+#   value: tuple of (auxiliary file, bids suffix)
+aux_files = dict.fromkeys(("ses-LCL", "ses-HCL"),
+                          (("FCsepNBack.tsv", "task-rest_events.tsv"),
+                           ("FCsepNBack.json", "task-rest_events.json"),
+                           ("VAS.tsv", "task-rest_beh.tsv"),
+                           ("VAS.json", "task-rest_beh.json")))
+
+
 countSeries = {}
 for ses in Series:
     countSeries[ses] = dict.fromkeys(Series[ses], 0)
@@ -64,9 +81,164 @@ for ses in Series:
         countSeries[ses][ser] += 1
 
 
+# series that must be followed, at given offset, by one of listed
+# series, with the description of expected series
+Lookahead = {
+        "cmrr_mbep2d_bold_mb2_invertpe": (1,
+                                          ("cmrr_mbep2d_bold_mb2_task_nfat",
+                                           "cmrr_mbep2d_bold_mb2_task_fat",
+                                           "cmrr_mbep2d_bold_mb2_rest"),
+                                          "task recording"),
+        "al_mtflash3d_sensArray": (2,
+                                   ("al_mtflash3d_PDw",
+                                    "al_mtflash3d_MTw",
+                                    "al_mtflash3d_T1w"),
+                                   "weighted recording"),
+        "al_mtflash3d_sensBody": (1,
+                                  ("al_mtflash3d_PDw",
+                                   "al_mtflash3d_MTw",
+                                   "al_mtflash3d_T1w"),
+                                  "weighted recording"),
+        }
+
+
+# Series and Lookahead compiled into per-session tables
+#   key: session name
+#   value: (set of allowed series,
+#           lookahead rules of session series,
+#           expected count of each serie)
+_compiled = {}
+for ses in Series:
+    _compiled[ses] = (frozenset(Series[ses]),
+                      {ser: (off, frozenset(targets), label)
+                       for ser, (off, targets, label) in Lookahead.items()
+                       if ser in Series[ses]},
+                      countSeries[ses])
+
+
+# violation of series definitions
+#   kind: one of "session", "serie", "order", "count"
+#   index: position of serie in session, -1 if not applicable
+#   serie: name of serie (of session for "session" kind)
+#   expected: expected following serie description or count
+#   found: found following serie or count
+Violation = namedtuple("Violation",
+                       ["kind", "index", "serie", "expected", "found"])
+
+
+# digest of series definitions, validation results stored with
+# earlier definitions are discarded
+definitions_digest = hashlib.sha1(
+        json.dumps([Series, Lookahead], sort_keys=True).encode()
+        ).hexdigest()
+
+
+def validationKey(folders: list, session: str) -> str:
+    """
+    Returns key of validation of session, digest of list of
+    series folders and of series definitions
+    """
+    h = hashlib.sha1(definitions_digest.encode())
+    h.update(session.encode())
+    for f in folders:
+        h.update(b"\0" + f.encode())
+    return h.hexdigest()
+
+
+def validateFolders(folders: list, session: str,
+                    cache: dict = None) -> list:
+    """
+    Checks list of series folders (named <index>-<serie>) against
+    session definitions, see validateSeries
+
+    Parameters:
+    -----------
+    folders: list
+        names of series folders, in order of acquisition
+    session: str
+        name of session
+    cache: dict
+        stored result of previous validation, reused if neither
+        folders nor definitions changed since, and updated
+        otherwise; usually "validation" entry of session plan
+
+    Returns:
+    --------
+    list of Violation
+    """
+    key = validationKey(folders, session)
+    if cache is not None and cache.get("key") == key:
+        return [Violation(*v) for v in cache["violations"]]
+    series = [f.split("-", 1)[1] for f in folders]
+    violations = validateSeries(series, session)
+    if cache is not None:
+        cache["key"] = key
+        cache["violations"] = [list(v) for v in violations]
+    return violations
+
+
+def validateSeries(series: list, session: str) -> list:
+    """
+    Checks list of series against session definitions in
+    a single pass
+
+    Parameters:
+    -----------
+    series: list
+        names of series, in order of acquisition
+    session: str
+        name of session
+
+    Returns:
+    --------
+    list of Violation:
+        all detected violations, empty list if series are valid
+    """
+    if session not in _compiled:
+        return [Violation("session", -1, session, None, None)]
+    allowed, rules, expected = _compiled[session]
+
+    violations = []
+    counts = dict()
+    n = len(series)
+    for ind, s in enumerate(series):
+        counts[s] = counts.get(s, 0) + 1
+        if s not in allowed:
+            violations.append(Violation("serie", ind, s, None, None))
+            continue
+        rule = rules.get(s)
+        if rule is None:
+            continue
+        off, targets, label = rule
+        following = series[ind + off] if ind + off < n else None
+        if following not in targets:
+            violations.append(Violation("order", ind, s, label, following))
+
+    for ser, count in expected.items():
+        count_loc = counts.get(ser, 0)
+        if count != count_loc:
+            violations.append(Violation("count", -1, ser, count, count_loc))
+    return violations
+
+
+def formatViolation(subject: str, session: str, v: Violation) -> str:
+    """
+    Returns human-readable description of violation
+    """
+    if v.kind == "session":
+        return "{}/{}: Invalid session".format(subject, session)
+    if v.kind == "serie":
+        return "{}/{}: Invalid serie {}".format(subject, session, v.serie)
+    if v.kind == "order":
+        return "{}/{}: {:03}-{} isn't followed by {}"\
+            .format(subject, session, v.index, v.serie, v.expected)
+    return "{}/{}: Expected {} occurences of {}, got {}"\
+        .format(subject, session, v.expected, v.serie, v.found)
+
+
 def checkSeries(path: str,
                 subject: str, session: str,
-                critical: bool) -> bool:
+                critical: bool, tree=None, plan: dict = None) -> bool:
     """
     Retrieve list of series from path and checks
     its compatibility with defined list
@@ -82,61 +254,36 @@ def checkSeries(path: str,
     critical: bool
         If True, mismatches will creeate exceptions
         and critical level log entries
+    tree: crawler.Tree
+        crawled dataset containing path, if None
+        path is listed from filesystem
+    plan: dict
+        plan of session, if given series are retrieved from
+        plan, and validation stored in plan is reused
     """
     if session not in Series:
         msg = "{}/{}: Invalid session".format(subject, session)
         reportError(msg, critical, KeyError)
         return False
-    passed = True
-    series = sorted(os.listdir(path))
-    series = [s.split("-", 1)[1] for s in series]
-    for ind, s in enumerate(series):
-        if s not in Series[session]:
-            msg = "{}/{}: Invalid serie {}".format(subject, session, s)
-            logger.error(msg)
-            passed = False
-            continue
-        if s == "cmrr_mbep2d_bold_mb2_invertpe":
-            if ind >= len(series) or\
-                    series[ind + 1] not in ("cmrr_mbep2d_bold_mb2_task_nfat",
-                                            "cmrr_mbep2d_bold_mb2_task_fat",
-                                            "cmrr_mbep2d_bold_mb2_rest"):
-                msg = "{}/{}: {:03}-{} isn't followed by task recording"\
-                    .format(subject, session, ind, s)
-                logger.error(msg)
-                passed = False
-        elif s == "al_mtflash3d_sensArray":
-            if ind >= len(series) - 1 or\
-                    series[ind + 2] not in ("al_mtflash3d_PDw",
-                                            "al_mtflash3d_MTw",
-                                            "al_mtflash3d_T1w"):
-                msg = "{}/{}: {:03}-{} isn't followed by weighted recording"\
-                        .format(subject, session, ind, s)
-                logger.error(msg)
-                passed = False
-        elif s == "al_mtflash3d_sensBody":
-            if ind >= len(series) or\
-                    series[ind + 1] not in ("al_mtflash3d_PDw",
-                                            "al_mtflash3d_MTw",
-                                            "al_mtflash3d_T1w"):
-                msg = "{}/{}: {:03}-{} isn't followed by weighted recording"\
-                        .format(subject, session, ind, s)
-                logger.error(msg)
-                passed = False
-
-    for ser, count in countSeries[session].items():
-        count_loc = series.count(ser)
-        if count != count_loc:
-            msg = "{}/{}: Expected {} occurences of {}, got {}"\
-                    .format(subject, session, count, ser, count_loc)
-            logger.error(msg)
-            passed = False
+    if plan is not None:
+        folders = [seq["folder"] for seq in plan["sequences"]]
+        violations = validateFolders(folders, session,
+                                     plan.setdefault("validation", {}))
+    else:
+        if tree is not None:
+            folders = tree.listdir(path)
+        else:
+            folders = sorted(os.listdir(path))
+        violations = validateFolders(folders, session)
+    for v in violations:
+        logger.error(LazyMessage(formatViolation, subject, session, v))
 
-    if not passed:
+    if violations:
         msg = "{}/{}: One or several series errors detected"\
                 .format(subject, session)
         reportError(msg, critical, ValueError)
-    return passed
+        return False
+    return True
 
 
 def reportError(msg: str, critical: bool, error: type = ValueError) -> None:
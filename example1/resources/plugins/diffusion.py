@@ -0,0 +1,216 @@
+import os
+import logging
+from collections import namedtuple
+
+from definitions import plugin_root
+from nifti import merge4D, splitext
+
+"""
+diffusion defines the handling of gradient tables of diffusion
+sequences.
+
+Gradient tables (bval/bvec files) are loaded once into numpy arrays
+and cached per protocol. Tables are validated as a whole (shapes,
+b-values, norm of gradient directions), and the number of their
+directions is compared with number of volumes of merged images.
+Runs of a session with protocols of concat_protocols can be
+concatenated into a single image with concatenated gradient table.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# gradient tables of protocols
+#   key: protocol name
+#   value: path to bval and bvec files, without extension
+gradient_tables = {
+        "cmrr_mbep2d_diff_NODDI":
+        os.path.join(plugin_root, "diffusion", "NODDI"),
+        "cmrr_mbep2d_diff_NODDI_invertpe":
+        os.path.join(plugin_root, "diffusion", "NODDI"),
+        "cmrr_mbep2d_diff_NODDI_noise":
+        os.path.join(plugin_root, "diffusion", "NODDI"),
+        }
+
+# protocols which table describes their acquisition, only their
+# runs are concatenated. Reversed phase-encoding and noise scans
+# are given NODDI table, as in example, but their actual tables
+# can't be derived from resources
+concat_protocols = ("cmrr_mbep2d_diff_NODDI",)
+
+# tolerance on norm of gradient directions
+norm_tolerance = 1e-2
+
+# gradient table
+#   bvals: array of shape (N,)
+#   bvecs: array of shape (3, N)
+GradientTable = namedtuple("GradientTable", ["bvals", "bvecs"])
+
+# loaded tables
+#   key: path of table
+#   value: (mtime of bval, mtime of bvec), GradientTable
+_cache = dict()
+
+
+def loadTable(path: str) -> GradientTable:
+    """
+    Loads gradient table from path.bval and path.bvec files
+    """
+    import numpy
+
+    bvals = numpy.loadtxt(path + ".bval", ndmin=1, dtype=float)
+    bvecs = numpy.loadtxt(path + ".bvec", ndmin=2, dtype=float)
+    if bvals.ndim != 1:
+        bvals = bvals.ravel()
+    if bvecs.shape[0] != 3 and bvecs.shape[-1] == 3:
+        # one direction per line
+        bvecs = bvecs.T
+    return GradientTable(bvals, bvecs)
+
+
+def getTable(protocol: str) -> GradientTable:
+    """
+    Returns gradient table of protocol, tables are loaded only
+    once, and reloaded if files changed
+
+    Returns:
+    --------
+    GradientTable:
+        table of protocol, None if protocol has no table
+    """
+    path = gradient_tables.get(protocol)
+    if path is None:
+        return None
+    signature = (os.stat(path + ".bval").st_mtime_ns,
+                 os.stat(path + ".bvec").st_mtime_ns)
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    table = loadTable(path)
+    for issue in validateTable(table):
+        logger.warning("{}: {}".format(path, issue))
+    _cache[path] = (signature, table)
+    return table
+
+
+def validateTable(table: GradientTable) -> list:
+    """
+    Checks consistency of gradient table
+
+    Returns:
+    --------
+    list:
+        list of found issues, empty if table is valid
+    """
+    import numpy
+
+    issues = list()
+    bvals, bvecs = table
+    if bvecs.ndim != 2 or bvecs.shape[0] != 3:
+        issues.append("bvec must have 3 rows, found shape {}"
+                      .format(bvecs.shape))
+        return issues
+    if bvals.shape[0] != bvecs.shape[1]:
+        issues.append("{} b-values for {} directions"
+                      .format(bvals.shape[0], bvecs.shape[1]))
+        return issues
+    if not numpy.isfinite(bvals).all() or not numpy.isfinite(bvecs).all():
+        issues.append("non-finite values")
+        return issues
+    negative = numpy.flatnonzero(bvals < 0)
+    if negative.size:
+        issues.append("negative b-values at {}".format(negative.tolist()))
+    norms = numpy.linalg.norm(bvecs, axis=0)
+    bad = numpy.flatnonzero((bvals > 0)
+                            & (numpy.abs(norms - 1) > norm_tolerance))
+    if bad.size:
+        issues.append("non-unit directions at {}".format(bad.tolist()))
+    return issues
+
+
+def checkRuns(runs: list) -> list:
+    """
+    Compares number of volumes of diffusion runs with number
+    of directions of their gradient tables
+
+    Parameters:
+    -----------
+    runs: list of tuples
+        (protocol, number of volumes)
+
+    Returns:
+    --------
+    list:
+        indexes of runs with mismatching number of volumes
+        or without gradient table
+    """
+    import numpy
+
+    if not runs:
+        return []
+    counts = dict()
+    for protocol in set(p for p, n in runs):
+        table = getTable(protocol)
+        counts[protocol] = -1 if table is None else table.bvals.shape[0]
+    expected = numpy.fromiter((counts[p] for p, n in runs),
+                              dtype=numpy.int64, count=len(runs))
+    found = numpy.fromiter((n for p, n in runs),
+                           dtype=numpy.int64, count=len(runs))
+    return numpy.flatnonzero(expected != found).tolist()
+
+
+def concatenate(tables: list) -> GradientTable:
+    """
+    Concatenates gradient tables, in order of runs
+    """
+    import numpy
+
+    return GradientTable(numpy.concatenate([t.bvals for t in tables]),
+                         numpy.concatenate([t.bvecs for t in tables],
+                                           axis=1))
+
+
+def writeTable(table: GradientTable, path: str) -> None:
+    """
+    Writes gradient table into path.bval and path.bvec files
+    """
+    import numpy
+
+    numpy.savetxt(path + ".bval", table.bvals[numpy.newaxis, :],
+                  fmt="%g", delimiter=" ")
+    numpy.savetxt(path + ".bvec", table.bvecs, fmt="%.6g", delimiter=" ")
+
+
+def concatenateRuns(images: list, protocols: list, output: str) -> int:
+    """
+    Concatenates diffusion runs into single image, with
+    concatenated gradient table
+
+    Parameters:
+    -----------
+    images: list
+        paths to 4D images of runs
+    protocols: list
+        protocols of runs
+    output: str
+        path to concatenated image, bval and bvec files are
+        created with same name
+
+    Returns:
+    --------
+    int:
+        number of volumes of concatenated image
+    """
+    tables = [getTable(p) for p in protocols]
+    for protocol, table in zip(protocols, tables):
+        if table is None:
+            raise ValueError("{}: No gradient table".format(protocol))
+    volumes = merge4D(images, output)
+    table = concatenate(tables)
+    if table.bvals.shape[0] != volumes:
+        os.remove(output)
+        raise ValueError("{}: {} volumes for {} directions"
+                         .format(output, volumes, table.bvals.shape[0]))
+    writeTable(table, splitext(output)[0])
+    return volumes
@@ -0,0 +1,187 @@
+import os
+import json
+import logging
+
+from parallel import runParallel
+
+"""
+events defines the conversion of in-scan task and behavioural
+log files into BIDS-ready tsv files.
+
+Log files are read by chunks of rows, and each chunk is treated
+column-wise: time columns are scaled from units of log file to
+units declared in json sidecar, missing values are normalised
+to 'n/a', and values of columns with declared Levels are checked.
+
+Conversion of several files can be done in one pass using
+pool of worker processes (see convertBatch)
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# scale of units to seconds
+unit_factors = {"s": 1., "ms": 1e-3, "us": 1e-6, "min": 60.}
+
+# values considered as missing in log files
+na_values = ("n/a", "N/A", "NA", "nan", "NaN", "")
+
+# number of rows treated at once
+chunk_rows = 10000
+
+# format of scaled values
+float_format = "%.10g"
+
+
+def loadSidecar(path: str) -> dict:
+    """
+    Loads json sidecar describing tsv columns
+    """
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def getScales(sidecar: dict, units: dict) -> dict:
+    """
+    Returns scale factors of columns, converting units of log file
+    to units declared in sidecar
+
+    Parameters:
+    -----------
+    sidecar: dict
+        json sidecar of tsv file
+    units: dict
+        units of columns in log file
+
+    Returns:
+    --------
+    dict:
+        column: scale factor
+    """
+    scales = dict()
+    for col, unit in units.items():
+        target = (sidecar.get(col) or {}).get("Units", unit)
+        if unit not in unit_factors or target not in unit_factors:
+            raise ValueError("{}: Unknown unit conversion {} -> {}"
+                             .format(col, unit, target))
+        scales[col] = unit_factors[unit] / unit_factors[target]
+    return scales
+
+
+def getLevels(sidecar: dict) -> dict:
+    """
+    Returns accepted values of columns with declared Levels
+    """
+    return {col: list(desc["Levels"]) for col, desc in sidecar.items()
+            if isinstance(desc, dict) and "Levels" in desc}
+
+
+def convertEvents(source: str, dest: str, sidecar_file: str,
+                  units: dict = None, strict: bool = False) -> dict:
+    """
+    Converts log file into BIDS tsv file
+
+    Parameters:
+    -----------
+    source: str
+        path to log file
+    dest: str
+        path to created tsv file
+    sidecar_file: str
+        path to json sidecar describing columns
+    units: dict
+        units of time columns in log file, columns are converted
+        to units of sidecar, if None no column is converted
+    strict: bool
+        if True, ValueError is raised if invalid values are found,
+        otherwise they are reported and replaced by n/a
+
+    Returns:
+    --------
+    dict:
+        number of converted rows and of invalid values per column
+    """
+    import pandas
+
+    if units is None:
+        units = dict()
+    sidecar = loadSidecar(sidecar_file)
+    scales = getScales(sidecar, units)
+    levels = getLevels(sidecar)
+
+    rows = 0
+    invalid = dict()
+    tmp_file = dest + ".tmp"
+    try:
+        with open(tmp_file, "w", newline="") as f:
+            reader = pandas.read_csv(source, sep="\t", dtype=str,
+                                     na_values=list(na_values),
+                                     keep_default_na=False,
+                                     chunksize=chunk_rows)
+            header = True
+            for chunk in reader:
+                for col, scale in scales.items():
+                    if col not in chunk.columns:
+                        continue
+                    values = pandas.to_numeric(chunk[col], errors="coerce")
+                    bad = values.isna() & chunk[col].notna()
+                    invalid[col] = invalid.get(col, 0) + int(bad.sum())
+                    chunk[col] = values * scale
+                for col, accepted in levels.items():
+                    if col not in chunk.columns:
+                        continue
+                    bad = chunk[col].notna() & ~chunk[col].isin(accepted)
+                    invalid[col] = invalid.get(col, 0) + int(bad.sum())
+                    chunk.loc[bad, col] = None
+                chunk.to_csv(f, sep="\t", index=False, header=header,
+                             na_rep="n/a", float_format=float_format)
+                header = False
+                rows += len(chunk)
+            if header:
+                # empty log file, keeping only header
+                with open(source, "r") as inp:
+                    f.write(inp.readline())
+
+        invalid = {col: n for col, n in invalid.items() if n}
+        if invalid:
+            msg = "{}: Invalid values: {}".format(
+                    source,
+                    ", ".join("{} ({})".format(*v)
+                              for v in sorted(invalid.items())))
+            if strict:
+                raise ValueError(msg)
+            logger.warning(msg)
+        os.replace(tmp_file, dest)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return {"source": source, "rows": rows, "invalid": invalid}
+
+
+def _convertJob(job: tuple) -> dict:
+    return convertEvents(*job)
+
+
+def convertBatch(jobs: list, workers: int = 0) -> list:
+    """
+    Converts several log files in one pass
+
+    Parameters:
+    -----------
+    jobs: list of tuples
+        arguments of convertEvents
+    workers: int
+        number of worker processes, if 0 or 1 files are
+        converted in current process
+
+    Returns:
+    --------
+    list:
+        results of convertEvents, in order of jobs
+    """
+    results = runParallel(_convertJob, jobs, workers)
+    logger.info("Converted {} log files, {} rows"
+                .format(len(results), sum(r["rows"] for r in results)))
+    return results
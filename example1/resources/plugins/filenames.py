@@ -0,0 +1,200 @@
+import os
+import re
+import logging
+from collections import namedtuple
+
+from sidecar import readFields
+
+"""
+filenames defines the index of source files built from their names.
+
+Files of source dataset follow the naming of hmri toolbox:
+
+    s1513-0012-00004-000211-01.nii
+    | |    |    |     |      |
+    | |    |    |     |      echo
+    | |    |    |     instance
+    | |    |    acquisition
+    | |    series
+    | exam
+    kind: 's' for structural, 'f' for functional
+
+All names of a folder are parsed by a single pass of compiled pattern
+over the joined listing, and files are grouped into series,
+acquisitions and echoes, without opening them. Only the sidecar of
+the first file of each series needs to be read to identify it.
+Optionally, the tokens of names can be cross-checked against the
+corresponding header fields.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# pattern of source file name, applied on joined listing
+_pattern = re.compile(r"^(?P<kind>[fs])(?P<exam>\d+)"
+                      r"-(?P<series>\d+)-(?P<acquisition>\d+)"
+                      r"-(?P<instance>\d+)-(?P<echo>\d+)"
+                      r"(?P<ext>\.[^\n]*)$", re.MULTILINE)
+
+# tokens of file name, numbers are converted to int
+FileName = namedtuple("FileName", ["name", "kind", "exam", "series",
+                                   "acquisition", "instance", "echo",
+                                   "ext"])
+
+# header fields corresponding to tokens, used in cross-check
+token_fields = (("series", "SeriesNumber"),
+                ("acquisition", "AcquisitionNumber"),
+                ("instance", "InstanceNumber"),
+                ("echo", "EchoNumbers"))
+
+
+def parseNames(names: list) -> tuple:
+    """
+    Parses list of file names
+
+    Returns:
+    --------
+    tuple:
+        list of FileName of matching names, in order of names,
+        and list of names that do not follow the naming
+    """
+    parsed = list()
+    matched = set()
+    for m in _pattern.finditer("\n".join(names)):
+        parsed.append(FileName(m.group(0), m.group("kind"),
+                               m.group("exam"),
+                               int(m.group("series")),
+                               int(m.group("acquisition")),
+                               int(m.group("instance")),
+                               int(m.group("echo")),
+                               m.group("ext")))
+        matched.add(m.group(0))
+    unmatched = [n for n in names if n not in matched]
+    return parsed, unmatched
+
+
+class SeriesGroup(object):
+    """
+    Files of one series
+
+    Attributes:
+    -----------
+    series: int
+        series number
+    kind: str
+        's' or 'f'
+    acquisitions: dict
+        acquisition number: dictionary echo number: sorted list
+        of instance numbers
+    files: list
+        sorted names of data files (all extensions except .json)
+    sidecars: list
+        sorted names of json sidecars
+    """
+    def __init__(self, series: int, kind: str):
+        self.series = series
+        self.kind = kind
+        self.acquisitions = dict()
+        self.files = list()
+        self.sidecars = list()
+
+    @property
+    def first(self) -> str:
+        """
+        Name of sidecar of first file of series, None if series
+        has no sidecars
+        """
+        return self.sidecars[0] if self.sidecars else None
+
+    @property
+    def echoes(self) -> list:
+        return sorted(set(e for a in self.acquisitions.values()
+                          for e in a))
+
+    @property
+    def instances(self) -> int:
+        """
+        Number of distinct (acquisition, echo, instance) in series
+        """
+        return sum(len(i) for a in self.acquisitions.values()
+                   for i in a.values())
+
+
+def groupNames(names: list) -> tuple:
+    """
+    Groups file names into series
+
+    Returns:
+    --------
+    tuple:
+        dictionary series number: SeriesGroup, ordered by series
+        number, and list of names not following the naming
+    """
+    parsed, unmatched = parseNames(sorted(names))
+    groups = dict()
+    for f in parsed:
+        group = groups.get(f.series)
+        if group is None:
+            group = groups[f.series] = SeriesGroup(f.series, f.kind)
+        if f.ext == ".json":
+            group.sidecars.append(f.name)
+        else:
+            group.files.append(f.name)
+        group.acquisitions.setdefault(f.acquisition, dict())\
+            .setdefault(f.echo, set()).add(f.instance)
+    for group in groups.values():
+        for echoes in group.acquisitions.values():
+            for echo, instances in echoes.items():
+                echoes[echo] = sorted(instances)
+    return {k: groups[k] for k in sorted(groups)}, unmatched
+
+
+def groupFolder(path: str, tree=None) -> tuple:
+    """
+    Groups files of folder into series, see groupNames
+
+    Parameters:
+    -----------
+    path: str
+        path to folder
+    tree: crawler.Tree
+        crawled dataset containing folder, if None
+        folder is listed from filesystem
+    """
+    names = tree.listdir(path) if tree is not None else os.listdir(path)
+    return groupNames(names)
+
+
+def crossCheck(path: str, groups: dict) -> list:
+    """
+    Compares tokens of names of sidecars with header fields,
+    all sidecars being read
+
+    Parameters:
+    -----------
+    path: str
+        path to folder
+    groups: dict
+        groups of folder, as returned by groupNames
+
+    Returns:
+    --------
+    list:
+        list of (file name, token, token value, header value)
+        for each mismatch
+    """
+    fields = tuple(f for t, f in token_fields)
+    mismatches = list()
+    for group in groups.values():
+        parsed, _ = parseNames(group.sidecars)
+        for f in parsed:
+            header = readFields(os.path.join(path, f.name), fields)
+            for token, field in token_fields:
+                value = header[field]
+                if isinstance(value, list) and len(value) == 1:
+                    value = value[0]
+                if value != getattr(f, token):
+                    mismatches.append((f.name, token,
+                                       getattr(f, token), value))
+    return mismatches
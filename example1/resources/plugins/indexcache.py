@@ -0,0 +1,110 @@
+import os
+import pickle
+import hashlib
+import logging
+
+"""
+indexcache defines the binary sidecar storing the compiled form
+of a resource file (subjects table, bidsmap). The resource is
+compiled only once, and the result is stored next to it. The sidecar
+is invalidated if the resource content changes, or if the signature
+of compilation (format version and parameters) differs; a resource
+only touched is not recompiled.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# extension of compiled index sidecar file
+index_ext = ".idx"
+
+
+def fileHash(path: str) -> str:
+    """
+    Returns sha1 hexdigest of file content
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def readIndex(idx_file: str) -> dict:
+    """
+    Reads compiled index, returns None if index do not exists
+    or is unreadable
+    """
+    if not os.path.isfile(idx_file):
+        return None
+    try:
+        with open(idx_file, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        logger.warning("{}: Unable to read index: {}".format(idx_file, e))
+        return None
+
+
+def writeIndex(idx_file: str, cache: dict) -> None:
+    """
+    Atomically writes compiled index. Failure to write is not
+    critical, index will be recompiled at next run
+    """
+    tmp_file = idx_file + ".tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, idx_file)
+    except OSError as e:
+        logger.warning("{}: Unable to write index: {}".format(idx_file, e))
+
+
+def loadIndex(path: str, signature, compile_func, *args):
+    """
+    Loads compiled form of file from sidecar, if it is up to
+    date, otherwise compiles it and stores it in sidecar
+
+    Parameters:
+    -----------
+    path: str
+        path to compiled file
+    signature:
+        picklable value identifying compilation (version of
+        index format, compilation parameters)
+    compile_func: callable
+        called as compile_func(path, *args), returns the
+        compiled index
+    args:
+        additional arguments of compile_func
+
+    Returns:
+    --------
+    compiled index
+    """
+    idx_file = path + index_ext
+    stat = os.stat(path)
+
+    cache = readIndex(idx_file)
+    if cache and cache["signature"] == signature:
+        if cache["mtime"] == stat.st_mtime_ns\
+                and cache["size"] == stat.st_size:
+            return cache["index"]
+        # file touched, checking if content changed
+        if cache["hash"] == fileHash(path):
+            logger.debug("{}: Unchanged content, updating timestamp"
+                         .format(path))
+            cache["mtime"] = stat.st_mtime_ns
+            cache["size"] = stat.st_size
+            writeIndex(idx_file, cache)
+            return cache["index"]
+
+    logger.info("{}: Compiling index".format(path))
+    cache = {"signature": signature,
+             "mtime": stat.st_mtime_ns,
+             "size": stat.st_size,
+             "hash": fileHash(path),
+             "index": compile_func(path, *args)
+             }
+    writeIndex(idx_file, cache)
+    return cache["index"]
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import functools
+import threading
+from collections import deque
+
+import logqueue
+
+"""
+instrument defines the tracing of plugin entry points.
+
+Each call of decorated entry point is recorded with its wall and
+cpu times, number of opened files and number of bytes read and
+written, together with the subject, session and sequence being
+treated. These are also set as keys of log records emitted during
+the call (see logqueue).
+
+Records are exported as json-lines trace, and aggregated per entry
+point into Prometheus textfile, that can be collected by
+node_exporter textfile collector.
+
+Opened files and read/written bytes are counted for the thread
+running the entry point only (from /proc/thread-self/io, if
+available, otherwise for whole process), so the work of background
+threads (files placed by iopool, log records written by logqueue)
+is not attributed to the entry points that scheduled it. Cpu time
+is the one of whole process, including the threads used by entry
+point (for ex. parallel compression).
+Opened files are counted by an audit hook, installed at first
+traced call, audit hooks can't be removed, so after tracing is
+disabled the hook remains, but does nothing.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# switch to enable tracing
+enabled = False
+
+# entry point ending the run, aggregated values are written
+# after its own record
+exit_entry_point = "ExitEP"
+
+# suffixes of trace and Prometheus files, prefixed by stage name
+trace_suffix = "_trace.jsonl"
+prom_suffix = "_trace.prom"
+
+# maximal number of records kept before output is set
+pending_size = 10000
+
+# records emitted before output is set, oldest records are
+# dropped if output is never set
+_pending = deque(maxlen=pending_size)
+# if True, records are not kept, only aggregated
+_discard = False
+# opened trace file
+_trace = None
+# path to Prometheus file
+_prom = None
+
+# aggregated values
+#   key: (plugin, entry point)
+#   value: list of calls, wall, cpu, opened, read, written, errors
+_totals = dict()
+
+# number of files opened, counted by audit hook
+#   key: thread id
+#   value: count
+_opened = dict()
+_hooked = False
+
+# source of per-thread I/O counters
+_io_file = "/proc/thread-self/io"
+if not os.path.exists(_io_file):
+    _io_file = "/proc/self/io"
+
+
+def _audit(event: str, args: tuple) -> None:
+    if event == "open" and enabled:
+        ident = threading.get_ident()
+        _opened[ident] = _opened.get(ident, 0) + 1
+
+
+def _installHook() -> None:
+    global _hooked
+    if not _hooked and hasattr(sys, "addaudithook"):
+        sys.addaudithook(_audit)
+    _hooked = True
+
+
+def _io() -> tuple:
+    """
+    Returns number of bytes read and written by current thread,
+    (0, 0) if not available
+    """
+    try:
+        with open(_io_file, "r") as f:
+            values = dict(line.split(": ") for line in f)
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _identify(args: tuple) -> dict:
+    """
+    Retrieves subject, session and sequence from entry point
+    arguments, which can be BidsSession or recording
+    """
+    ids = dict()
+    for arg in args:
+        try:
+            if hasattr(arg, "recId"):
+                ids["subject"] = arg.subId()
+                ids["session"] = arg.sesId()
+                ids["sequence"] = arg.recId()
+            elif hasattr(arg, "subject") and hasattr(arg, "session"):
+                ids["subject"] = arg.subject
+                ids["session"] = arg.session
+        except Exception:
+            continue
+    return ids
+
+
+def traced(func):
+    """
+    Decorator recording execution of plugin entry point,
+    after exit entry point the trace is finished
+    """
+    plugin = func.__module__
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # subject and session may be changed by entry point
+        ids = _identify(args)
+        token = logqueue.setKeys(ids)
+        try:
+            if not enabled:
+                return func(*args, **kwargs)
+            return _call(func, plugin, name, ids, args, kwargs)
+        finally:
+            logqueue.resetKeys(token)
+            if enabled and name == exit_entry_point:
+                finish()
+    return wrapper
+
+
+def _call(func, plugin: str, name: str, ids: dict,
+          args: tuple, kwargs: dict):
+    """
+    Executes entry point and records its execution
+    """
+    _installHook()
+    ident = threading.get_ident()
+    read0, written0 = _io()
+    opened0 = _opened.get(ident, 0)
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    status = "ok"
+    try:
+        return func(*args, **kwargs)
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+        # read before opening of /proc io file
+        opened = _opened.get(ident, 0) - opened0
+        read1, written1 = _io()
+        record = {"time": time.time(),
+                  "plugin": plugin,
+                  "entry_point": name,
+                  "wall": wall,
+                  "cpu": cpu,
+                  "opened": opened,
+                  "read": read1 - read0,
+                  "written": written1 - written0,
+                  "status": status
+                  }
+        record.update(ids)
+        _emit(record)
+
+
+def _emit(record: dict) -> None:
+    key = (record["plugin"], record["entry_point"])
+    totals = _totals.setdefault(key, [0, 0., 0., 0, 0, 0, 0])
+    totals[0] += 1
+    totals[1] += record["wall"]
+    totals[2] += record["cpu"]
+    totals[3] += record["opened"]
+    totals[4] += record["read"]
+    totals[5] += record["written"]
+    totals[6] += record["status"] != "ok"
+    if _trace is None:
+        if not _discard:
+            _pending.append(record)
+    else:
+        _trace.write(json.dumps(record) + "\n")
+
+
+def setOutput(folder: str, stage: str) -> None:
+    """
+    Sets folder where trace is written, pending records are
+    written immediately
+
+    Parameters:
+    -----------
+    folder: str
+        output folder, usually code/bidsme of destination dataset
+    stage: str
+        name of stage, used as prefix of files
+    """
+    global _trace
+    global _prom
+    global _discard
+    close()
+    _discard = False
+    os.makedirs(folder, exist_ok=True)
+    _trace = open(os.path.join(folder, stage + trace_suffix), "w")
+    _prom = os.path.join(folder, stage + prom_suffix)
+    for record in _pending:
+        _trace.write(json.dumps(record) + "\n")
+    _pending.clear()
+
+
+def discardOutput() -> None:
+    """
+    Drops pending records and stops keeping new ones, when
+    trace is not written (for ex. in dry run); records are
+    still aggregated
+    """
+    global _discard
+    _discard = True
+    _pending.clear()
+
+
+_metrics = (("calls_total", "Number of calls of entry point"),
+            ("wall_seconds_total", "Wall time spent in entry point"),
+            ("cpu_seconds_total", "Cpu time spent in entry point"),
+            ("files_opened_total", "Number of files opened"),
+            ("read_bytes_total", "Number of bytes read"),
+            ("written_bytes_total", "Number of bytes written"),
+            ("errors_total", "Number of calls raising exception"))
+
+
+def finish() -> None:
+    """
+    Flushes trace and writes aggregated values into
+    Prometheus textfile
+    """
+    if _trace is None:
+        return
+    _trace.flush()
+    lines = list()
+    for ind, (metric, description) in enumerate(_metrics):
+        metric = "bidsme_plugin_" + metric
+        lines.append("# HELP {} {}".format(metric, description))
+        lines.append("# TYPE {} counter".format(metric))
+        for (plugin, name), totals in sorted(_totals.items()):
+            lines.append('{}{{plugin="{}",entry_point="{}"}} {}'
+                         .format(metric, plugin, name, totals[ind]))
+    tmp_file = _prom + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, _prom)
+
+
+def close() -> None:
+    """
+    Closes trace file
+    """
+    global _trace
+    if _trace is not None:
+        _trace.close()
+        _trace = None
+
+
+atexit.register(close)
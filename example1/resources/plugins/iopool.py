@@ -0,0 +1,158 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+iopool defines the background executor of plugins file operations.
+
+File placements (copy, link) are submitted to a small pool of
+threads, so the latency of filesystem overlaps with parsing of
+the next files. Operations are grouped by owner (usually a
+(subject, session) tuple): the owner waits for completion of its
+operations with barrier, which re-raises the first error occured
+in one of them.
+
+The number of queued operations is bounded: submit blocks while
+too many operations are pending, which prevents the queue to grow
+if filesystem is slower than plugins.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# number of threads, 0 to execute operations immediately
+workers = 0
+
+# maximum number of operations submitted and not completed
+max_pending = 64
+
+
+class IOPool(object):
+    """
+    Bounded pool of threads executing file operations
+
+    Attributes:
+    -----------
+    workers: int
+        number of threads, if 0 operations are executed
+        synchronously in submit
+    pending: dict
+        owner: list of futures not yet awaited
+    """
+    def __init__(self, workers: int = workers,
+                 max_pending: int = max_pending):
+        self.workers = workers
+        self.pending = dict()
+        self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix="iopool")
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+
+    def submit(self, owner, func, *args, **kwargs) -> None:
+        """
+        Submits operation func(*args, **kwargs) on behalf of owner.
+        Blocks while maximum number of pending operations is reached
+        """
+        if self._executor is None:
+            func(*args, **kwargs)
+            return
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self.pending.setdefault(owner, list()).append(future)
+
+    def barrier(self, owner) -> int:
+        """
+        Waits for completion of all operations of owner, and
+        re-raises first raised exception
+
+        Returns:
+        --------
+        int:
+            number of completed operations
+        """
+        with self._lock:
+            futures = self.pending.pop(owner, [])
+        error = None
+        for future in futures:
+            exc = future.exception()
+            if exc is not None:
+                if error is None:
+                    error = exc
+                else:
+                    logger.error("{}: {}".format(owner, exc))
+        if error is not None:
+            raise error
+        return len(futures)
+
+    def shutdown(self) -> None:
+        """
+        Waits for all operations and stops threads, errors of
+        operations never awaited are reported
+        """
+        for owner in list(self.pending):
+            try:
+                self.barrier(owner)
+            except Exception as e:
+                logger.error("{}: {}".format(owner, e))
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# pool used by plugins
+_pool = None
+
+
+def getPool() -> IOPool:
+    """
+    Returns pool used by plugins, creating it if needed
+    """
+    global _pool
+    if _pool is None:
+        _pool = IOPool(workers, max_pending)
+    return _pool
+
+
+def setWorkers(value: int) -> None:
+    """
+    Sets number of threads, restarting the pool
+    """
+    global workers
+    workers = value
+    shutdown()
+
+
+def submit(owner, func, *args, **kwargs) -> None:
+    """
+    Submits operation to plugins pool, see IOPool.submit
+    """
+    getPool().submit(owner, func, *args, **kwargs)
+
+
+def barrier(owner) -> int:
+    """
+    Waits for operations of owner, see IOPool.barrier
+    """
+    if _pool is None:
+        return 0
+    return _pool.barrier(owner)
+
+
+def shutdown() -> None:
+    """
+    Waits for all operations and stops plugins pool
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
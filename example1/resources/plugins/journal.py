@@ -0,0 +1,212 @@
+import os
+import json
+import logging
+
+"""
+journal defines the write-ahead journal of plugins file operations.
+
+Each operation (for ex. conversion of a sequence) is identified by
+a key, and goes through following states, each one being recorded
+in journal before being acted:
+
+    begin:  outputs are going to be written, under temporary names
+    commit: outputs are complete and renamed to their final names,
+            inputs are going to be removed
+    done:   inputs are removed
+
+If run is interrupted, on resume the operations in begin state are
+rolled back (temporary and partial outputs are removed) and redone,
+the operations in commit state are finished by removing remaining
+inputs, and the done operations are skipped. A run which is not
+resumed forgets the done operations, but still recovers the
+interrupted ones.
+
+Only the conversions of process_plugin are journaled. The renaming
+(rename_plugin) and bidsification (bidsify_plugin) copy or link files
+without removing their inputs, an interrupted run leaves at most
+complete files placed atomically (see placement), and is resumed by
+running the step again; the files already placed are overwritten.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# suffix of journal files, prefixed by stage name
+journal_suffix = "_journal.jsonl"
+
+# prefix of temporary files
+part_prefix = ".part-"
+
+
+def tmpName(path: str) -> str:
+    """
+    Returns temporary name of file, file is hidden and placed
+    in the same folder, so it can be atomically renamed.
+    Extension is kept, so format can still be guessed from name
+    """
+    folder, name = os.path.split(path)
+    return os.path.join(folder, part_prefix + name)
+
+
+def writeAtomic(path: str, func, *args):
+    """
+    Calls func(tmp, *args) that writes into temporary file,
+    then renames it to path
+
+    Returns:
+    --------
+        value returned by func
+    """
+    tmp = tmpName(path)
+    try:
+        res = func(tmp, *args)
+        os.replace(tmp, path)
+        return res
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+class Journal(object):
+    """
+    Write-ahead journal
+
+    Attributes:
+    -----------
+    path: str
+        path to journal file
+    entries: dict
+        key: last entry of operation
+    """
+    def __init__(self, path: str, resume: bool = True):
+        """
+        Opens journal, if resume is False the done operations
+        are forgotten, but interrupted ones are still recovered
+        """
+        self.path = path
+        self.entries = dict()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # record interrupted while written
+                        logger.warning("{}: Invalid entry ignored"
+                                       .format(path))
+                        continue
+                    self.entries[entry["key"]] = entry
+        if not resume:
+            self.entries = {key: entry
+                            for key, entry in self.entries.items()
+                            if entry["state"] != "done"}
+        # journal is compacted, and entry interrupted while
+        # written is removed, so next entries are not appended to it
+        writeAtomic(path, self._dump)
+        self._file = open(path, "a")
+
+    def _dump(self, path: str) -> None:
+        """
+        Writes current entries into new journal file
+        """
+        with open(path, "w") as f:
+            for key, entry in sorted(self.entries.items()):
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write(self, entry: dict) -> None:
+        self.entries[entry["key"]] = entry
+        self._file.write(json.dumps(entry, sort_keys=True) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def status(self, key: str) -> str:
+        """
+        Returns state of operation, None if not in journal
+        """
+        entry = self.entries.get(key)
+        return None if entry is None else entry["state"]
+
+    def begin(self, key: str, outputs: list, inputs: list) -> None:
+        """
+        Records begin of operation, with its outputs (final names)
+        and inputs to remove after commit
+        """
+        self._write({"key": key, "state": "begin",
+                     "outputs": list(outputs), "inputs": list(inputs)})
+
+    def commit(self, key: str, **info) -> None:
+        """
+        Records that all outputs are written, with optional
+        information on outputs, kept in entry for resumed runs
+        """
+        entry = dict(self.entries[key])
+        entry.update(info)
+        entry["state"] = "commit"
+        self._write(entry)
+
+    def done(self, key: str) -> None:
+        """
+        Records that inputs are removed
+        """
+        entry = dict(self.entries[key])
+        entry["state"] = "done"
+        self._write(entry)
+
+    def removeInputs(self, key: str) -> None:
+        """
+        Removes inputs of committed operation, and records
+        it as done
+        """
+        entry = self.entries[key]
+        if entry["state"] != "commit":
+            raise RuntimeError("{}: Operation not committed".format(key))
+        for path in entry["inputs"]:
+            if os.path.lexists(path):
+                os.remove(path)
+        self.done(key)
+
+    def rollback(self, key: str) -> None:
+        """
+        Removes outputs of uncommitted operation, and forgets it
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        if entry["state"] != "begin":
+            raise RuntimeError("{}: Operation already committed"
+                               .format(key))
+        for path in entry["outputs"]:
+            for p in (tmpName(path), path):
+                if os.path.lexists(p):
+                    logger.info("{}: Removing uncommitted {}"
+                                .format(key, p))
+                    os.remove(p)
+
+    def recover(self, key: str) -> str:
+        """
+        Brings operation to consistent state after interruption
+
+        Returns:
+        --------
+        str:
+            'done' if operation is complete, None if it must
+            be (re)done
+        """
+        state = self.status(key)
+        if state == "begin":
+            self.rollback(key)
+            return None
+        if state == "commit":
+            logger.info("{}: Finishing committed operation".format(key))
+            self.removeInputs(key)
+            return "done"
+        return state
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,267 @@
+import os
+import json
+import queue
+import atexit
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+"""
+logqueue defines the asynchronous logging of plugins.
+
+Handlers of root logger (console and code/bidsme log files set by
+bidsme) are moved behind a queue, and are run by a listener thread,
+so plugins never wait for formatting or writing of log records.
+Messages built with BraceMessage are formatted only when (and if)
+they are written, by the listener thread.
+
+Each record is keyed by the subject, session and sequence being
+treated, as set by instrument.traced for entry points, and can be
+written as json-lines into code/bidsme/<plugin>_log.jsonl. Number
+of records of each level are counted per session, and reported
+by sessionSummary.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# suffix of json-lines log files, prefixed by stage name
+log_suffix = "_log.jsonl"
+
+# keys of record identifying treated data
+key_names = ("subject", "session", "sequence")
+
+# keys of current entry point
+_keys = contextvars.ContextVar("logqueue_keys", default={})
+
+# counts of records per session
+#   key: (subject, session)
+#   value: dictionary level name: count
+_counts = dict()
+
+# running listener, its handlers and replaced handlers
+_listener = None
+_handler = None
+_json = None
+_replaced = list()
+
+
+class LazyMessage(object):
+    """
+    Log message computed by func(*args) only when formatted
+    """
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return self.func(*self.args)
+
+
+class BraceMessage(LazyMessage):
+    """
+    Log message with str.format style, formatted only
+    when written, ex:
+
+        logger.warning(BraceMessage("{}: Id mismatch folder {}",
+                                    rec_id, folder))
+    """
+    __slots__ = ()
+
+    def __init__(self, fmt: str, *args):
+        super().__init__(fmt.format, *args)
+
+
+def setKeys(keys: dict):
+    """
+    Sets subject, session and sequence of following records
+
+    Returns:
+    --------
+    token to pass to resetKeys
+    """
+    return _keys.set(keys)
+
+
+def resetKeys(token) -> None:
+    """
+    Restores keys set before setKeys
+    """
+    _keys.reset(token)
+
+
+def renameKeys(subject: str, session: str) -> None:
+    """
+    Changes subject and session of following records, when they
+    are renamed by entry point, and moves the records already
+    counted under previous names to the new ones, so they are
+    reported by sessionSummary with new names
+    """
+    keys = _keys.get()
+    old = (keys.get("subject"), keys.get("session"))
+    new = (subject, session)
+    _keys.set(dict(keys, subject=subject, session=session))
+    if old[0] is None or old == new or old not in _counts:
+        return
+    counts = _counts.setdefault(new, dict())
+    for level, n in _counts.pop(old).items():
+        counts[level] = counts.get(level, 0) + n
+
+
+class _KeyFilter(logging.Filter):
+    """
+    Stores keys of current entry point in record, and counts
+    records per session; runs in thread emitting the record
+    """
+    def filter(self, record):
+        keys = _keys.get()
+        for name in key_names:
+            if not hasattr(record, name):
+                setattr(record, name, keys.get(name))
+        if record.subject is not None\
+                and not hasattr(record, "summary"):
+            ses = (record.subject, record.session)
+            counts = _counts.setdefault(ses, dict())
+            counts[record.levelname] = counts.get(record.levelname, 0) + 1
+        return True
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting of record to
+    listener thread
+    """
+    def prepare(self, record):
+        return record
+
+
+class JsonHandler(logging.Handler):
+    """
+    Handler writing records as json lines
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self.stream = open(path, "w")
+
+    def emit(self, record):
+        try:
+            entry = {"time": record.created,
+                     "level": record.levelname,
+                     "logger": record.name,
+                     "message": record.getMessage()}
+            for name in key_names:
+                entry[name] = getattr(record, name, None)
+            summary = getattr(record, "summary", None)
+            if summary is not None:
+                entry["summary"] = summary
+            if record.exc_info:
+                entry["exception"] = logging.Formatter()\
+                        .formatException(record.exc_info)
+            self.stream.write(json.dumps(entry) + "\n")
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
+
+
+def start(folder: str = "", stage: str = "") -> None:
+    """
+    Moves handlers of root logger behind queue, and starts
+    listener thread
+
+    Parameters:
+    -----------
+    folder: str
+        folder where json-lines log is written, usually
+        code/bidsme of destination dataset, if empty
+        json-lines log is not written
+    stage: str
+        name of stage, used as prefix of json-lines log
+    """
+    global _listener
+    global _handler
+    global _json
+    stop()
+    root = logging.getLogger()
+    _replaced[:] = root.handlers
+    handlers = list(_replaced)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+        _json = JsonHandler(os.path.join(folder, stage + log_suffix))
+        handlers.append(_json)
+    records = queue.SimpleQueue()
+    _handler = _LazyQueueHandler(records)
+    _handler.addFilter(_KeyFilter())
+    for h in _replaced:
+        root.removeHandler(h)
+    root.addHandler(_handler)
+    _listener = QueueListener(records, *handlers,
+                              respect_handler_level=True)
+    _listener.start()
+
+
+def stop() -> None:
+    """
+    Writes pending records, stops listener thread and
+    restores handlers of root logger
+    """
+    global _listener
+    global _handler
+    global _json
+    if _listener is None:
+        return
+    # reporting records of sessions not ended
+    for subject, session in list(_counts):
+        sessionSummary(subject, session)
+    root = logging.getLogger()
+    root.removeHandler(_handler)
+    _listener.stop()
+    for h in _replaced:
+        root.addHandler(h)
+    _replaced.clear()
+    if _json is not None:
+        _json.close()
+    _listener = None
+    _handler = None
+    _json = None
+
+
+def sessionSummary(subject: str, session: str) -> dict:
+    """
+    Reports number of records of each level emitted while
+    treating session, and resets them. Records of subject
+    entry point are reported with empty session
+
+    Returns:
+    --------
+    dict:
+        level name: number of records
+    """
+    counts = _counts.pop((subject, session), dict())
+    problems = sum(n for level, n in counts.items()
+                   if level in ("WARNING", "ERROR", "CRITICAL"))
+    if counts:
+        level = logging.INFO if problems else logging.DEBUG
+        name = subject if not session else "{}/{}".format(subject, session)
+        logger.log(level,
+                   "{}: {}".format(name,
+                                   ", ".join("{} {}".format(n, lvl)
+                                             for lvl, n
+                                             in sorted(counts.items()))),
+                   extra={"subject": subject, "session": session,
+                          "summary": counts})
+    return counts
+
+
+atexit.register(stop)
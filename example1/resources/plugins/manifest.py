@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import logging
+
+"""
+manifest defines the persistent record of prepared sessions,
+allowing to skip the sessions unchanged since last preparation.
+
+Each source session is identified by a fingerprint, computed
+from names, sizes and modification times of all its files
+(hidden files excepted),
+and any additional data used in preparation (for ex. the
+corresponding row of subjects table).
+
+Manifest is stored as json-lines file, where new entries are
+appended and the last entry for a given session is the valid one
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# name of manifest file, placed in code/bidsme folder
+manifest_name = "prepare_manifest.jsonl"
+
+
+def fingerprint(path: str, *extra, tree=None) -> str:
+    """
+    Computes fingerprint of folder content
+
+    Parameters:
+    -----------
+    path: str
+        path to folder
+    extra:
+        additional values to include in fingerprint,
+        must have stable repr
+    tree: crawler.Tree
+        crawled dataset containing folder, if None
+        folder is listed from filesystem
+
+    Returns:
+    --------
+    str:
+        sha1 hexdigest
+    """
+    if tree is not None:
+        entries = tree.files(path)
+        stack = []
+    else:
+        entries = list()
+        stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(path, rel)) as it:
+            for entry in it:
+                # hidden files are ignored, as in crawler
+                if entry.name.startswith("."):
+                    continue
+                name = os.path.join(rel, entry.name)
+                if entry.is_dir():
+                    stack.append(name)
+                else:
+                    st = entry.stat()
+                    entries.append((name, st.st_size, st.st_mtime_ns))
+    entries.sort()
+    h = hashlib.sha1()
+    for e in entries:
+        h.update("{}\0{}\0{}\n".format(*e).encode())
+    for e in extra:
+        h.update(repr(e).encode())
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """
+    Record of prepared sessions
+
+    Attributes:
+    -----------
+    path: str
+        path to manifest file
+    entries: dict
+        key: session key (subject/session)
+        value: entry dictionary, with at least fingerprint key
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = dict()
+        if not os.path.isfile(path):
+            return
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # incomplete last line from interrupted run
+                    logger.warning("{}: Invalid entry ignored"
+                                   .format(path))
+                    continue
+                self.entries[entry["key"]] = entry
+
+    def unchanged(self, key: str, fp: str) -> bool:
+        """
+        Checks if session was prepared with the same fingerprint
+        """
+        entry = self.entries.get(key)
+        return entry is not None and entry["fingerprint"] == fp
+
+    def update(self, key: str, fp: str, **info) -> None:
+        """
+        Records the session as prepared, entry is immediately
+        appended to manifest file
+        """
+        entry = {"key": key, "fingerprint": fp}
+        entry.update(info)
+        self.entries[key] = entry
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def compact(self) -> None:
+        """
+        Rewrites manifest keeping only the valid entries
+        """
+        if not self.entries:
+            return
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "w") as f:
+            for key in sorted(self.entries):
+                f.write(json.dumps(self.entries[key], sort_keys=True) + "\n")
+        os.replace(tmp_file, self.path)
@@ -0,0 +1,363 @@
+import os
+import math
+import mmap
+import json
+import zlib
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from sidecar import readFields
+
+"""
+nifti defines the merging of 3D NIfTI-1 images into single 4D image.
+
+The 4D header is written once, and the data block of each 3D volume
+is streamed into output from memory-mapped input, so only one volume
+is in memory at any time. All images must share geometry, voxel size,
+datatype and scaling; the header extensions of the first image are
+kept, and repetition time is set from sidecar.
+
+Images can be gzip-compressed using all cores: file is cut into
+blocks compressed in parallel as raw deflate streams, each block
+being primed with the end of previous one, and blocks are joined
+into single standard gzip member
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# size of NIfTI-1 header
+header_size = 348
+# offset of data in merged file without extensions: header
+# and 4 bytes of empty extension flag
+merged_offset = header_size + 4
+
+# time units (seconds) of xyzt_units field
+_unit_sec = 8
+# relative tolerance on voxel sizes
+_pixdim_tol = 1e-5
+
+# fields of 3D json sidecars reported per volume in merged sidecar
+volume_fields = ("AcquisitionTime",)
+
+# gzip compression level
+gzip_level = 6
+# number of compression threads, 0 for number of cores
+gzip_workers = 0
+# size of independently compressed blocks
+block_size = 1 << 20
+# size of deflate window, used as dictionary of next block
+_window = 1 << 15
+
+
+def splitext(path: str) -> tuple:
+    """
+    Splits extension of path, '.nii.gz' being a single extension
+    """
+    base, ext = os.path.splitext(path)
+    if ext == ".gz":
+        base, ext2 = os.path.splitext(base)
+        ext = ext2 + ext
+    return base, ext
+
+
+def readHeader(path: str) -> dict:
+    """
+    Reads the NIfTI-1 header of single-file image
+
+    Parameters:
+    -----------
+    path: str
+        path to image
+
+    Returns:
+    --------
+    dict:
+        parsed header, or None if file is not a valid
+        NIfTI-1 image (for ex. empty or placeholder file)
+    """
+    with open(path, "rb") as f:
+        raw = f.read(header_size)
+    if len(raw) < header_size:
+        return None
+    for endian in ("<", ">"):
+        if struct.unpack_from(endian + "i", raw, 0)[0] == header_size:
+            break
+    else:
+        return None
+    if raw[344:348] != b"n+1\0":
+        return None
+    dim = struct.unpack_from(endian + "8h", raw, 40)
+    datatype, bitpix = struct.unpack_from(endian + "2h", raw, 70)
+    pixdim = struct.unpack_from(endian + "8f", raw, 76)
+    vox_offset = int(struct.unpack_from(endian + "f", raw, 108)[0])
+    scl_slope, scl_inter = struct.unpack_from(endian + "2f", raw, 112)
+    if not 0 < dim[0] <= 7 or bitpix <= 0:
+        return None
+    # null or invalid slope means no scaling
+    if scl_slope == 0 or not math.isfinite(scl_slope):
+        scl_slope, scl_inter = 1., 0.
+    return {"raw": raw,
+            "endian": endian,
+            "dim": dim,
+            "datatype": datatype,
+            "bitpix": bitpix,
+            "pixdim": pixdim,
+            "vox_offset": vox_offset,
+            "scaling": (scl_slope, scl_inter)
+            }
+
+
+def volumeSize(header: dict) -> int:
+    """
+    Returns size in bytes of data block
+    """
+    dim = header["dim"]
+    size = header["bitpix"] // 8
+    for d in dim[1:dim[0] + 1]:
+        size *= max(d, 1)
+    return size
+
+
+def volumeCount(header: dict) -> int:
+    """
+    Returns number of volumes of image
+    """
+    dim = header["dim"]
+    if dim[0] < 4:
+        return 1
+    return max(dim[4], 1)
+
+
+def isNifti(path: str) -> bool:
+    """
+    Checks if file is a valid NIfTI-1 single-file image
+    """
+    return readHeader(path) is not None
+
+
+def _mismatch(hdr: dict, first: dict) -> str:
+    """
+    Returns name of first header field differing between
+    images, empty string if images can be merged
+    """
+    if hdr["endian"] != first["endian"]:
+        return "endianness"
+    if hdr["dim"][1:4] != first["dim"][1:4]:
+        return "dim"
+    if hdr["datatype"] != first["datatype"]:
+        return "datatype"
+    for a, b in zip(hdr["pixdim"][1:4], first["pixdim"][1:4]):
+        if not math.isclose(a, b, rel_tol=_pixdim_tol):
+            return "pixdim"
+    if hdr["scaling"] != first["scaling"]:
+        return "scl_slope/scl_inter"
+    return ""
+
+
+def repetitionTime(sidecar: str) -> float:
+    """
+    Returns repetition time, in seconds, from json sidecar where it
+    is stored in milliseconds, None if not available
+    """
+    tr = readFields(sidecar, ("RepetitionTime",))["RepetitionTime"]
+    if isinstance(tr, list):
+        tr = tr[0] if len(tr) == 1 else None
+    try:
+        return float(tr) / 1000.
+    except (TypeError, ValueError):
+        return None
+
+
+def merge4D(files: list, output: str,
+            repetition_time: float = None) -> int:
+    """
+    Merges 3D (or 4D) images into one 4D image
+
+    Parameters:
+    -----------
+    files: list
+        paths to 3D or 4D images, in order of acquisition
+    output: str
+        path to merged image, if it ends with .gz the
+        image is compressed with compressFile
+    repetition_time: float
+        repetition time in seconds, stored as pixdim[4];
+        if None, pixdim[4] of first image is kept
+
+    Returns:
+    --------
+    int:
+        number of volumes in merged image
+
+    Raises:
+    -------
+    ValueError:
+        if any image is not valid, or images have different
+        geometry, voxel size, datatype or scaling
+    """
+    if not files:
+        raise ValueError("No images to merge")
+    headers = list()
+    for f in files:
+        hdr = readHeader(f)
+        if hdr is None:
+            raise ValueError("{}: Not a valid NIfTI-1 image".format(f))
+        if hdr["dim"][0] > 4 and any(d > 1 for d in hdr["dim"][5:]):
+            raise ValueError("{}: Not a 3D or 4D image".format(f))
+        headers.append(hdr)
+    first = headers[0]
+    for f, hdr in zip(files, headers):
+        field = _mismatch(hdr, first)
+        if field:
+            raise ValueError("{}: {} mismatch with {}"
+                             .format(f, field, files[0]))
+
+    endian = first["endian"]
+    volumes = sum(volumeCount(hdr) for hdr in headers)
+    raw = bytearray(first["raw"])
+    dim = [4] + list(first["dim"][1:4]) + [volumes, 1, 1, 1]
+    struct.pack_into(endian + "8h", raw, 40, *dim)
+    if repetition_time is not None:
+        struct.pack_into(endian + "f", raw, 76 + 4 * 4,
+                         float(repetition_time))
+        raw[123] = (raw[123] & 0x07) | _unit_sec
+
+    # extensions of first image (flag and extension blocks)
+    # are kept, the ones of following images are per-volume
+    with open(files[0], "rb") as inp:
+        inp.seek(header_size)
+        extensions = inp.read(max(first["vox_offset"], merged_offset)
+                              - header_size)
+    if len(extensions) < 4 or extensions[0] == 0:
+        extensions = b"\0" * (merged_offset - header_size)
+    struct.pack_into(endian + "f", raw, 108,
+                     float(header_size + len(extensions)))
+
+    merged = output
+    if output.endswith(".gz"):
+        merged = output[:-3] + ".tmp"
+
+    with open(merged, "wb") as out:
+        out.write(raw)
+        out.write(extensions)
+        for f, hdr in zip(files, headers):
+            offset = hdr["vox_offset"]
+            size = volumeSize(hdr)
+            with open(f, "rb") as inp:
+                if os.fstat(inp.fileno()).st_size < offset + size:
+                    raise ValueError("{}: Truncated image".format(f))
+                with mmap.mmap(inp.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as view:
+                        out.write(view[offset:offset + size])
+    if merged != output:
+        try:
+            compressFile(merged, output)
+        finally:
+            os.remove(merged)
+    return volumes
+
+
+def _deflate(view, start: int, end: int, level: int) -> bytes:
+    """
+    Compresses data[start:end] as raw deflate stream, primed with
+    preceding window; stream is finished only for last block
+    """
+    if start > 0:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                zdict=view[max(0, start - _window):start])
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = comp.compress(view[start:end])
+    if end == len(view):
+        return data + comp.flush(zlib.Z_FINISH)
+    return data + comp.flush(zlib.Z_SYNC_FLUSH)
+
+
+def compressFile(source: str, output: str, level: int = None,
+                 workers: int = None) -> int:
+    """
+    Compresses file into single-member gzip file, blocks of
+    file being compressed in parallel
+
+    Parameters:
+    -----------
+    source: str
+        path to uncompressed file
+    output: str
+        path to compressed file
+    level: int
+        compression level, default gzip_level
+    workers: int
+        number of threads, default gzip_workers
+
+    Returns:
+    --------
+    int:
+        size of compressed file
+    """
+    if level is None:
+        level = gzip_level
+    if workers is None:
+        workers = gzip_workers
+    workers = workers or os.cpu_count() or 1
+    # extra flags: 2 for maximum compression, 4 for fastest
+    xfl = 2 if level == 9 else 4 if level == 1 else 0
+    mtime = int(os.stat(source).st_mtime) & 0xffffffff
+
+    tmp_file = output + ".tmp"
+    with open(source, "rb") as inp, open(tmp_file, "wb") as out:
+        out.write(struct.pack("<4BIBB", 0x1f, 0x8b, 8, 0,
+                              mtime, xfl, 3))
+        size = os.fstat(inp.fileno()).st_size
+        if size == 0:
+            out.write(_deflate(b"", 0, 0, level))
+            crc = 0
+        else:
+            with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as mm,\
+                    memoryview(mm) as view,\
+                    ThreadPoolExecutor(max_workers=workers) as pool:
+                starts = range(0, size, block_size)
+                # limiting number of blocks held in memory
+                window = workers * 4
+                crc = 0
+                for i in range(0, len(starts), window):
+                    blocks = [pool.submit(_deflate, view, start,
+                                          min(start + block_size, size),
+                                          level)
+                              for start in starts[i:i + window]]
+                    for start in starts[i:i + window]:
+                        crc = zlib.crc32(view[start:start + block_size],
+                                         crc)
+                    for block in blocks:
+                        out.write(block.result())
+        out.write(struct.pack("<II", crc & 0xffffffff, size & 0xffffffff))
+    os.replace(tmp_file, output)
+    return os.path.getsize(output)
+
+
+def mergeSidecars(files: list, output: str,
+                  fields: tuple = volume_fields) -> None:
+    """
+    Creates sidecar json of merged image from the json of the first
+    volume, with addition of per-volume values of requested fields
+
+    Parameters:
+    -----------
+    files: list
+        paths to json sidecars of 3D images, in order of acquisition
+    output: str
+        path to merged json
+    fields: tuple
+        fields to report for each volume
+    """
+    with open(files[0], "r") as f:
+        merged = json.load(f)
+    volumes = [readFields(f, fields) for f in files]
+    for field in fields:
+        merged[field + "s"] = [v[field] for v in volumes]
+    with open(output, "w") as f:
+        json.dump(merged, f, indent="\t")
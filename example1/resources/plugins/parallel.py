@@ -0,0 +1,123 @@
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+parallel defines the process pool driver, used by plugin tools
+to distribute independent jobs (checks of preflight, conversion
+of events, harvest of catalogue) between worker processes.
+
+Entry points of plugins are called by bidsme, serially, and are
+not distributed by this driver.
+
+Log records emitted in workers are captured and re-emitted
+in main process in the order of submitted items, so log files
+are identical to the serial run
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+
+class _CaptureHandler(logging.Handler):
+    """
+    Stores log records in list, preparing them
+    to be pickled
+    """
+    def __init__(self):
+        super().__init__(logging.NOTSET)
+        self.records = list()
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+# capture handler of worker process
+_capture = None
+
+
+def _initWorker(level: int) -> None:
+    """
+    Replaces handlers, inherited from main process, by
+    capture handler
+    """
+    global _capture
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    _capture = _CaptureHandler()
+    root.addHandler(_capture)
+    root.setLevel(level)
+
+
+def _runCaptured(func, item):
+    """
+    Runs func on item in worker process, and returns
+    result, captured records and formatted exception
+    """
+    _capture.records = list()
+    error = None
+    result = None
+    try:
+        result = func(item)
+    except Exception as e:
+        error = (e, traceback.format_exc())
+    return result, _capture.records, error
+
+
+def runParallel(func, items: list, workers: int = 0) -> list:
+    """
+    Applies func to each item, using pool of worker processes
+
+    func must be a module-level function, and items must be
+    picklable (for ex. tuples of paths). If workers is
+    0 or 1, items are treated serially in current process.
+
+    Log records from workers are replayed in main process in
+    order of items. As in serial run, treatment stops at first
+    item raising an exception, which is re-raised in main process.
+
+    Parameters:
+    -----------
+    func: callable
+        function to apply
+    items: list
+        list of items to treat
+    workers: int
+        number of worker processes
+
+    Returns:
+    --------
+    list:
+        results of func, in order of items
+    """
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    results = list()
+    level = logging.getLogger().getEffectiveLevel()
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_initWorker,
+                             initargs=(level,)) as pool:
+        futures = [pool.submit(_runCaptured, func, item) for item in items]
+        try:
+            for future in futures:
+                result, records, error = future.result()
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if error:
+                    logger.debug("Worker traceback:\n{}".format(error[1]))
+                    raise error[0]
+                results.append(result)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
@@ -0,0 +1,310 @@
+import os
+import csv
+import json
+import math
+import logging
+from array import array
+from collections import OrderedDict
+
+"""
+participants defines columnar table of participants.
+
+Participant values set by plugins on session.sub_values are collected
+for all subjects into typed columns: numerical columns are stored
+as arrays of doubles, and text columns as arrays of codes into list
+of distinct values. Values loaded from existing participants.tsv are
+kept as text, so they are written back unchanged (for ex. '007' or
+'1.50'). Template (participants.json, participants_add.json,
+participants_remove.json) is applied once on columns, and table is
+written with a single atomic write at the end of run.
+
+bidsme writes its own participants.tsv; when plugins assemble the
+table (part_template plugin option), they write it in ExitEP, after
+bidsme, so the plugin table is the one kept. Before writing, the
+existing file is loaded again, filling only values missing in
+plugin table, so values written by bidsme meanwhile are not lost;
+values cleared by plugins (set to None) stay missing.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# representation of missing values
+na = "n/a"
+
+
+def _isMissing(value) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    return isinstance(value, str) and value in ("", na)
+
+
+class Column(object):
+    """
+    Typed column of participants table
+
+    Attributes:
+    -----------
+    name: str
+        name of column
+    numeric: bool
+        True if column contains only numbers
+    data: array
+        values (numeric) or codes of values (text), missing values
+        are stored as NaN or code 0
+    levels: list
+        distinct values of text column, first being missing value
+    cleared: set
+        rows which value was set missing, they are not filled
+        by values loaded without update
+    """
+    __slots__ = ["name", "numeric", "data", "levels", "cleared", "_codes"]
+
+    def __init__(self, name: str, size: int = 0):
+        self.name = name
+        self.numeric = True
+        self.data = array("d", [math.nan]) * size
+        self.levels = [None]
+        self.cleared = set()
+        self._codes = {None: 0}
+
+    def __len__(self):
+        return len(self.data)
+
+    def _toText(self) -> None:
+        """
+        Converts numeric column to text column
+        """
+        data = array("l")
+        for v in self.data:
+            data.append(self._code(None if math.isnan(v) else _format(v)))
+        self.numeric = False
+        self.data = data
+
+    def _code(self, value) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.levels)
+            self.levels.append(value)
+            self._codes[value] = code
+        return code
+
+    def resize(self, size: int) -> None:
+        """
+        Extends column with missing values up to size
+        """
+        missing = size - len(self.data)
+        if missing > 0:
+            if self.numeric:
+                self.data.extend(array("d", [math.nan]) * missing)
+            else:
+                self.data.extend(array("l", [0]) * missing)
+
+    def set(self, row: int, value) -> None:
+        """
+        Sets value of given row, None or 'n/a' being missing value
+        """
+        self.resize(row + 1)
+        if _isMissing(value):
+            self.data[row] = math.nan if self.numeric else 0
+            self.cleared.add(row)
+            return
+        self.cleared.discard(row)
+        number = isinstance(value, (int, float))\
+            and not isinstance(value, bool)
+        if self.numeric:
+            if number:
+                self.data[row] = value
+                return
+            self._toText()
+        self.data[row] = self._code(_format(value) if number
+                                    else str(value))
+
+    def isMissing(self, row: int) -> bool:
+        return row >= len(self.data) or self.get(row) is None
+
+    def get(self, row: int):
+        if self.numeric:
+            v = self.data[row]
+            return None if math.isnan(v) else v
+        return self.levels[self.data[row]]
+
+    def format(self, row: int) -> str:
+        value = self.get(row)
+        if value is None:
+            return na
+        if self.numeric:
+            return _format(value)
+        return value
+
+
+def _format(value: float) -> str:
+    """
+    Formats number, integers without decimal part
+    """
+    if math.isfinite(value) and value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class ParticipantsTable(object):
+    """
+    Columnar table of participants
+
+    Attributes:
+    -----------
+    ids: list
+        participant_id of rows
+    index: dict
+        participant_id: row
+    columns: OrderedDict
+        column name: Column
+    """
+    def __init__(self):
+        self.ids = list()
+        self.index = dict()
+        self.columns = OrderedDict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _row(self, participant: str) -> int:
+        row = self.index.get(participant)
+        if row is None:
+            row = len(self.ids)
+            self.ids.append(participant)
+            self.index[participant] = row
+        return row
+
+    def add(self, participant: str, values: dict,
+            update: bool = True) -> None:
+        """
+        Adds or updates participant row, values not present in
+        dictionary are kept
+
+        Parameters:
+        -----------
+        participant: str
+            participant id, with sub- prefix
+        values: dict
+            column: value
+        update: bool
+            if False, only missing values of row are set,
+            values cleared by previous add are kept missing
+        """
+        if not participant.startswith("sub-"):
+            participant = "sub-" + participant
+        row = self._row(participant)
+        for name, value in values.items():
+            if name == "participant_id":
+                continue
+            column = self.columns.get(name)
+            if column is None:
+                column = Column(name, len(self.ids))
+                self.columns[name] = column
+            if update or (column.isMissing(row)
+                          and row not in column.cleared):
+                column.set(row, value)
+
+    def load(self, path: str, update: bool = True) -> None:
+        """
+        Loads existing participants.tsv file, if it exists.
+        Values are kept as text, missing values of file do not
+        change the table
+
+        Parameters:
+        -----------
+        path: str
+            path to participants.tsv file
+        update: bool
+            if False, only values missing in table are
+            loaded from file
+        """
+        if not os.path.isfile(path):
+            return
+        with open(path, "r", newline="") as f:
+            reader = csv.DictReader(f, delimiter="\t")
+            for name in reader.fieldnames or ():
+                if name != "participant_id" and name not in self.columns:
+                    self.columns[name] = Column(name, len(self.ids))
+            for line in reader:
+                participant = line.pop("participant_id")
+                values = {k: _parse(v) for k, v in line.items()}
+                self.add(participant,
+                         {k: v for k, v in values.items() if v is not None},
+                         update)
+
+    def applyTemplate(self, template: dict) -> None:
+        """
+        Reorders columns following template, adding missing columns
+        and removing columns not in template
+        """
+        columns = OrderedDict()
+        for name in template:
+            if name == "participant_id":
+                continue
+            column = self.columns.get(name)
+            if column is None:
+                column = Column(name)
+            columns[name] = column
+        removed = [name for name in self.columns if name not in columns]
+        if removed:
+            logger.info("Removing participants columns: {}"
+                        .format(", ".join(removed)))
+        self.columns = columns
+
+    def write(self, path: str, template: dict = None) -> None:
+        """
+        Atomically writes participants.tsv, and its json
+        sidecar if template given
+
+        Parameters:
+        -----------
+        path: str
+            path to participants.tsv file
+        template: dict
+            content of json sidecar, columns are filtered
+            by template
+        """
+        if template is not None:
+            self.applyTemplate(template)
+        for column in self.columns.values():
+            column.resize(len(self.ids))
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w", newline="") as f:
+            f.write("\t".join(["participant_id"] + list(self.columns))
+                    + "\n")
+            columns = list(self.columns.values())
+            for row in sorted(range(len(self.ids)),
+                              key=self.ids.__getitem__):
+                f.write("\t".join([self.ids[row]]
+                                  + [c.format(row) for c in columns])
+                        + "\n")
+        os.replace(tmp_file, path)
+
+        if template is not None:
+            json_file = os.path.splitext(path)[0] + ".json"
+            tmp_file = json_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(template, f, indent=2)
+            os.replace(tmp_file, json_file)
+
+
+def _parse(value: str):
+    """
+    Parses value read from tsv file, values are kept as text
+    """
+    if _isMissing(value):
+        return None
+    return value
+
+
+def loadTemplate(path: str) -> dict:
+    """
+    Loads participants json template, keeping order of columns
+    """
+    with open(path, "r") as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
@@ -0,0 +1,161 @@
+import os
+import errno
+import shutil
+import logging
+import threading
+
+from journal import tmpName
+
+"""
+placement defines the way files are placed by plugins into
+prepared and bidsified datasets.
+
+Instead of copying, files can be reflinked (copy-on-write clone,
+supported by btrfs, xfs and some network filesystems) or
+hardlinked, which avoids duplication of data on disk.
+In auto mode, the best method is determined at first placement
+for each pair of filesystems, and re-used afterwards.
+
+Hardlinked files share content with original: they must not be
+modified in place, only replaced or removed.
+
+Files are placed under temporary name, and renamed once complete,
+so an interrupted placement never leaves a truncated file.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# methods in order of preference
+methods = ("reflink", "hardlink", "copy")
+
+# placement strategy, either "auto" or one of methods
+strategy = "auto"
+
+# FICLONE ioctl request, from linux/fs.h
+_FICLONE = 0x40049409
+
+# method chosen in auto mode
+#   key: (source device, destination device)
+#   value: method
+_chosen = dict()
+
+# placement statistics, files may be placed from
+# several threads (see iopool)
+stats = {"files": 0,
+         "written": 0,
+         "linked": 0
+         }
+_stats_lock = threading.Lock()
+
+
+def setStrategy(value: str) -> None:
+    """
+    Sets placement strategy, resetting chosen methods
+    """
+    global strategy
+    if value != "auto" and value not in methods:
+        raise ValueError("Invalid placement strategy '{}', must be "
+                         "auto or one of {}".format(value, methods))
+    strategy = value
+    _chosen.clear()
+
+
+def _reflink(source: str, dest: str) -> None:
+    import fcntl
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    shutil.copystat(source, dest)
+
+
+def _hardlink(source: str, dest: str) -> None:
+    os.link(source, dest)
+
+
+def _copy(source: str, dest: str) -> None:
+    shutil.copy2(source, dest)
+
+
+_impl = {"reflink": _reflink,
+         "hardlink": _hardlink,
+         "copy": _copy
+         }
+
+
+def place(source: str, dest: str) -> str:
+    """
+    Places file source at dest, using configured strategy.
+    As with shutil.copy2, if dest is a directory, file is
+    placed inside it with the same name, and existing
+    file is replaced
+
+    Parameters:
+    -----------
+    source: str
+        path to file to place
+    dest: str
+        destination file or directory
+
+    Returns:
+    --------
+    str:
+        path to placed file
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(source))
+    src_stat = os.stat(source)
+    key = (src_stat.st_dev,
+           os.stat(os.path.dirname(os.path.abspath(dest))).st_dev)
+
+    if strategy != "auto":
+        candidates = (strategy,)
+    elif key in _chosen:
+        candidates = methods[methods.index(_chosen[key]):]
+    else:
+        candidates = methods
+
+    tmp = tmpName(dest)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    for method in candidates:
+        try:
+            _impl[method](source, tmp)
+        except OSError as e:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if strategy != "auto" or method == "copy"\
+                    or e.errno == errno.ENOSPC:
+                raise
+            logger.debug("{}: {} not supported: {}"
+                         .format(dest, method, e))
+            continue
+        os.replace(tmp, dest)
+        if os.path.lexists(tmp):
+            # dest was already a link to source, rename of a
+            # link onto the same file does nothing
+            os.remove(tmp)
+        if key not in _chosen and strategy == "auto":
+            logger.info("Using {} to place files from device {} to {}"
+                        .format(method, key[0], key[1]))
+            _chosen[key] = method
+        with _stats_lock:
+            stats["files"] += 1
+            if method == "copy":
+                stats["written"] += src_stat.st_size
+            else:
+                stats["linked"] += src_stat.st_size
+        return dest
+
+
+def summary() -> dict:
+    """
+    Reports number of placed files, and volume of written
+    and linked data
+    """
+    logger.info("Placed {} files: {:.1f} MB written, {:.1f} MB linked"
+                .format(stats["files"],
+                        stats["written"] / 1048576,
+                        stats["linked"] / 1048576))
+    return dict(stats)
@@ -0,0 +1,212 @@
+import os
+import json
+import logging
+
+from definitions import validateFolders, validationKey
+
+"""
+plan defines the sequence plan of prepared session.
+
+Some sequences within session (namely fMRI and MPM structural) follows
+same protocol, thus it is impossible to identify them only using
+metadata. They are identified by the sequences that follows them.
+The plan is computed once from the list of session sequences, and
+stored in prepared session folder, so process and bidsify plugins
+retrieve the role and IntendedFor value of each sequence without
+listing folders and looking ahead in list of sequences.
+
+The plan also stores the result of validation of session series
+(see definitions.checkSeries), keyed by digest of list of series and
+of series definitions, so the validation is done once, and redone
+only if MRI folder or definitions change.
+
+Plan is invalidated if MRI folder of session is modified
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# version of plan format, must be increased each time
+# the structure or resolution of plan changes
+plan_version = 2
+
+# name of plan file, placed in prepared session folder
+plan_name = "plan.json"
+
+# value of IntendedFor for sequences which target can't be resolved
+invalid = "invalid"
+
+# fMRI following inverted phase encoding fMRI, and corresponding
+# IntendedFor
+reversed_targets = (("cmrr_mbep2d_bold_mb2_task_fat", "nBack"),
+                    ("cmrr_mbep2d_bold_mb2_task_nfat", "nBack"),
+                    ("cmrr_mbep2d_bold_mb2_rest", "rest"))
+
+# MPM structurals following sensitivity maps
+mpm_targets = (("al_mtflash3d_PDw", "PDw"),
+               ("al_mtflash3d_T1w", "T1w"),
+               ("al_mtflash3d_MTw", "MTw"))
+
+# field-map IntendedFor, by session
+fieldmap_targets = {"ses-HCL": "HCL/LCL",
+                    "ses-LCL": "HCL/LCL",
+                    "ses-STROOP": "STROOP"}
+
+# sequences needing identification:
+#   key: sequence name
+#   value: role, offset of identifying sequence
+roles = {"cmrr_mbep2d_bold_mb2_invertpe": ("reversed", 1),
+         "gre_field_mapping": ("fieldmap", 0),
+         "al_mtflash3d_sensArray": ("sensitivity", 2),
+         "al_mtflash3d_sensBody": ("sensitivity", 1)}
+
+
+def _target(name: str, targets: tuple) -> str:
+    for seq, target in targets:
+        if name.endswith(seq):
+            return target
+    return invalid
+
+
+def resolve(names: list, session: str) -> list:
+    """
+    Resolves role and IntendedFor of each sequence of session
+
+    Parameters:
+    -----------
+    names: list
+        names of sequences, in order of acquisition
+    session: str
+        bidsified session name
+
+    Returns:
+    --------
+    list of dict:
+        with name, role, intended_for and reference (name of
+        identifying sequence) keys
+    """
+    plan = list()
+    for ind, name in enumerate(names):
+        role, offset = roles.get(name, ("", 0))
+        reference = ""
+        intended_for = ""
+        if role == "fieldmap":
+            reference = session
+            intended_for = fieldmap_targets.get(session, invalid)
+        elif role:
+            if ind + offset < len(names):
+                reference = names[ind + offset]
+            if role == "reversed":
+                intended_for = _target(reference, reversed_targets)
+            else:
+                intended_for = _target(reference, mpm_targets)
+        plan.append({"name": name,
+                     "role": role,
+                     "intended_for": intended_for,
+                     "reference": reference})
+    return plan
+
+
+def buildPlan(path: str, session: str, tree=None) -> dict:
+    """
+    Builds plan of prepared session
+
+    Parameters:
+    -----------
+    path: str
+        path to prepared session folder
+    session: str
+        bidsified session name
+    tree: crawler.Tree
+        crawled dataset containing session, if None
+        session is listed from filesystem
+    """
+    mri = os.path.join(path, "MRI")
+    if tree is not None:
+        folders = tree.listdir(mri)
+        mtime = tree.mtime(mri)
+    else:
+        folders = sorted(os.listdir(mri))
+        mtime = os.stat(mri).st_mtime_ns
+    names = [f.split("-", 1)[1] for f in folders]
+    sequences = resolve(names, session)
+    for seq, folder in zip(sequences, folders):
+        seq["folder"] = folder
+    plan = {"version": plan_version,
+            "session": session,
+            "mtime": mtime,
+            "sequences": sequences,
+            "validation": dict()}
+    validateFolders(folders, session, plan["validation"])
+    return plan
+
+
+def savePlan(path: str, plan: dict) -> None:
+    """
+    Atomically writes plan into prepared session folder
+    """
+    plan_file = os.path.join(path, plan_name)
+    tmp_file = plan_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(plan, f, indent=1)
+    os.replace(tmp_file, plan_file)
+
+
+def loadPlan(path: str, session: str, save: bool = True,
+             tree=None) -> dict:
+    """
+    Loads plan of prepared session, if plan is missing or
+    outdated, it is rebuilt, if series definitions changed,
+    series are revalidated
+
+    Parameters:
+    -----------
+    path: str
+        path to prepared session folder
+    session: str
+        bidsified session name
+    save: bool
+        if True, rebuilt or revalidated plan is stored in
+        session folder
+    tree: crawler.Tree
+        crawled dataset containing session, if None
+        session is listed from filesystem
+    """
+    plan_file = os.path.join(path, plan_name)
+    mri = os.path.join(path, "MRI")
+    plan = None
+    try:
+        with open(plan_file, "r") as f:
+            plan = json.load(f)
+        if tree is not None:
+            mtime = tree.mtime(mri)
+        else:
+            mtime = os.stat(mri).st_mtime_ns
+        if plan["version"] == plan_version\
+                and plan["session"] == session\
+                and plan["mtime"] == mtime:
+            folders = [seq["folder"] for seq in plan["sequences"]]
+            if plan["validation"].get("key")\
+                    == validationKey(folders, session):
+                return plan
+            logger.info("{}: Series definitions changed, revalidating"
+                        .format(path))
+            validateFolders(folders, session, plan["validation"])
+        else:
+            logger.info("{}: Plan outdated, rebuilding".format(path))
+            plan = None
+    except FileNotFoundError:
+        logger.debug("{}: Plan not found, building".format(path))
+    except (ValueError, KeyError) as e:
+        logger.warning("{}: Invalid plan: {}".format(path, e))
+        plan = None
+
+    if plan is None:
+        plan = buildPlan(path, session, tree)
+    if save:
+        try:
+            savePlan(path, plan)
+        except OSError as e:
+            logger.warning("{}: Unable to write plan: {}".format(path, e))
+    return plan
@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import logging
+import argparse
+
+from definitions import Series, validateSeries, formatViolation, plugin_root
+from subjects import loadSubjects
+from sidecar import readFields
+from parallel import runParallel
+from filenames import groupFolder, crossCheck
+
+"""
+preflight validates a whole dataset against the session definitions
+and subjects table, without running bidsme.
+
+It can be run on source dataset (before preparation) or on prepared
+dataset:
+
+    python3 resources/plugins/preflight.py -j 8 -o report.json source/
+
+All detected errors are reported in a machine-readable json file
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# folder containing image files in source dataset
+source_datadir = "nii"
+# folder containing series folders in prepared dataset
+prepared_datadir = "MRI"
+
+
+def _error(subject: str, session: str, kind: str, message: str,
+           **kwargs) -> dict:
+    """
+    Creates error entry of report
+    """
+    err = {"subject": subject, "session": session,
+           "kind": kind, "message": message}
+    err.update(kwargs)
+    return err
+
+
+def _violations(subject: str, session: str, series: list) -> list:
+    """
+    Validates series and converts violations to report entries
+    """
+    return [_error(subject, session, v.kind,
+                   formatViolation(subject, session, v),
+                   **{k: getattr(v, k)
+                      for k in ("index", "serie", "expected", "found")})
+            for v in validateSeries(series, session)]
+
+
+def sourceSeries(path: str, groups: dict = None) -> list:
+    """
+    Retrieves list of series protocols from source session,
+    ordered by serie number. Series are grouped from file
+    names, and only the json of first file of each serie
+    is read
+
+    Parameters:
+    -----------
+    path: str
+        path to folder with image files
+    groups: dict
+        series of folder, as returned by filenames.groupFolder,
+        if None folder is listed
+
+    Returns:
+    --------
+    list:
+        protocol names of series
+    """
+    if groups is None:
+        groups = groupFolder(path)[0]
+    series = list()
+    for group in groups.values():
+        if group.first is None:
+            continue
+        header = readFields(os.path.join(path, group.first),
+                            ("ProtocolName",))
+        series.append((header["ProtocolName"] or "").strip())
+    return series
+
+
+def checkSourceSubject(job: tuple) -> dict:
+    """
+    Validates all sessions of subject in source dataset
+
+    Parameters:
+    -----------
+    job: tuple
+        (subject folder, subject path, subject record from index,
+        switch to cross-check file names with headers)
+
+    Returns:
+    --------
+    dict:
+        number of checked sessions and list of errors
+    """
+    subject, path, record, cross_check = job
+    errors = list()
+    sessions = sorted(s for s in os.listdir(path)
+                      if s.startswith("s")
+                      and os.path.isdir(os.path.join(path, s)))
+    if record is None:
+        errors.append(_error(subject, "", "subject",
+                             "{}: Subject not found in table"
+                             .format(subject)))
+        return {"sessions": len(sessions), "errors": errors}
+
+    names = ["ses-" + s for s in record["sessions"]]
+    if "ses-OUT" in names:
+        errors.append(_error(subject, "", "abandoned",
+                             "{}: Subject seems to be abandoned study"
+                             .format(subject)))
+        return {"sessions": len(sessions), "errors": errors}
+
+    for ind, ses in enumerate(sessions):
+        name = names[ind] if ind < len(names) else "ses-nan"
+        if name == "ses-nan":
+            errors.append(_error(subject, ses, "session",
+                                 "{}/{}: Can't identify session"
+                                 .format(subject, ses)))
+            continue
+        datadir = os.path.join(path, ses, source_datadir)
+        if not os.path.isdir(datadir):
+            errors.append(_error(subject, name, "missing",
+                                 "{}/{}: Folder {} not found"
+                                 .format(subject, name, datadir)))
+            continue
+        groups, unmatched = groupFolder(datadir)
+        for f in unmatched:
+            errors.append(_error(subject, name, "naming",
+                                 "{}/{}: Unexpected file name {}"
+                                 .format(subject, name, f), file=f))
+        if cross_check:
+            for f, token, value, header in crossCheck(datadir, groups):
+                errors.append(_error(subject, name, "naming",
+                                     "{}/{}: {} of {} is {} in header"
+                                     .format(subject, name, token, f,
+                                             header),
+                                     file=f, token=token,
+                                     expected=value, found=header))
+        errors.extend(_violations(subject, name,
+                                  sourceSeries(datadir, groups)))
+    return {"sessions": len(sessions), "errors": errors}
+
+
+def checkPreparedSession(job: tuple) -> dict:
+    """
+    Validates session of prepared dataset
+
+    Parameters:
+    -----------
+    job: tuple
+        (subject, session, session path, expected sessions of
+        subject, or None if subject not in table)
+
+    Returns:
+    --------
+    dict:
+        number of checked sessions and list of errors
+    """
+    subject, session, path, expected = job
+    errors = list()
+    if expected is not None and session not in expected:
+        errors.append(_error(subject, session, "session",
+                             "{}/{}: Session not defined in table"
+                             .format(subject, session)))
+    datadir = os.path.join(path, prepared_datadir)
+    if not os.path.isdir(datadir):
+        errors.append(_error(subject, session, "missing",
+                             "{}/{}: Folder {} not found"
+                             .format(subject, session, datadir)))
+        return {"sessions": 1, "errors": errors}
+    series = [s.split("-", 1)[1] for s in sorted(os.listdir(datadir))]
+    errors.extend(_violations(subject, session, series))
+    return {"sessions": 1, "errors": errors}
+
+
+def _subjectId(name: str) -> int:
+    if name.startswith("sub-"):
+        name = name[4:]
+    try:
+        return int(name)
+    except ValueError:
+        return None
+
+
+def _lsdirs(path: str, prefix: str = "") -> list:
+    return sorted(d for d in os.listdir(path)
+                  if d.startswith(prefix)
+                  and os.path.isdir(os.path.join(path, d)))
+
+
+def preflight(dataset: str, subjects: dict,
+              layout: str = "", workers: int = 0,
+              cross_check: bool = False) -> dict:
+    """
+    Validates dataset
+
+    Parameters:
+    -----------
+    dataset: str
+        path to source or prepared dataset
+    subjects: dict
+        subjects index, as returned by subjects.loadSubjects
+    layout: str
+        either "source" or "prepared", if empty is
+        determined from folder names
+    workers: int
+        number of worker processes
+    cross_check: bool
+        if True, the tokens of file names of source dataset are
+        compared with headers of all sidecars
+
+    Returns:
+    --------
+    dict:
+        report
+    """
+    if not layout:
+        if any(d.startswith("sub-") for d in os.listdir(dataset)):
+            layout = "prepared"
+        else:
+            layout = "source"
+
+    jobs = list()
+    missing = list()
+    if layout == "source":
+        func = checkSourceSubject
+        for sub in _lsdirs(dataset):
+            sub_id = _subjectId(sub)
+            jobs.append((sub, os.path.join(dataset, sub),
+                         subjects.get(sub_id), cross_check))
+    elif layout == "prepared":
+        func = checkPreparedSession
+        for sub in _lsdirs(dataset, "sub-"):
+            record = subjects.get(_subjectId(sub))
+            expected = None
+            if record is not None:
+                expected = set("ses-" + s for s in record["sessions"])
+            else:
+                missing.append(_error(sub, "", "subject",
+                                      "{}: Subject not found in table"
+                                      .format(sub)))
+            for ses in _lsdirs(os.path.join(dataset, sub), "ses-"):
+                jobs.append((sub, ses, os.path.join(dataset, sub, ses),
+                             expected))
+    else:
+        raise ValueError("Invalid layout '{}'".format(layout))
+
+    results = runParallel(func, jobs, workers)
+    errors = missing + [e for r in results for e in r["errors"]]
+    return {"dataset": os.path.abspath(dataset),
+            "layout": layout,
+            "sessions_defined": sorted(Series),
+            "subjects": len(set(j[0] for j in jobs)),
+            "sessions": sum(r["sessions"] for r in results),
+            "errors": errors,
+            "passed": not errors
+            }
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+            description="Validates dataset against session definitions "
+                        "and subjects table")
+    parser.add_argument("dataset",
+                        help="path to source or prepared dataset")
+    parser.add_argument("--layout", choices=("source", "prepared"),
+                        default="",
+                        help="dataset layout, guessed if not given")
+    parser.add_argument("--subjects",
+                        default=os.path.join(plugin_root,
+                                             "Appariement.xlsx"),
+                        help="path to subjects xls table")
+    parser.add_argument("-j", "--workers", type=int,
+                        default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--cross-check", action="store_true",
+                        help="compares file names of source dataset "
+                             "with headers of all sidecars")
+    parser.add_argument("-o", "--output", default="",
+                        help="path to json report, printed if not given")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s %(name)s: %(message)s")
+    report = preflight(args.dataset, loadSubjects(args.subjects),
+                       args.layout, args.workers, args.cross_check)
+    for err in report["errors"]:
+        logger.error(err["message"])
+    logger.info("{} subjects, {} sessions checked, {} errors"
+                .format(report["subjects"], report["sessions"],
+                        len(report["errors"])))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
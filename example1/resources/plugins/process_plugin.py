@@ -1,11 +1,26 @@
 import os
-import shutil
 import logging
 import random
 
 from bids import BidsSession
 
-from definitions import checkSeries, plugin_root
+from context import openContext, currentContext, closeContext
+from plan import loadPlan, invalid
+import placement
+import iopool
+from journal import Journal, journal_suffix, writeAtomic
+from participants import ParticipantsTable, loadTemplate
+import instrument
+from instrument import traced
+from definitions import checkSeries, aux_files
+import crawler
+import logqueue
+from logqueue import BraceMessage
+import nifti
+from nifti import isNifti, merge4D, mergeSidecars, compressFile, splitext
+from nifti import repetitionTime, readHeader, volumeCount
+from diffusion import gradient_tables, checkRuns, concatenateRuns
+from diffusion import concat_protocols
 
 """
 process_plugin defines all nessesary functions to pre-process
@@ -26,6 +41,20 @@ preparedfolder = None
 bidsfolder = None
 # switch if is a dry-run (test run)
 dry_run = False
+# extension of merged 4D images, .nii.gz if images are compressed
+nii_ext = ".nii"
+# switch to concatenate diffusion runs of session
+dwi_concat = False
+# journal of sequences conversions, None in dry-run
+journal = None
+# crawled prepared dataset, queried instead of filesystem
+source_tree = None
+
+# participants table, filled at end of each subject and
+# written at the end of run, None if not requested
+participants = None
+# participants template
+part_json = None
 
 
 #####################
@@ -36,23 +65,28 @@ dry_run = False
 # protocol, thus it is impossible to identify them only using metadata
 # we will identify them by order they appear in session
 
-# list of sequences in order of acquisition in current session
-seq_list = list()
-
-
-#####################
-# Sequence variable #
-#####################
-
-# The index of current sequence, corresponds to order in the sequence list
-seq_index = -1
-
-
-def InitEP(source: str, destination: str, dry: bool) -> int:
+# the plan of session, with sequences in order of acquisition, their
+# role and IntendedFor, is built once by rename_plugin (see plan.py),
+# and is stored with index of current sequence in session context,
+# allowing to treat several sessions in parallel
+# see context.SessionContext.seq_list and seq_index
+
+
+@traced
+def InitEP(source: str, destination: str, dry: bool,
+           placement_mode: str = "auto",
+           trace: bool = False,
+           part_template: str = "",
+           io_workers: int = 0,
+           compression: int = 0,
+           concat_dwi: bool = False,
+           resume: bool = False,
+           log_queue: bool = False) -> int:
     """
     Initialisation of plugin
 
     1. Saves source/destination folders and dry_run switch
+    2. Loads participants table
 
     Parameters
     ----------
@@ -60,16 +94,91 @@ def InitEP(source: str, destination: str, dry: bool) -> int:
         path to source dataset
     destination:
         path to prepared dataset
+    placement_mode: str
+        how files are placed: auto, reflink, hardlink or copy
+    trace: bool
+        if True, entry points are traced in code/bidsme
+    part_template: str
+        path to participants json template, if set, the
+        participants.tsv is assembled by plugin and written
+        at the end of run
+    io_workers: int
+        number of threads placing files in background,
+        if 0 (default) files are placed immediately
+    log_queue: bool
+        if True, log records are written by background thread,
+        and also stored as json lines in code/bidsme
+    compression: int
+        gzip compression level (1-9) of merged 4D images,
+        if 0 images are not compressed
+    concat_dwi: bool
+        if True, diffusion runs of session are concatenated
+        in derivatives/dwi_concat
+    resume: bool
+        if True, the journal of interrupted run is replayed:
+        finished conversions are skipped and unfinished ones
+        are redone
     """
     global preparedfolder
     global bidsfolder
     global dry_run
+    global nii_ext
+    global dwi_concat
+    global journal
+    global source_tree
 
     preparedfolder = source
     bidsfolder = destination
     dry_run = dry
-
-
+    placement.setStrategy(placement_mode)
+    iopool.setWorkers(io_workers)
+    if not 0 <= compression <= 9:
+        raise ValueError("Invalid compression level {}"
+                         .format(compression))
+    dwi_concat = concat_dwi
+    nii_ext = ".nii"
+    if compression:
+        nii_ext = ".nii.gz"
+        nifti.gzip_level = compression
+    instrument.enabled = trace
+    logqueue.stop()
+    if log_queue:
+        logqueue.start("" if dry_run else
+                       os.path.join(bidsfolder, "code", "bidsme"),
+                       "process_plugin")
+    if trace and not dry_run:
+        instrument.setOutput(os.path.join(bidsfolder, "code", "bidsme"),
+                             "process_plugin")
+    else:
+        instrument.discardOutput()
+
+    # prepared dataset tree is stored by rename_plugin,
+    # dataset is crawled if tree is missing or outdated
+    source_tree = crawler.crawl(source,
+                                os.path.join(source, "code", "bidsme",
+                                             crawler.tree_name))
+
+    # conversions are recorded in journal, placed with logs
+    if journal is not None:
+        journal.close()
+    journal = None
+    if not dry_run:
+        journal = Journal(os.path.join(bidsfolder, "code", "bidsme",
+                                       "process_plugin" + journal_suffix),
+                          resume)
+
+    # participants table is loaded once, and filled
+    # by SubjectEP
+    global participants
+    global part_json
+    participants = None
+    if part_template:
+        part_json = loadTemplate(part_template)
+        participants = ParticipantsTable()
+        participants.load(os.path.join(destination, "participants.tsv"))
+
+
+@traced
 def SubjectEP(scan: BidsSession) -> int:
     """
     Subject modification
@@ -83,7 +192,12 @@ def SubjectEP(scan: BidsSession) -> int:
     # can set it to None, or set to new value
     scan.sub_values["handiness"] = random.choice([0, 1])
 
+    if participants is not None:
+        participants.add(scan.subject, scan.sub_values)
+    logqueue.sessionSummary(scan.subject, scan.session)
 
+
+@traced
 def SessionEP(scan: BidsSession) -> int:
     """
     Session files modifications
@@ -97,121 +211,81 @@ def SessionEP(scan: BidsSession) -> int:
     ######################################
     # Initialisation of sesion variables #
     ######################################
-    # retrieving sequences and puttintg them into list
-    global seq_list
-    global seq_index
+    # retrieving plan of session, built by rename_plugin
     path = os.path.join(scan.in_path, "MRI")
-    seq_list = sorted(os.listdir(path))
-    # removing leading sequence number from name
-    seq_list = [s.split("-", 1)[1] for s in seq_list]
-    seq_index = -1
+    aux_input = os.path.join(scan.in_path, "auxiliary")
+    source_tree.refresh(path)
+    source_tree.refresh(aux_input)
+    ctx = openContext(scan.subject, scan.session)
+    plan = loadPlan(scan.in_path, scan.session, not dry_run, source_tree)
+    ctx.data["plan"] = plan["sequences"]
+    ctx.seq_list = [seq["name"] for seq in plan["sequences"]]
 
     #################################
     # Checking sequences in session #
     #################################
-    checkSeries(path, scan.subject, scan.session, False)
+    checkSeries(path, scan.subject, scan.session, False, plan=plan)
 
     #############################################
     # Checking for existance of auxiliary files #
     #############################################
     # BidsSession.in_path contains current session folder path
-    aux_input = os.path.join(scan.in_path, "auxiliary")
-    if scan.session in ("ses-LCL", "ses-HCL"):
-        if not os.path.isdir(aux_input):
+    if scan.session in aux_files:
+        if not source_tree.isdir(aux_input):
             logger.error("Session {}/{} do not contain auxiliary folder"
                          .format(scan.subject, scan.session))
             return -1
-        for old, new in (("FCsepNBack.tsv", "task-rest_events.tsv"),
-                         ("FCsepNBack.json", "task-rest_events.json"),
-                         ("VAS.tsv", "task-rest_beh.tsv"),
-                         ("VAS.json", "task-rest_beh.json")):
+        for old, new in aux_files[scan.session]:
             source = "{}/{}".format(aux_input, old)
-            if not os.path.isfile(source):
+            if not source_tree.isfile(source):
                 logger.error("{}/{}: File {} not found"
                              .format(scan.subject, scan.session, source))
 
 
+@traced
 def SequenceEP(recording):
     """
     Sequence identification
     """
 
-    global seq_index
-
     # recording.custom is a dictionary for user-defined variables
     # that can be acessed from bidsmap
     # they are initialized at new sequence, and conserved for all files
     # within sequence, can be used to define sequence-global parameters
-    recording.custom["IntendedFor"] = ""
-    seq_index += 1
-    recid = seq_list[seq_index]
+    ctx = currentContext()
+    recid = ctx.nextSequence()
+    seq = ctx.data["plan"][ctx.seq_index]
 
     # checking if current sequence corresponds in correct place in list
     if recid != recording.recId():
-        logger.warning("{}: Id mismatch folder {}"
-                       .format(recording.recIdentity(False),
-                               recid))
-
-    # The inverted fMRI are taken just before normal fMRI
-    # looking into the following sequence will identify
-    # the current one
-    if recid == "cmrr_mbep2d_bold_mb2_invertpe":
-        mod = seq_list[seq_index + 1]
-        if mod.endswith("cmrr_mbep2d_bold_mb2_task_fat"):
-            recording.custom["IntendedFor"] = "nBack"
-        elif mod.endswith("cmrr_mbep2d_bold_mb2_task_nfat"):
-            recording.custom["IntendedFor"] = "nBack"
-        elif mod.endswith("cmrr_mbep2d_bold_mb2_rest"):
-            recording.custom["IntendedFor"] = "rest"
-        else:
-            recording.custom["IntendedFor"] = "invalid"
-            logger.warning("{}: Unknown session {}"
-                           .format(recording.recIdentity(),
-                                   mod))
-    # fmap images are taken for HCL, LCL and MPM (STROOP)
-    # sessions
-    elif recid == "gre_field_mapping":
-        if recording.sesId() in ("ses-HCL", "ses-LCL"):
-            recording.custom["IntendedFor"] = "HCL/LCL"
-        elif recording.sesId() == "ses-STROOP":
-            recording.custom["IntendedFor"] = "STROOP"
-        else:
-            logger.warning("{}: Unknown session {}"
-                           .format(recording.recIdentity(),
-                                   recording.sesId()))
-            recording.custom["IntendedFor"] = "invalid"
-    # fmaps sesnsBody and sesnArray are taken just before
-    # structural PD , T1 and MT. Looking into next sequences
-    # will allow the identification
-    elif recid == "al_mtflash3d_sensArray":
-        det = seq_list[seq_index + 2]
-        if det.endswith("al_mtflash3d_PDw"):
-            recording.custom["IntendedFor"] = "PDw"
-        elif det.endswith("al_mtflash3d_T1w"):
-            recording.custom["IntendedFor"] = "T1w"
-        elif det.endswith("al_mtflash3d_MTw"):
-            recording.custom["IntendedFor"] = "MTw"
-        else:
-            logger.warning("{}: Unable determine modality"
-                           .format(recording.recIdentity()))
-            recording.custom["IntendedFor"] = "invalid"
-    elif recid == "al_mtflash3d_sensBody":
-        det = seq_list[seq_index + 1]
-        if det.endswith("al_mtflash3d_PDw"):
-            recording.custom["IntendedFor"] = "PDw"
-        elif det.endswith("al_mtflash3d_T1w"):
-            recording.custom["IntendedFor"] = "T1w"
-        elif det.endswith("al_mtflash3d_MTw"):
-            recording.custom["IntendedFor"] = "MTw"
-        else:
-            logger.warning("{}: Unable determine modality"
-                           .format(recording.recIdentity()))
-            recording.custom["IntendedFor"] = "invalid"
-
-
+        logger.warning(BraceMessage("{}: Id mismatch folder {}",
+                                    recording.recIdentity(False),
+                                    recid))
+
+    # The inverted fMRI, fmap and sensitivity maps are identified
+    # by session or by the sequence that follows them, resolved
+    # in session plan, see plan.resolve
+    recording.custom["IntendedFor"] = seq["intended_for"]
+    if seq["intended_for"] == invalid:
+        logger.warning(BraceMessage("{}: Unable determine IntendedFor "
+                                    "from {}",
+                                    recording.recIdentity(),
+                                    seq["reference"]))
+
+
+@traced
 def SequenceEndEP(outfolder, recording):
     """
-    Simulates 3D to 4D images conversion
+    3D to 4D images conversion
+
+    Images are merged by nifti.merge4D, empty or placeholder
+    images (as in example dataset) are just copied. Sequences
+    mixing valid and placeholder images are not converted.
+    Merged images are compressed if compression is set
+
+    Conversion is recorded in journal: outputs are written
+    under temporary names, and 3D images are removed only
+    once all outputs are complete
     """
     modality = recording.Modality()
 
@@ -220,36 +294,191 @@ def SequenceEndEP(outfolder, recording):
         return
 
     f4D = os.path.join(outfolder, "4D")
-    if not os.path.isfile(f4D + ".nii"):
-        logger.info("{}: Converting {} MRI to 4D"
-                    .format(recording.recIdentity(index=False),
-                            modality))
-        first_file = os.path.join(outfolder, recording.files[0])
-        # "convertion" is just copy of first file in sequence
-        # in real application a external tool should be used
-        shutil.copy2(first_file, f4D + ".nii")
-        first_file = os.path.splitext(first_file)[0] + ".json"
-        # copying the first file json to allow the identification
-        shutil.copy2(first_file, f4D + ".json")
-
-        # copying fake bval and bvec values
-        # during the bidsifications these files will
-        # be automatically picked up
-        if modality == "dwi":
-            shutil.copy2(os.path.join(plugin_root,
-                                      "diffusion",
-                                      "NODDI.bval"),
-                         os.path.join(outfolder,
-                                      "4D.bval"))
-            shutil.copy2(os.path.join(plugin_root,
-                                      "diffusion",
-                                      "NODDI.bvec"),
-                         os.path.join(outfolder,
-                                      "4D.bvec"))
-
-        # Removing now obsolete files
-        for f_nii in recording.files:
-            f_nii = os.path.join(outfolder, f_nii)
-            f_json = os.path.splitext(f_nii)[0] + ".json"
-            os.remove(f_nii)
-            os.remove(f_json)
+    key = os.path.relpath(outfolder, preparedfolder)
+    if journal is not None and journal.recover(key) == "done":
+        logger.info(BraceMessage("{}: Already converted",
+                                 recording.recIdentity(index=False)))
+        _registerRun(recording, f4D + nii_ext,
+                     journal.entries[key].get("volumes"))
+        return
+    table = None
+    outputs = [f4D + nii_ext, f4D + ".json"]
+    if modality == "dwi":
+        protocol = recording.recId()
+        table = gradient_tables.get(protocol)
+        if table is not None:
+            outputs += [f4D + ".bval", f4D + ".bvec"]
+    if (journal is None or journal.status(key) is None)\
+            and all(os.path.isfile(f) for f in outputs):
+        # converted by previous run, not resumed, or before
+        # journal was introduced
+        _registerRun(recording, f4D + nii_ext)
+        return
+
+    logger.info(BraceMessage("{}: Converting {} MRI to 4D",
+                             recording.recIdentity(index=False), modality))
+    files = [os.path.join(outfolder, f) for f in recording.files]
+    sidecars = [splitext(f)[0] + ".json" for f in files]
+    valid = [isNifti(f) for f in files]
+    if any(valid) and not all(valid):
+        logger.error(BraceMessage("{}: {} of {} images are not valid "
+                                  "NIfTI, sequence not converted",
+                                  recording.recIdentity(index=False),
+                                  valid.count(False), len(files)))
+        return
+    if modality == "dwi" and table is None:
+        logger.warning(BraceMessage("{}: No gradient table for {}",
+                                    recording.recIdentity(index=False),
+                                    protocol))
+    if journal is not None:
+        journal.begin(key, outputs, files + sidecars)
+
+    # number of volumes is known only for valid images
+    volumes = None
+    if all(valid):
+        volumes = writeAtomic(f4D + nii_ext, _merge4D, files,
+                              repetitionTime(sidecars[0]))
+    elif nii_ext == ".nii":
+        # "convertion" of placeholder images is just copy
+        # of first file in sequence
+        placement.place(files[0], f4D + nii_ext)
+    else:
+        writeAtomic(f4D + nii_ext, _compressFile, files[0])
+    # merged json contains the header of first file, and
+    # acquisition time of each volume
+    writeAtomic(f4D + ".json", _mergeSidecars, sidecars)
+
+    # copying gradient table of protocol
+    # during the bidsifications these files will
+    # be automatically picked up
+    if table is not None:
+        for ext in (".bval", ".bvec"):
+            placement.place(table + ext, f4D + ext)
+    _registerRun(recording, f4D + nii_ext, volumes)
+
+    # Removing now obsolete files, only once
+    # conversion is committed, number of volumes is kept
+    # in journal for resumed runs
+    if journal is None:
+        for f in files + sidecars:
+            os.remove(f)
+    else:
+        journal.commit(key, volumes=volumes)
+        journal.removeInputs(key)
+
+
+def _registerRun(recording, image: str, volumes: int = None) -> None:
+    """
+    Stores converted diffusion run in session context, runs
+    are checked against gradient tables at end of session.
+    If number of volumes is not given, it is read from image
+    header, runs with unknown number of volumes are skipped
+    """
+    if recording.Modality() != "dwi":
+        return
+    protocol = recording.recId()
+    if protocol not in gradient_tables:
+        return
+    if volumes is None:
+        header = readHeader(image) if os.path.isfile(image) else None
+        if header is None:
+            logger.debug(BraceMessage("{}: Unknown number of volumes, "
+                                      "run not checked",
+                                      recording.recIdentity(index=False)))
+            return
+        volumes = volumeCount(header)
+    ctx = currentContext()
+    ctx.data.setdefault("dwi", list()).append((image, protocol, volumes))
+
+
+def _merge4D(output: str, files: list, tr: float) -> int:
+    return merge4D(files, output, tr)
+
+
+def _compressFile(output: str, source: str) -> int:
+    return compressFile(source, output)
+
+
+def _mergeSidecars(output: str, sidecars: list) -> None:
+    mergeSidecars(sidecars, output)
+
+
+@traced
+def SessionEndEP(scan):
+    """
+    1. Waits for files placed in background
+    2. Checks diffusion runs against gradient tables,
+    and concatenates them
+    3. Releases session context
+    4. Reports number of log records of session
+    """
+    try:
+        iopool.barrier((scan.subject, scan.session))
+        runs = currentContext().data.get("dwi")
+        if runs:
+            _checkDiffusion(scan, runs)
+    finally:
+        closeContext()
+        logqueue.sessionSummary(scan.subject, scan.session)
+
+
+def _checkDiffusion(scan, runs: list) -> None:
+    """
+    Validates number of volumes of diffusion runs, and
+    concatenates runs of diffusion.concat_protocols if requested
+    """
+    mismatches = checkRuns([(protocol, volumes)
+                            for image, protocol, volumes in runs])
+    for ind in mismatches:
+        logger.warning("{}/{}: {} volumes in {} do not match gradient "
+                       "table of {}"
+                       .format(scan.subject, scan.session,
+                               runs[ind][2], runs[ind][0], runs[ind][1]))
+    if not dwi_concat or dry_run:
+        return
+    # only runs which table is the one of acquisition
+    # are concatenated
+    mismatches = [ind for ind in mismatches
+                  if runs[ind][1] in concat_protocols]
+    runs = [r for r in runs if r[1] in concat_protocols]
+    if len(runs) < 2:
+        return
+    if mismatches or nii_ext != ".nii":
+        # compressed images can't be streamed by merge4D
+        logger.error("{}/{}: Diffusion runs not concatenated"
+                     .format(scan.subject, scan.session))
+        return
+    out_dir = os.path.join(bidsfolder, "derivatives", "dwi_concat",
+                           scan.subject, scan.session, "dwi")
+    os.makedirs(out_dir, exist_ok=True)
+    output = os.path.join(out_dir, "{}_{}_dwi{}"
+                          .format(scan.subject, scan.session, nii_ext))
+    volumes = concatenateRuns([r[0] for r in runs],
+                              [r[1] for r in runs],
+                              output)
+    logger.info("{}/{}: {} diffusion runs concatenated, {} volumes"
+                .format(scan.subject, scan.session, len(runs), volumes))
+
+
+@traced
+def ExitEP() -> int:
+    """
+    1. Writes participants table
+    2. Reports placement statistics (entry points trace is
+    written after ExitEP, see instrument.traced)
+    3. Closes conversions journal
+    4. Writes pending log records
+    """
+    global journal
+    if participants is not None and not dry_run:
+        # written after bidsme, values of its file are kept
+        # only where plugin table has none
+        path = os.path.join(bidsfolder, "participants.tsv")
+        participants.load(path, update=False)
+        participants.write(path, part_json)
+    iopool.shutdown()
+    if journal is not None:
+        journal.close()
+        journal = None
+    placement.summary()
+    logqueue.stop()
@@ -1,12 +1,24 @@
 import os
-import pandas
 import logging
-import shutil
 
-from tools import tools
 from bids import BidsSession
 
 from definitions import Series, checkSeries, plugin_root
+from definitions import definitions_digest
+from subjects import loadSubjects, excel_col_list
+import placement
+import iopool
+from participants import ParticipantsTable, loadTemplate
+import instrument
+from instrument import traced
+from manifest import Manifest, fingerprint, manifest_name
+from context import openContext, currentContext
+from plan import buildPlan, savePlan
+from events import convertEvents, convertBatch
+import crawler
+import catalogue
+import logqueue
+from logqueue import BraceMessage
 
 """
 rename_plugin defines all nessesary functions to prepare source
@@ -35,50 +47,84 @@ dry_run = False
 # global plugin variables #
 ###########################
 
-# map of individual sessions
+# map of individual sessions is stored in subject context
 #   key: source folde session (s01234)
 #   value: bidsified session (ses-HCL)
-scans_map = {}
-
-# scale to convert ms in log-files to seconds
-time_scale = 1e-3
+# see context.SessionContext.scans_map
+
+# units of time columns in log files, converted to units
+# declared in json sidecars (see events.unit_factors)
+#   key: log file name
+#   value: dictionary of column: unit
+log_units = {"FCsepNBack": {"onset": "s",
+                            "duration": "s",
+                            "response_time": "s"},
+             "VAS": {}
+             }
+
+# if True, invalid values in log files raise an error,
+# otherwise they are replaced by n/a
+strict_events = False
+
+# if True, log files are converted in one pass at the end
+# of preparation, instead of at end of each session
+events_batch = False
+# pending conversions and manifest entries in batch mode
+events_jobs = list()
+events_records = list()
 
 # subject balck-list
 #   subject folders in this list will be skipped
 #   by plugin
 sub_black_list = []
 
-# subject xls table columns and their renaming
-excel_col_list = {"Patient": "pat",
-                  "Sex": "pat_sex",
-                  "Age": "pat_age",
-                  "Education": "pat_edu",
-                  1: "pat_1", 2: "pat_2", 3: "pat_3",
-                  'Control': "cnt",
-                  "Sex.1": "cnt_sex",
-                  "Age.1": "cnt_age",
-                  "Education.1": "cnt_edu",
-                  "1.1": "cnt_1", "2.1": "cnt_2", "3.1": "cnt_3"
-                  }
+# compiled index of subjects table
+#   key: subject id
+#   value: dictionary with group, demographics, pairing
+#          and sessions order
+subjects_index = None
+
+# participants table, filled at end of each subject and
+# written at the end of run, None if not requested
+participants = None
+# participants template
+part_json = None
 
+# manifest of prepared sessions, used to skip the sessions
+# unchanged since last preparation, None if incremental
+# preparation is disabled
+manifest = None
+# parameters of preparation included in fingerprint of each
+# session, so sessions are prepared again if they change
+prepare_signature = None
 
-# columns prefixes for patient and control subjects
-#   0 == False == Control
-#   1 == True == Patient
-sub_prefix = ["cnt", "pat"]
+# crawled source dataset, queried instead of filesystem
+source_tree = None
 
-# pandas dataframe with list of subjects
-df_subjects = None
+# switch to update catalogue of prepared dataset
+catalogue_update = False
 
 
+@traced
 def InitEP(source: str, destination: str,
            dry: bool,
-           subjects: str = "") -> int:
+           subjects: str = "",
+           placement_mode: str = "auto",
+           incremental: bool = False,
+           trace: bool = False,
+           batch_events: bool = False,
+           part_template: str = "",
+           io_workers: int = 0,
+           log_queue: bool = False,
+           build_catalogue: bool = False) -> int:
     """
     Initialisation of plugin
 
     1. Saves source/destination folders and dry_run switch
-    2. Loads subjects xls table
+    2. Crawls source dataset
+    3. Loads subjects xls table compiled index
+    4. Loads manifest of prepared sessions
+    5. Loads participants table
 
     Parameters
     ----------
@@ -89,15 +135,75 @@ def InitEP(source: str, destination: str,
     subjects: str
         path to subjects xls file, if empty is looked
         in source dataset folder
+    placement_mode: str
+        how auxiliary files are placed in prepared dataset:
+        auto, reflink, hardlink or copy
+    incremental: bool
+        if True, sessions unchanged since last preparation
+        are skipped; a session is changed if its source files,
+        its subject record, series definitions, log files
+        conversion or resource files differ
+    trace: bool
+        if True, entry points are traced in code/bidsme
+    batch_events: bool
+        if True, log files of all sessions are converted
+        in one pass at the end of preparation
+    part_template: str
+        path to participants json template, if set, the
+        participants.tsv is assembled by plugin and written
+        at the end of run
+    io_workers: int
+        number of threads placing files in background,
+        if 0 (default) files are placed immediately
+    log_queue: bool
+        if True, log records are written by background thread,
+        and also stored as json lines in code/bidsme
+    build_catalogue: bool
+        if True, the catalogue of sidecars of prepared dataset
+        is updated at the end of preparation
     """
 
     global rawfolder
     global preparefolder
     global dry_run
+    global events_batch
+    global source_tree
+    global catalogue_update
 
     rawfolder = source
     preparefolder = destination
     dry_run = dry
+    events_batch = batch_events
+    catalogue_update = build_catalogue
+    events_jobs.clear()
+    events_records.clear()
+    placement.setStrategy(placement_mode)
+    iopool.setWorkers(io_workers)
+    instrument.enabled = trace
+    logqueue.stop()
+    if log_queue:
+        logqueue.start("" if dry_run else
+                       os.path.join(preparefolder, "code", "bidsme"),
+                       "rename_plugin")
+    if trace and not dry_run:
+        instrument.setOutput(os.path.join(preparefolder, "code", "bidsme"),
+                             "rename_plugin")
+    else:
+        instrument.discardOutput()
+
+    # source dataset is listed once, subjects and sessions
+    # are retrieved from crawled tree
+    source_tree = crawler.crawl(rawfolder)
+
+    # participants table is loaded once, and filled
+    # by SubjectEP
+    global participants
+    global part_json
+    participants = None
+    if part_template:
+        part_json = loadTemplate(part_template)
+        participants = ParticipantsTable()
+        participants.load(os.path.join(destination, "participants.tsv"))
 
     #########################
     # Loading subjects list #
@@ -110,17 +216,43 @@ def InitEP(source: str, destination: str,
         raise FileNotFoundError("Subject file '{}' not found"
                                 .format(subject_file))
 
-    # creating dataframe for subjects
-    global df_subjects
-    df_subjects = pandas.read_excel(subject_file,
-                                    sheet_name=0, header=0,
-                                    usecols="A:N"
-                                    )
-    df_subjects.rename(index=str, columns=excel_col_list, inplace=True)
-    df_subjects = df_subjects[df_subjects['pat'].notnull()
-                              | df_subjects['cnt'].notnull()]
+    # loading subjects index, the excel table is parsed
+    # only if compiled index is outdated
+    global subjects_index
+    subjects_index = loadSubjects(subject_file, excel_col_list)
 
+    ####################
+    # Loading manifest #
+    ####################
+    global manifest
+    global prepare_signature
+    manifest = None
+    if incremental:
+        manifest = Manifest(os.path.join(preparefolder, "code", "bidsme",
+                                         manifest_name))
+        prepare_signature = _prepareSignature()
 
+
+def _prepareSignature() -> tuple:
+    """
+    Returns the parameters of preparation that change its result:
+    series definitions, conversion of log files and size and
+    modification time of resource files copied into sessions
+    """
+    resources = list()
+    for name in sorted(log_units):
+        sidecar = os.path.join(plugin_root, name + ".json")
+        if os.path.isfile(sidecar):
+            st = os.stat(sidecar)
+            resources.append((name, st.st_size, st.st_mtime_ns))
+    return (definitions_digest,
+            sorted((name, sorted(units.items()))
+                   for name, units in log_units.items()),
+            strict_events,
+            resources)
+
+
+@traced
 def SubjectEP(session: BidsSession) -> int:
     """
     Subject determination and initialisation
@@ -128,6 +260,7 @@ def SubjectEP(session: BidsSession) -> int:
     1. Checks if subject not in balck list
     2. Loads demographics from subject table
     3. Creates session parcing dictionary
+    4. Reports number of log records of subject
 
     Parameters
     ----------
@@ -140,6 +273,13 @@ def SubjectEP(session: BidsSession) -> int:
         if > 0, plugin failed, an exception will be raised
         if < 0, plugin failed, and subject will be skipped
     """
+    try:
+        return _subject(session)
+    finally:
+        logqueue.sessionSummary(session.subject, session.session)
+
+
+def _subject(session: BidsSession) -> int:
 
     #################################
     # Skipping if in the black list #
@@ -164,73 +304,59 @@ def SubjectEP(session: BidsSession) -> int:
     # storing bidsified subject id into session object
     # optional, but useful as reference
     session.sub_values["participant_id"] = "sub-" + session.subject
-    # looking for subject in dataframe
-    prefix = "pat"
-    index = df_subjects.loc[df_subjects[prefix] == sub_id].index
-    # storing participant group in session
-    session.sub_values["group"] = "patient"
-
-    if len(index) == 0:
-        # Subject not in patient list, looking in control
-        prefix = "cnt"
-        index = df_subjects.loc[df_subjects[prefix] == sub_id].index
-        session.sub_values["group"] = "control"
-        if len(index) == 0:
-            raise KeyError("Subject {} not found in table"
-                           .format(sub_id))
-    if len(index) > 1:
-        logger.warning("Subject {}: several column entries present"
+    # looking for subject in index
+    record = subjects_index.get(sub_id)
+    if record is None:
+        raise KeyError("Subject {} not found in table"
                        .format(sub_id))
-    index = index[0]
-
-    # retrieving demographics
-    sex = df_subjects.loc[index, prefix + "_sex"]
-    age = df_subjects.loc[index, prefix + "_age"]
-    education = df_subjects.loc[index, prefix + "_edu"]
+    # storing participant group in session
+    session.sub_values["group"] = record["group"]
+    if record["duplicates"] > 1:
+        logger.warning(BraceMessage("Subject {}: several column entries "
+                                    "present", sub_id))
 
     # session initialised values are Null
     # fill them only if they are retrieved from table
-    if pandas.notna(sex):
-        session.sub_values["sex"] = sex
-    if pandas.notna(age):
-        session.sub_values["age"] = float(age)
-    if pandas.notna(education):
-        session.sub_values["education"] = float(education)
+    if record["sex"] is not None:
+        session.sub_values["sex"] = record["sex"]
+    if record["age"] is not None:
+        session.sub_values["age"] = record["age"]
+    if record["education"] is not None:
+        session.sub_values["education"] = record["education"]
 
     # looking for pairing
-    paired = df_subjects.loc[index, sub_prefix[prefix == "cnt"]]
-    if pandas.notna(paired):
-        session.sub_values["paired"] = "sub-{:03}".format(int(paired))
+    if record["paired"] is not None:
+        session.sub_values["paired"] = "sub-{:03}".format(record["paired"])
 
     #################################
     # determining order of sessions #
     #################################
-    scans_map.clear()
-    scans_order = sorted([os.path.basename(s) for s in
-                          tools.lsdirs(os.path.join(rawfolder,
-                                                    session.subject),
-                                       "s*")
-                          ])
+    ctx = openContext("sub-" + session.subject)
+    ctx.data["record"] = record
+    scans_map = ctx.scans_map
+    scans_order = [os.path.basename(s) for s in
+                   source_tree.lsdirs(os.path.join(rawfolder,
+                                                   session.subject),
+                                      "s*")
+                   ]
     # looping over session defined in columns
     for ind, s in enumerate(("_1", "_2", "_3")):
-        v = "ses-" + str(df_subjects.loc[index, prefix + s]).strip()
+        v = "ses-" + record["sessions"][ind]
         ses = "ses" + s
         if v == "ses-nan":
             # Session not defined in table, but existing
             # in source dataset
             session.sub_values[ses] = ""
-            logger.warning("Subject {}({}): missing {} value"
-                           .format(session.sub_values["participant_id"],
-                                   session.sub_values["group"],
-                                   ses)
-                           )
+            logger.warning(BraceMessage("Subject {}({}): missing {} value",
+                                        session.sub_values["participant_id"],
+                                        session.sub_values["group"],
+                                        ses))
         elif v == "ses-OUT":
             # participant left study
-            logger.warning("Subject {}({}): seems to be abandoned study"
-                           .format(session.sub_values["participant_id"],
-                                   session.sub_values["group"]
-                                   )
-                           )
+            logger.warning(BraceMessage("Subject {}({}): seems to be "
+                                        "abandoned study",
+                                        session.sub_values["participant_id"],
+                                        session.sub_values["group"]))
             return -1
         elif v not in Series:
             # invalid session name
@@ -252,35 +378,76 @@ def SubjectEP(session: BidsSession) -> int:
     # with original names
     for scan in scans_order:
         if scan not in scans_map:
-            logger.error("Subject {}({}): Can't identify session {}"
-                         .format(session.sub_values["participant_id"],
-                                 session.sub_values["group"],
-                                 scan))
+            logger.error(BraceMessage("Subject {}({}): Can't identify "
+                                      "session {}",
+                                      session.sub_values["participant_id"],
+                                      session.sub_values["group"],
+                                      scan))
             scans_map[scan] = scan
 
     # opional, the sub- prefix added automatically
     # if not present
     session.subject = "sub-" + session.subject
+    logqueue.renameKeys(session.subject, session.session)
+
+    if participants is not None:
+        participants.add(session.subject, session.sub_values)
 
 
+@traced
 def SessionEP(session: BidsSession) -> int:
     """
     1. Set-up session name
+    2. Skips session if unchanged since last preparation
 
     Parameters
     ----------
     session: BidsSession
+
+    Returns
+    -------
+    int:
+        if < 0, session is skipped
     """
     # Renaming session name from map
-    session.session = scans_map[session.session]
+    ctx = currentContext("subject")
+    source_ses = session.session
+    session.session = ctx.scans_map[source_ses]
+    logqueue.renameKeys(session.subject, session.session)
+
+    ##############################
+    # Checking for modifications #
+    ##############################
+    if manifest is None:
+        return 0
+    key = "{}/{}".format(session.subject, source_ses)
+    fp = fingerprint(session.in_path, ctx.data["record"], session.session,
+                     prepare_signature, tree=source_tree)
+    ctx.data[key] = fp
+    if manifest.unchanged(key, fp)\
+            and os.path.isdir(os.path.join(preparefolder,
+                                           session.getPath(True))):
+        logger.info("{}/{}: Unchanged since last preparation, skipping"
+                    .format(session.subject, session.session))
+        return -1
+    return 0
 
 
+@traced
 def SessionEndEP(session: BidsSession):
     """
-    1. Checks the series in the prepared folder
-    2. Extract KSS/VAS data from kss_dict to tsv file
-    3. Parces in-scan nBack and KSS/VAS log files
+    1. Checks the series in the prepared folder and stores
+    session plan
+    2. Converts in-scan nBack and KSS/VAS log files
+    3. Reports number of log records of session
     """
+    try:
+        return _sessionEnd(session)
+    finally:
+        logqueue.sessionSummary(session.subject, session.session)
+
+
+def _sessionEnd(session: BidsSession):
     # path contain destination folder, where
     # all data files are placed
 
@@ -295,15 +462,20 @@ def SessionEndEP(session: BidsSession):
                             "MRI")
 
     # checking if session contains correct series
+    # and storing plan of sequences for process and
+    # bidsify plugins
     if not dry_run:
+        plan = buildPlan(path, session.session)
         checkSeries(out_path,
                     session.subject, session.session,
-                    False)
+                    False, plan=plan)
+        savePlan(path, plan)
 
     ############################################
     # Retrieving in-scan task and KSS/VAS data #
     ############################################
     if session.session == "ses-STROOP":
+        _recordSession(session)
         return 0
     # where tsv files are
     inp_dir = os.path.join(session.in_path, "inp")
@@ -315,17 +487,89 @@ def SessionEndEP(session: BidsSession):
     # do not copy if we are in dry mode
     if not dry_run:
         os.makedirs(aux_dir, exist_ok=True)
-        # just copy file, in real life application
-        # you may parce files
-        for file in ("FCsepNBack.tsv", "VAS.tsv"):
-            file = os.path.join(inp_dir, file)
+        owner = (session.subject, session.session)
+        jobs = list()
+        for name, units in log_units.items():
+            file = os.path.join(inp_dir, name + ".tsv")
             if not os.path.isfile(file):
                 raise FileNotFoundError(file)
-            shutil.copy2(file, aux_dir)
+            # copiyng correspondent json file
+            sidecar = os.path.join(plugin_root, name + ".json")
+            if not os.path.isfile(sidecar):
+                raise FileNotFoundError(sidecar)
+            iopool.submit(owner, placement.place, sidecar, aux_dir)
+            jobs.append((file, os.path.join(aux_dir, name + ".tsv"),
+                         sidecar, units, strict_events))
+
+        if events_batch:
+            events_jobs.extend(jobs)
+        else:
+            for job in jobs:
+                convertEvents(*job)
 
-        # copiyng correspondent json files
-        for file in ("FCsepNBack.json", "VAS.json"):
-            file = os.path.join(plugin_root, file)
-            if not os.path.isfile(file):
-                raise FileNotFoundError(file)
-            shutil.copy2(file, aux_dir)
+        # session is recorded in manifest only after its files
+        # are placed, and in batch mode, after conversion
+        iopool.barrier(owner)
+        if events_batch:
+            events_records.append(_recordSession(session, False))
+            return 0
+
+    _recordSession(session)
+
+
+def _recordSession(session: BidsSession, write: bool = True) -> tuple:
+    """
+    Records prepared session in manifest, if write is False
+    the manifest entry is returned to be recorded later
+    """
+    if manifest is None or dry_run:
+        return None
+    source_ses = os.path.basename(os.path.normpath(session.in_path))
+    key = "{}/{}".format(session.subject, source_ses)
+    fp = currentContext("subject").data.get(key)
+    if fp is None:
+        return None
+    if write:
+        manifest.update(key, fp, session=session.session)
+    return (key, fp, session.session)
+
+
+@traced
+def ExitEP() -> int:
+    """
+    1. Converts log files in batch mode
+    2. Writes participants table
+    3. Reports placement statistics (entry points trace is
+    written after ExitEP, see instrument.traced)
+    4. Compacts manifest of prepared sessions
+    5. Crawls prepared dataset, and stores its tree for
+    next stages, and updates catalogue of sidecars
+    6. Writes pending log records
+    """
+    iopool.shutdown()
+    if events_jobs:
+        convertBatch(events_jobs, os.cpu_count())
+        for record in events_records:
+            if record is not None:
+                key, fp, ses = record
+                manifest.update(key, fp, session=ses)
+        events_jobs.clear()
+        events_records.clear()
+    if participants is not None and not dry_run:
+        # written after bidsme, values of its file are kept
+        # only where plugin table has none
+        path = os.path.join(preparefolder, "participants.tsv")
+        participants.load(path, update=False)
+        participants.write(path, part_json)
+    placement.summary()
+    if manifest is not None and not dry_run:
+        manifest.compact()
+    if not dry_run:
+        code = os.path.join(preparefolder, "code", "bidsme")
+        os.makedirs(code, exist_ok=True)
+        tree = crawler.Tree(preparefolder)
+        tree.save(os.path.join(code, crawler.tree_name))
+        if catalogue_update:
+            catalogue.build(preparefolder, workers=os.cpu_count(),
+                            tree=tree)
+    logqueue.stop()
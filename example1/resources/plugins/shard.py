@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import filecmp
+import hashlib
+import logging
+import argparse
+
+import placement
+import crawler
+import catalogue
+from manifest import Manifest, manifest_name
+from participants import ParticipantsTable, loadTemplate
+
+"""
+shard splits a source dataset into independent shards of subjects,
+and merges the datasets produced from shards into single dataset.
+
+Each shard is a folder with symbolic links to its subjects, that
+can be processed by bidsme as an independent job, with its own
+destination and logs:
+
+    python3 resources/plugins/shard.py split -n 4 source/ shards/
+    # on each node, for K in 00..03:
+    python3 bidsme.py prepare ... shards/shard-K/source/ \\
+                                  shards/shard-K/renamed/
+    ...
+    python3 resources/plugins/shard.py merge -o bids/ shards/shard-*/bids
+
+Subjects are assigned to shards by their folder order or by stable
+hash of their name. At merge, subject folders are placed into the
+merged dataset, participants.tsv files are merged and sorted by
+participant, manifests are compacted and code/bidsme logs are
+concatenated in shard order. Tree and catalogue of dataset, built
+for each shard, are rebuilt for merged dataset
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# name of shards description file, placed in shards folder
+shards_name = "shards.json"
+
+# files of code/bidsme that are not merged
+skip_code = (".idx", ".tmp")
+
+# files of code/bidsme derived from dataset content, that
+# are rebuilt for merged dataset
+derived_code = (crawler.tree_name,
+                catalogue.catalogue_base + ".parquet",
+                catalogue.catalogue_base + ".json.gz")
+
+
+def assignShards(subjects: list, n: int, method: str = "hash") -> dict:
+    """
+    Assigns subjects to shards
+
+    Parameters:
+    -----------
+    subjects: list
+        list of subjects folder names
+    n: int
+        number of shards
+    method: str
+        'folder' to cut sorted list of subjects in contiguous
+        shards, 'hash' to assign by hash of subject name
+
+    Returns:
+    --------
+    dict:
+        shard name: sorted list of subjects
+    """
+    if n < 1:
+        raise ValueError("Invalid number of shards: {}".format(n))
+    subjects = sorted(subjects)
+    shards = {"shard-{:02d}".format(k): list() for k in range(n)}
+    for ind, sub in enumerate(subjects):
+        if method == "folder":
+            k = ind * n // len(subjects)
+        elif method == "hash":
+            k = int(hashlib.sha1(sub.encode()).hexdigest(), 16) % n
+        else:
+            raise ValueError("Invalid shard method: {}".format(method))
+        shards["shard-{:02d}".format(k)].append(sub)
+    return shards
+
+
+def split(source: str, destination: str, n: int,
+          method: str = "hash") -> dict:
+    """
+    Creates shards of source dataset, each shard contains
+    source sub-folder with links to its subjects
+
+    Returns:
+    --------
+    dict:
+        shard name: list of subjects
+    """
+    source = os.path.abspath(source)
+    subjects = [e.name for e in os.scandir(source) if e.is_dir()]
+    shards = assignShards(subjects, n, method)
+    for shard, subs in shards.items():
+        shard_source = os.path.join(destination, shard, "source")
+        os.makedirs(shard_source, exist_ok=True)
+        for sub in subs:
+            link = os.path.join(shard_source, sub)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.join(source, sub), link)
+        logger.info("{}: {} subjects".format(shard, len(subs)))
+    with open(os.path.join(destination, shards_name), "w") as f:
+        json.dump({"source": source, "method": method,
+                   "shards": shards}, f, indent=2)
+    return shards
+
+
+def _placeTree(source: str, dest: str, exclusive: bool) -> int:
+    """
+    Places all files of source folder into dest folder.
+    If exclusive, existing files are an error, otherwise
+    existing files are kept and reported if they differ
+
+    Returns number of placed files
+    """
+    count = 0
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        out = os.path.join(dest, os.path.relpath(root, source))
+        os.makedirs(out, exist_ok=True)
+        for name in sorted(files):
+            src = os.path.join(root, name)
+            dst = os.path.join(out, name)
+            if os.path.exists(dst):
+                if exclusive:
+                    raise FileExistsError(dst)
+                if not filecmp.cmp(src, dst, shallow=False):
+                    logger.warning("{}: Differs from {}, first kept"
+                                   .format(src, dst))
+                continue
+            placement.place(src, dst)
+            count += 1
+    return count
+
+
+def _mergeProm(files: list, output: str) -> None:
+    """
+    Merges Prometheus textfiles, summing values of same series
+    """
+    lines = list()
+    values = dict()
+    for path in files:
+        with open(path, "r") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line.startswith("#") or not line:
+                    if line not in lines:
+                        lines.append(line)
+                    continue
+                series, value = line.rsplit(" ", 1)
+                if series not in values:
+                    lines.append(series)
+                    values[series] = 0
+                values[series] += float(value)
+    with open(output, "w") as f:
+        for line in lines:
+            if line in values:
+                v = values[line]
+                line = "{} {}".format(line, int(v) if v == int(v) else v)
+            f.write(line + "\n")
+
+
+def _mergeCode(shards: list, dest: str) -> list:
+    """
+    Merges code/bidsme folders of shards
+
+    Returns:
+    --------
+    list:
+        names of derived files found in shards, not merged
+    """
+    names = set()
+    for shard in shards:
+        code = os.path.join(shard, "code", "bidsme")
+        if os.path.isdir(code):
+            names.update(e.name for e in os.scandir(code) if e.is_file())
+    out = os.path.join(dest, "code", "bidsme")
+    os.makedirs(out, exist_ok=True)
+
+    for name in sorted(names):
+        if name.endswith(skip_code) or name in derived_code:
+            continue
+        files = [os.path.join(shard, "code", "bidsme", name)
+                 for shard in shards]
+        files = [f for f in files if os.path.isfile(f)]
+        output = os.path.join(out, name)
+        if name == manifest_name:
+            merged = Manifest(output)
+            for f in files:
+                merged.entries.update(Manifest(f).entries)
+            merged.compact()
+        elif name.endswith(".prom"):
+            _mergeProm(files, output)
+        elif name.endswith((".log", ".jsonl")):
+            # logs are concatenated in order of shards
+            with open(output, "wb") as out_file:
+                for f in files:
+                    with open(f, "rb") as inp:
+                        out_file.write(inp.read())
+        else:
+            # configuration files, must be same for all shards
+            for f in files[1:]:
+                if not filecmp.cmp(files[0], f, shallow=False):
+                    logger.warning("{}: Differs from {}, first kept"
+                                   .format(f, files[0]))
+            placement.place(files[0], output)
+    return sorted(names.intersection(derived_code))
+
+
+def _rebuildCode(dest: str, derived: list) -> None:
+    """
+    Rebuilds tree and catalogue of merged dataset, if they
+    were built for shards
+    """
+    if not derived:
+        return
+    tree = crawler.Tree(dest)
+    code = os.path.join(dest, "code", "bidsme")
+    if crawler.tree_name in derived:
+        tree.save(os.path.join(code, crawler.tree_name))
+    if any(name.startswith(catalogue.catalogue_base) for name in derived):
+        catalogue.build(dest, workers=os.cpu_count(), tree=tree)
+
+
+def merge(shards: list, destination: str) -> dict:
+    """
+    Merges datasets produced from shards
+
+    Parameters:
+    -----------
+    shards: list
+        paths to datasets of shards, in order of shards
+    destination: str
+        path to merged dataset
+
+    Returns:
+    --------
+    dict:
+        number of merged subjects and files
+    """
+    os.makedirs(destination, exist_ok=True)
+    subjects = 0
+    files = 0
+    participants = ParticipantsTable()
+    template = None
+    for shard in shards:
+        for entry in sorted(os.scandir(shard), key=lambda e: e.name):
+            if entry.name in ("participants.tsv", "code"):
+                continue
+            if entry.name == "participants.json" and template is None:
+                template = loadTemplate(entry.path)
+            if entry.is_dir():
+                # subjects are exclusive to shards
+                exclusive = entry.name.startswith("sub-")
+                subjects += exclusive
+                files += _placeTree(entry.path,
+                                    os.path.join(destination, entry.name),
+                                    exclusive)
+            else:
+                dst = os.path.join(destination, entry.name)
+                if not os.path.exists(dst):
+                    placement.place(entry.path, dst)
+                    files += 1
+                elif not filecmp.cmp(entry.path, dst, shallow=False):
+                    logger.warning("{}: Differs from {}, first kept"
+                                   .format(entry.path, dst))
+        participants.load(os.path.join(shard, "participants.tsv"))
+
+    if len(participants):
+        participants.write(os.path.join(destination, "participants.tsv"),
+                           template)
+    _rebuildCode(destination, _mergeCode(shards, destination))
+    logger.info("Merged {} shards: {} subjects, {} files"
+                .format(len(shards), subjects, files))
+    return {"shards": len(shards), "subjects": subjects, "files": files}
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+            description="Splits dataset into shards of subjects, "
+                        "and merges datasets of shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("split", help="splits source dataset")
+    cmd.add_argument("source", help="path to source dataset")
+    cmd.add_argument("destination", help="folder where shards are created")
+    cmd.add_argument("-n", "--shards", type=int, required=True,
+                     help="number of shards")
+    cmd.add_argument("--method", choices=("hash", "folder"),
+                     default="hash",
+                     help="assignment of subjects to shards")
+
+    cmd = commands.add_parser("merge", help="merges datasets of shards")
+    cmd.add_argument("shards", nargs="+",
+                     help="paths to datasets of shards")
+    cmd.add_argument("-o", "--output", required=True,
+                     help="path to merged dataset")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s %(name)s: %(message)s")
+    if args.command == "split":
+        split(args.source, args.destination, args.shards, args.method)
+    else:
+        merge(args.shards, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+import re
+import json
+import logging
+
+"""
+sidecar defines a streaming reader for json files created by
+hmri toolbox. The json files contains the full dump of Dicom
+header, while only few fields are needed to identify recordings.
+
+The reader decodes only requested key paths, skipping all other
+values without decoding them, and stops reading the file as soon
+as all requested fields are found.
+
+The file is read by chunks, and only the part of it starting at
+current token is kept in memory: a container value (object or list)
+being skipped or decoded is held whole, so memory use is bounded by
+the size of the largest such value, not by the size of file.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# path to the Dicom header in hmri json file
+acqpar_root = ("acqpar", 0)
+
+# fields used in bidsmap for recordings identification
+hmri_fields = ("ProtocolName", "ImageType", "AcquisitionNumber",
+               "RepetitionTime", "EchoTime", "EchoNumbers")
+
+# size of read chunks
+chunk_size = 4096
+
+_ws = re.compile(r"\s*")
+_string_stop = re.compile(r'["\\]')
+_struct_stop = re.compile(r'[\[\]{}"]')
+_scalar_stop = re.compile(r"[,\]}\s]")
+# string, with unrolled escapes loop
+_string = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+# scalar value, or list of numbers
+_flat_value = r'(?:' + _string + r'|\[[^\[\]{}"]*\]|[^\s,\]}\[{"]+)'
+# key: scalar pair, runs of consecutive pairs are skipped in one match
+_flat_pair = _string + r'\s*:\s*' + _flat_value + r'\s*,'
+
+# key of trie node storing the requested path of node value,
+# when sub-paths of same value are also requested
+_whole = ...
+
+
+class _Done(Exception):
+    """
+    Raised when all requested fields are found
+    """
+    pass
+
+
+class _Reader(object):
+    """
+    Incremental json tokenizer over a text file
+
+    self.pos is the anchor of the current token: reading more
+    data discards the buffer before it, so all positions used
+    during token scan are relative to buffer
+    """
+    def __init__(self, f, chunk: int):
+        self.f = f
+        self.chunk = chunk
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _more(self) -> int:
+        """
+        Reads next chunk, returns the shift of buffer positions
+        """
+        if self.eof:
+            raise ValueError("Unexpected end of file")
+        data = self.f.read(self.chunk)
+        if not data:
+            self.eof = True
+            return 0
+        shift = self.pos
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return shift
+
+    def _search(self, regex, i: int):
+        """
+        Searches regex from position i, reading more data if needed
+        """
+        while True:
+            m = regex.search(self.buf, i)
+            if m is not None:
+                return m
+            i = max(i, len(self.buf))
+            i -= self._more()
+
+    def peek(self) -> str:
+        """
+        Skips whitespaces and returns next character
+        """
+        while True:
+            self.pos = _ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._more()
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError("Expected '{}' at '{}'"
+                             .format(char, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def _stringEnd(self, i: int) -> int:
+        """
+        Returns end of string starting at position i
+        """
+        i += 1
+        while True:
+            m = self._search(_string_stop, i)
+            if m.group() == '"':
+                return m.end()
+            i = m.end() + 1
+
+    def _valueEnd(self) -> int:
+        """
+        Returns end of value starting at current position
+        """
+        c = self.peek()
+        if c == '"':
+            return self._stringEnd(self.pos)
+        if c in "{[":
+            depth = 0
+            i = self.pos
+            while True:
+                m = self._search(_struct_stop, i)
+                c = m.group()
+                if c == '"':
+                    i = self._stringEnd(m.start())
+                    continue
+                i = m.end()
+                if c in "{[":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return i
+        try:
+            return self._search(_scalar_stop, self.pos + 1).start()
+        except ValueError:
+            if self.eof:
+                return len(self.buf)
+            raise
+
+    def skip(self) -> None:
+        self.pos = self._valueEnd()
+
+    def decode(self):
+        end = self._valueEnd()
+        value = json.loads(self.buf[self.pos:end])
+        self.pos = end
+        return value
+
+
+def _buildTrie(paths: list) -> dict:
+    """
+    Builds tree of requested paths, leafs contains the path.
+    If both a path and its sub-paths are requested, the path
+    is stored in node under _whole key
+    """
+    trie = dict()
+    for path in paths:
+        node = trie
+        for key in path[:-1]:
+            sub = node.get(key)
+            if sub is None:
+                sub = node[key] = dict()
+            elif not isinstance(sub, dict):
+                sub = node[key] = {_whole: sub}
+            node = sub
+        if isinstance(node.get(path[-1]), dict):
+            node[path[-1]][_whole] = path
+        else:
+            node[path[-1]] = path
+    _compileKeys(trie)
+    return trie
+
+
+def _keysPattern(keys: list) -> str:
+    return "|".join(re.escape(json.dumps(k)[1:-1]) for k in keys)
+
+
+def _compileKeys(node: dict) -> None:
+    """
+    Stores under None key of each node the regex matching
+    the pairs of requested keys with scalar value, and the
+    regex matching runs of pairs that can be skipped, which
+    stops before keys with requested sub-paths
+    """
+    leafs = list()
+    branches = list()
+    for k, sub in node.items():
+        if not isinstance(k, str):
+            continue
+        if isinstance(sub, dict):
+            branches.append(k)
+        else:
+            leafs.append(k)
+    keys = None
+    if leafs:
+        # keys must follow '{', ',' or whitespace, so they
+        # are never matched within string values
+        keys = re.compile(r'(?<![^{{,\s])"({})"\s*:\s*({})'
+                          .format(_keysPattern(leafs), _flat_value))
+    stop = ""
+    if branches:
+        stop = r'(?!"(?:{})"\s*:)'.format(_keysPattern(branches))
+    node[None] = (keys, re.compile(r'(?:\s*' + stop + _flat_pair + r')*'))
+    for k, sub in node.items():
+        if isinstance(sub, dict):
+            _compileKeys(sub)
+
+
+def _store(path: tuple, value, result: dict, remaining: list) -> None:
+    """
+    Stores decoded value of requested path
+    """
+    result[path] = value
+    remaining[0] -= 1
+    if remaining[0] == 0:
+        raise _Done()
+
+
+def _extract(value, node, result: dict, remaining: list) -> None:
+    """
+    Stores requested paths from already decoded value
+    """
+    if not isinstance(node, dict):
+        _store(node, value, result, remaining)
+        return
+    for key, sub in node.items():
+        if key is None:
+            continue
+        if key is _whole:
+            _store(sub, value, result, remaining)
+        elif isinstance(key, str) and isinstance(value, dict):
+            if key in value:
+                _extract(value[key], sub, result, remaining)
+        elif isinstance(key, int) and isinstance(value, list):
+            if key < len(value):
+                _extract(value[key], sub, result, remaining)
+
+
+def _walk(reader: _Reader, node, result: dict, remaining: list) -> None:
+    """
+    Walks through current value, decoding the requested paths
+    """
+    if node is None:
+        reader.skip()
+        return
+    if not isinstance(node, dict) or _whole in node:
+        # node is the requested path, or value is requested
+        # together with its sub-paths
+        _extract(reader.decode(), node, result, remaining)
+        return
+
+    c = reader.peek()
+    if c == "{":
+        reader.pos += 1
+        if reader.peek() == "}":
+            reader.pos += 1
+            return
+        keys, flat_run = node[None]
+        while True:
+            # fast path, skipping pairs with scalar values in one
+            # match, and decoding only the requested ones; pairs
+            # with requested sub-paths go through slow path
+            run = flat_run.match(reader.buf, reader.pos).end()
+            if run > reader.pos:
+                if keys is not None:
+                    for m in keys.finditer(reader.buf, reader.pos, run):
+                        path = node[json.loads('"' + m.group(1) + '"')]
+                        _store(path, json.loads(m.group(2)),
+                               result, remaining)
+                reader.pos = run
+            # slow path, for containers and last pair of object
+            reader.peek()
+            end = reader._stringEnd(reader.pos)
+            key = json.loads(reader.buf[reader.pos:end])
+            reader.pos = end
+            reader.expect(":")
+            _walk(reader, node.get(key), result, remaining)
+            c = reader.peek()
+            reader.pos += 1
+            if c == "}":
+                return
+    elif c == "[":
+        reader.pos += 1
+        if reader.peek() == "]":
+            reader.pos += 1
+            return
+        index = 0
+        while True:
+            _walk(reader, node.get(index), result, remaining)
+            index += 1
+            c = reader.peek()
+            reader.pos += 1
+            if c == "]":
+                return
+    else:
+        reader.skip()
+
+
+def readPaths(path: str, paths: list) -> dict:
+    """
+    Reads values of requested key paths from json file
+
+    Parameters:
+    -----------
+    path: str
+        path to json file
+    paths: list of tuples
+        list of key paths, each path is a tuple of dictionary
+        keys and list indexes, for ex. ("acqpar", 0, "EchoTime")
+
+    Returns:
+    --------
+    dict:
+        path: value dictionary, missing paths are not included
+    """
+    paths = [tuple(p) for p in paths]
+    result = dict()
+    if not paths:
+        return result
+    remaining = [len(set(paths))]
+    with open(path, "r", encoding="utf-8") as f:
+        reader = _Reader(f, chunk_size)
+        try:
+            _walk(reader, _buildTrie(paths), result, remaining)
+        except _Done:
+            pass
+    return result
+
+
+def readFields(path: str, fields: tuple = hmri_fields,
+               root: tuple = acqpar_root) -> dict:
+    """
+    Reads requested Dicom fields from hmri json file
+
+    Parameters:
+    -----------
+    path: str
+        path to json file
+    fields: tuple
+        names of fields to retrieve
+    root: tuple
+        key path to Dicom header in json
+
+    Returns:
+    --------
+    dict:
+        field: value dictionary, missing fields are set to None
+    """
+    values = readPaths(path, [root + (f,) for f in fields])
+    return {f: values.get(root + (f,)) for f in fields}
+
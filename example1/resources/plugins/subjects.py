@@ -0,0 +1,124 @@
+import logging
+
+from indexcache import loadIndex
+
+"""
+subjects defines the compiled index of the participants bookkeeping
+table (Appariement.xlsx). The excel table is parsed only once, and
+the resulting hash index is stored in a binary sidecar file next to
+the table (see indexcache). The sidecar is invalidated if table
+changes.
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# version of index format, must be increased each time
+# the structure of index records changes
+index_version = 1
+
+# subject xls table columns and their renaming
+excel_col_list = {"Patient": "pat",
+                  "Sex": "pat_sex",
+                  "Age": "pat_age",
+                  "Education": "pat_edu",
+                  1: "pat_1", 2: "pat_2", 3: "pat_3",
+                  'Control': "cnt",
+                  "Sex.1": "cnt_sex",
+                  "Age.1": "cnt_age",
+                  "Education.1": "cnt_edu",
+                  "1.1": "cnt_1", "2.1": "cnt_2", "3.1": "cnt_3"
+                  }
+
+# columns prefixes and corresponding participant groups,
+# in order of priority of lookup
+groups = (("pat", "patient"), ("cnt", "control"))
+
+# suffixes of columns with session names, in order of sessions
+session_cols = ("_1", "_2", "_3")
+
+
+def loadSubjects(subject_file: str, columns: dict = excel_col_list) -> dict:
+    """
+    Loads subjects index from compiled sidecar, if it is
+    up to date, otherwise compiles it from excel table
+
+    Parameters:
+    -----------
+    subject_file: str
+        path to excel subjects table
+    columns: dict
+        renaming of excel columns
+
+    Returns:
+    --------
+    dict:
+        subjects index, with subject id as key
+    """
+    signature = (index_version, repr(sorted(columns.items(), key=str)))
+    return loadIndex(subject_file, signature, compileSubjects, columns)
+
+
+def compileSubjects(subject_file: str,
+                    columns: dict = excel_col_list) -> dict:
+    """
+    Parses excel subjects table and compiles it into dictionary
+    of subject records.
+
+    Patient entries have priority over control entries, if subject
+    appears several times in the same column, the first entry is
+    retained, and number of occurences is stored in record
+
+    Parameters:
+    -----------
+    subject_file: str
+        path to excel subjects table
+    columns: dict
+        renaming of excel columns
+
+    Returns:
+    --------
+    dict:
+        subjects index, with subject id as key
+    """
+    import pandas
+
+    df = pandas.read_excel(subject_file,
+                           sheet_name=0, header=0,
+                           usecols="A:N"
+                           )
+    df.rename(index=str, columns=columns, inplace=True)
+    df = df[df['pat'].notnull() | df['cnt'].notnull()]
+
+    index = dict()
+    for prefix, group in groups:
+        other = [p for p, g in groups if p != prefix][0]
+        found = dict()
+        for row in df.to_dict("records"):
+            if pandas.isna(row[prefix]):
+                continue
+            sub_id = int(row[prefix])
+            if sub_id in found:
+                found[sub_id]["duplicates"] += 1
+                continue
+            sex = row[prefix + "_sex"]
+            age = row[prefix + "_age"]
+            education = row[prefix + "_edu"]
+            paired = row[other]
+            found[sub_id] = {
+                    "group": group,
+                    "sex": sex if pandas.notna(sex) else None,
+                    "age": float(age) if pandas.notna(age) else None,
+                    "education": float(education)
+                    if pandas.notna(education) else None,
+                    "paired": int(paired) if pandas.notna(paired) else None,
+                    "sessions": tuple(str(row[prefix + s]).strip()
+                                      for s in session_cols),
+                    "duplicates": 1
+                    }
+        for sub_id, record in found.items():
+            # subject found in higher priority column
+            if sub_id not in index:
+                index[sub_id] = record
+    return index
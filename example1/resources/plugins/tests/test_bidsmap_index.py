@@ -0,0 +1,132 @@
+import os
+import re
+import sys
+import shutil
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import bidsmap_index  # noqa: E402
+from bidsmap_index import literal, compileBidsmap, loadBidsmap  # noqa: E402
+from indexcache import index_ext  # noqa: E402
+
+"""
+Compares rules matched by compiled bidsmap index with rules matched
+by comparing recording with all rules in bidsmap order, and checks
+caching of compiled index
+"""
+
+bidsmap = os.path.join(os.path.dirname(__file__), "..", "..", "map",
+                       "bidsmap.yaml")
+
+
+def _linear(index, attributes: dict):
+    """
+    Returns first rule matching all attributes, as bidsme does
+    """
+    for rule in index.rules:
+        patterns = [(n, re.escape(v))
+                    for n, v in zip(rule.literals, rule.values)]
+        if all(re.fullmatch(p, bidsmap_index._value(attributes.get(n)))
+               for n, p in patterns + list(rule.patterns)):
+            return rule
+    return None
+
+
+def _attributes(index) -> list:
+    """
+    Returns attributes of recordings built from rules, with
+    some changed values
+    """
+    result = list()
+    for rule in index.rules:
+        attrs = dict(zip(rule.literals, rule.values))
+        result.append(attrs)
+        for name in rule.literals:
+            result.append(dict(attrs, **{name: attrs[name] + "x"}))
+            result.append({k: v for k, v in attrs.items() if k != name})
+        result.append(dict(attrs, **{"<<custom:IntendedFor>>": "invalid"}))
+    return result
+
+
+@pytest.mark.parametrize("pattern,value", [
+        ("localizer", "localizer"),
+        ("ORIGINAL\\\\PRIMARY", "ORIGINAL\\PRIMARY"),
+        ("a\\.b", "a.b"),
+        ("a.b", None),
+        ("(a|b)", None),
+        ("\\d+", None),
+        (12, "12"),
+        ])
+def test_literal(pattern, value):
+    assert literal(pattern) == value
+
+
+def test_example_bidsmap():
+    index = compileBidsmap(bidsmap)
+    assert len(index) > 0
+    for attrs in _attributes(index):
+        assert index.match(attrs) is _linear(index, attrs), attrs
+
+
+def test_patterns(tmp_path):
+    path = str(tmp_path / "bidsmap.yaml")
+    with open(path, "w") as f:
+        f.write("""MRI:
+  hmriNIFTI:
+    anat:
+      - suffix: T1w
+        attributes:
+          ProtocolName: 'mprage.*'
+          ImageType: 'ORIGINAL'
+      - suffix: T2w
+        attributes:
+          ProtocolName: 'mprage_t2'
+    func:
+      - suffix: bold
+        attributes:
+          ProtocolName: 'bold'
+      - suffix: sbref
+        attributes:
+          ProtocolName: 'bold'
+          ImageType: ''
+""")
+    index = compileBidsmap(path)
+    cases = [({"ProtocolName": "mprage_t2", "ImageType": "ORIGINAL"},
+              "T1w"),
+             ({"ProtocolName": "mprage_t2", "ImageType": "DERIVED"},
+              "T2w"),
+             ({"ProtocolName": "bold"}, "bold"),
+             ({"ProtocolName": " bold "}, "bold"),
+             ({"ProtocolName": "other"}, None)]
+    for attrs, suffix in cases:
+        rule = index.match(attrs)
+        assert (rule and rule.suffix) == suffix
+        assert rule is _linear(index, attrs)
+
+
+def test_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "bidsmap.yaml")
+    shutil.copy(bidsmap, path)
+    index = loadBidsmap(path)
+    assert os.path.isfile(path + index_ext)
+
+    def fail(*args):
+        raise AssertionError("index compiled again")
+
+    monkeypatch.setattr(bidsmap_index, "compileBidsmap", fail)
+    cached = loadBidsmap(path)
+    assert [repr(r) for r in cached.rules] == [repr(r) for r in index.rules]
+    # touched but unchanged file
+    os.utime(path, ns=(0, 0))
+    loadBidsmap(path)
+    monkeypatch.undo()
+
+    with open(path, "a") as f:
+        f.write("\n# modified\n")
+    calls = list()
+    monkeypatch.setattr(bidsmap_index, "compileBidsmap",
+                        lambda *args: calls.append(args) or index)
+    loadBidsmap(path)
+    assert len(calls) == 1
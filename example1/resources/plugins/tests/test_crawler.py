@@ -0,0 +1,125 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import crawler  # noqa: E402
+from crawler import Tree, crawl  # noqa: E402
+
+"""
+Compares crawled tree with filesystem, and checks that stored tree
+is updated when subjects and sessions change
+"""
+
+
+def _write(path: str, text: str = "x") -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = str(tmp_path / "source")
+    for sub in ("001", "002"):
+        for ses in ("s01", "s02"):
+            for name in ("a.nii", "a.json", ".hidden"):
+                _write(os.path.join(root, sub, ses, "nii", name), name)
+    _write(os.path.join(root, ".git", "config"))
+    _write(os.path.join(root, "README"), "readme")
+    return root
+
+
+def _walk(root: str) -> dict:
+    """
+    Lists files with os.walk, ignoring hidden ones
+    """
+    files = dict()
+    for folder, dirs, names in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in names:
+            if name.startswith("."):
+                continue
+            path = os.path.join(folder, name)
+            st = os.stat(path)
+            files[os.path.relpath(path, root)] = (st.st_size,
+                                                  st.st_mtime_ns)
+    return files
+
+
+def _files(tree: Tree, path: str) -> dict:
+    return {rel: (size, mtime) for rel, size, mtime in tree.files(path)}
+
+
+def test_queries(dataset):
+    tree = Tree(dataset)
+    assert _files(tree, dataset) == _walk(dataset)
+    assert tree.listdir(dataset) == ["001", "002", "README"]
+    assert tree.lsdirs(dataset) == [os.path.join(dataset, "001"),
+                                    os.path.join(dataset, "002")]
+    assert tree.lsdirs(dataset, "*2") == [os.path.join(dataset, "002")]
+    nii = os.path.join(dataset, "001", "s01", "nii")
+    assert tree.lsfiles(nii, "*.json") == [os.path.join(nii, "a.json")]
+    st = os.stat(os.path.join(nii, "a.nii"))
+    assert tree.stat(os.path.join(nii, "a.nii"))\
+        == (st.st_size, st.st_mtime_ns)
+    assert tree.isdir(nii) and not tree.isfile(nii)
+    assert tree.isfile(os.path.join(dataset, "README"))
+    assert not tree.exists(os.path.join(dataset, ".git"))
+    with pytest.raises(FileNotFoundError):
+        tree.listdir(os.path.join(dataset, "003"))
+    with pytest.raises(NotADirectoryError):
+        tree.listdir(os.path.join(dataset, "README"))
+    with pytest.raises(ValueError):
+        tree.exists(os.path.dirname(dataset))
+
+
+def test_stored_tree(dataset, tmp_path):
+    cache = str(tmp_path / crawler.tree_name)
+    tree = crawl(dataset, cache)
+    tree.save(cache)
+    assert Tree.load(cache, dataset).node == tree.node
+    # tree of other dataset
+    other = str(tmp_path / "other")
+    shutil.copytree(dataset, other)
+    assert Tree.load(cache, other) is None
+    assert crawl(other, cache).root == other
+    # invalid and missing trees
+    assert Tree.load(str(tmp_path / "missing"), dataset) is None
+    with open(cache, "wb") as f:
+        f.write(b"invalid")
+    assert Tree.load(cache, dataset) is None
+
+
+def test_check(dataset, tmp_path):
+    cache = str(tmp_path / crawler.tree_name)
+    Tree(dataset).save(cache)
+
+    # new session, removed session, new subject
+    _write(os.path.join(dataset, "001", "s03", "nii", "b.nii"))
+    shutil.rmtree(os.path.join(dataset, "002", "s01"))
+    _write(os.path.join(dataset, "003", "s01", "nii", "c.nii"))
+    # forcing change of modification time of folders
+    for folder in ("", "001", "002"):
+        os.utime(os.path.join(dataset, folder), ns=(1, 1))
+
+    tree = crawl(dataset, cache)
+    assert _files(tree, dataset) == _walk(dataset)
+    assert tree.node == Tree(dataset).node
+
+
+def test_refresh(dataset):
+    tree = Tree(dataset)
+    nii = os.path.join(dataset, "002", "s02", "nii")
+    assert not tree.refresh(nii)
+    os.remove(os.path.join(nii, "a.json"))
+    _write(os.path.join(nii, "b.json"))
+    os.utime(nii, ns=(1, 1))
+    assert tree.refresh(nii)
+    assert tree.listdir(nii) == ["a.nii", "b.json"]
+    shutil.rmtree(nii)
+    assert tree.refresh(nii)
+    assert not tree.exists(nii)
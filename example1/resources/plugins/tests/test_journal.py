@@ -0,0 +1,106 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import journal  # noqa: E402
+from journal import Journal, tmpName  # noqa: E402
+
+"""
+Simulates runs interrupted at each state of journaled operation,
+and checks that next run, resumed or not, recovers them
+"""
+
+
+def _touch(path: str, text: str = "x") -> None:
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _operation(tmp_path):
+    path = str(tmp_path / "code" / ("test" + journal.journal_suffix))
+    inputs = [str(tmp_path / "in-1.nii"), str(tmp_path / "in-2.nii")]
+    outputs = [str(tmp_path / "4D.nii"), str(tmp_path / "4D.json")]
+    for f in inputs:
+        _touch(f)
+    return path, inputs, outputs
+
+
+def test_interrupted_before_commit(tmp_path):
+    path, inputs, outputs = _operation(tmp_path)
+    jr = Journal(path, resume=False)
+    jr.begin("seq", outputs, inputs)
+    # first output renamed, second one partially written
+    _touch(outputs[0])
+    _touch(tmpName(outputs[1]))
+    jr.close()
+
+    for resume in (True, False):
+        jr = Journal(path, resume)
+        assert jr.recover("seq") is None
+        jr.close()
+        for f in outputs:
+            assert not os.path.exists(f)
+            assert not os.path.exists(tmpName(f))
+        for f in inputs:
+            assert os.path.exists(f)
+
+
+def test_interrupted_after_commit(tmp_path):
+    path, inputs, outputs = _operation(tmp_path)
+    jr = Journal(path, resume=False)
+    jr.begin("seq", outputs, inputs)
+    for f in outputs:
+        _touch(f)
+    jr.commit("seq", volumes=2)
+    os.remove(inputs[0])
+    jr.close()
+
+    jr = Journal(path, resume=False)
+    assert jr.recover("seq") == "done"
+    assert jr.entries["seq"]["volumes"] == 2
+    jr.close()
+    for f in inputs:
+        assert not os.path.exists(f)
+    for f in outputs:
+        assert os.path.exists(f)
+
+
+def test_done_operations(tmp_path):
+    path, inputs, outputs = _operation(tmp_path)
+    jr = Journal(path, resume=False)
+    jr.begin("seq", outputs, inputs)
+    jr.commit("seq")
+    jr.removeInputs("seq")
+    jr.begin("other", [], [])
+    jr.close()
+
+    jr = Journal(path, resume=True)
+    assert jr.status("seq") == "done"
+    jr.close()
+    # not resumed run forgets done operations, but keeps
+    # the interrupted ones
+    jr = Journal(path, resume=False)
+    assert jr.status("seq") is None
+    assert jr.status("other") == "begin"
+    jr.close()
+    jr = Journal(path, resume=True)
+    assert jr.status("seq") is None
+    assert jr.status("other") == "begin"
+    jr.close()
+
+
+def test_invalid_entry(tmp_path):
+    path, inputs, outputs = _operation(tmp_path)
+    jr = Journal(path, resume=False)
+    jr.begin("seq", outputs, inputs)
+    jr.close()
+    with open(path, "a") as f:
+        f.write('{"key": "seq", "sta')
+    jr = Journal(path, resume=True)
+    assert jr.status("seq") == "begin"
+    jr.commit("seq")
+    jr.close()
+    jr = Journal(path, resume=True)
+    assert jr.status("seq") == "commit"
+    jr.close()
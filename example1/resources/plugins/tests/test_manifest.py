@@ -0,0 +1,64 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import crawler  # noqa: E402
+from manifest import Manifest, fingerprint, manifest_name  # noqa: E402
+
+"""
+Checks that fingerprint of session changes with its files and
+parameters, and that manifest skips only unchanged sessions
+"""
+
+
+def _session(root) -> str:
+    path = root / "sub-001" / "s01234"
+    (path / "nii").mkdir(parents=True)
+    (path / "nii" / "f1.nii").write_text("x")
+    (path / "inp").mkdir()
+    (path / "inp" / "VAS.tsv").write_text("a\tb\n")
+    return str(path)
+
+
+def test_fingerprint(tmp_path):
+    path = _session(tmp_path)
+    fp = fingerprint(path, {"age": 20}, "ses-HCL")
+    assert fingerprint(path, {"age": 20}, "ses-HCL") == fp
+    # crawled tree gives same fingerprint as filesystem
+    tree = crawler.Tree(str(tmp_path))
+    assert fingerprint(path, {"age": 20}, "ses-HCL", tree=tree) == fp
+
+    # subject record and parameters
+    assert fingerprint(path, {"age": 21}, "ses-HCL") != fp
+    assert fingerprint(path, {"age": 20}, "ses-HCL", ("digest",)) != fp
+
+    # added, modified and hidden files
+    with open(os.path.join(path, "nii", "f1.nii"), "a") as f:
+        f.write("y")
+    fp2 = fingerprint(path, {"age": 20}, "ses-HCL")
+    assert fp2 != fp
+    with open(os.path.join(path, "nii", ".hidden"), "w") as f:
+        f.write("y")
+    assert fingerprint(path, {"age": 20}, "ses-HCL") == fp2
+    with open(os.path.join(path, "nii", "f2.nii"), "w") as f:
+        f.write("y")
+    assert fingerprint(path, {"age": 20}, "ses-HCL") != fp2
+
+
+def test_manifest(tmp_path):
+    path = str(tmp_path / "code" / manifest_name)
+    manifest = Manifest(path)
+    assert not manifest.unchanged("sub-001/s01234", "a")
+    manifest.update("sub-001/s01234", "a", session="ses-HCL")
+    manifest.update("sub-001/s01235", "b")
+    manifest.update("sub-001/s01234", "c")
+
+    manifest = Manifest(path)
+    assert manifest.unchanged("sub-001/s01234", "c")
+    assert not manifest.unchanged("sub-001/s01234", "a")
+    assert manifest.unchanged("sub-001/s01235", "b")
+    manifest.compact()
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+    assert Manifest(path).entries == manifest.entries
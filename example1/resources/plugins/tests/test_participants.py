@@ -0,0 +1,73 @@
+import os
+import sys
+import math
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from participants import ParticipantsTable  # noqa: E402
+
+"""
+Writes participants table, and checks merging with existing
+participants.tsv, as done by plugins ExitEP
+"""
+
+
+def _read(path: str) -> list:
+    with open(path, "r") as f:
+        return [line.rstrip("\n").split("\t") for line in f]
+
+
+def _writeTsv(path: str, rows: list) -> None:
+    with open(path, "w") as f:
+        for row in rows:
+            f.write("\t".join(row) + "\n")
+
+
+def test_write(tmp_path):
+    path = str(tmp_path / "participants.tsv")
+    table = ParticipantsTable()
+    table.add("002", {"age": 30, "score": 1.5, "group": "control"})
+    table.add("sub-001", {"age": 25.0, "score": math.inf, "group": None})
+    table.add("sub-003", {"age": "n/a", "score": -math.inf})
+    template = {"participant_id": {}, "group": {}, "age": {}, "score": {}}
+    table.write(path, template)
+    assert _read(path) == [["participant_id", "group", "age", "score"],
+                           ["sub-001", "n/a", "25", "inf"],
+                           ["sub-002", "control", "30", "1.5"],
+                           ["sub-003", "n/a", "n/a", "-inf"]]
+    with open(str(tmp_path / "participants.json")) as f:
+        assert list(json.load(f)) == list(template)
+
+
+def test_load_keeps_text(tmp_path):
+    path = str(tmp_path / "participants.tsv")
+    _writeTsv(path, [["participant_id", "id", "height", "empty"],
+                     ["sub-001", "007", "1.50", "n/a"]])
+    table = ParticipantsTable()
+    table.load(path)
+    table.add("sub-002", {"id": 8, "height": 1.7})
+    table.write(path)
+    assert _read(path) == [["participant_id", "id", "height", "empty"],
+                           ["sub-001", "007", "1.50", "n/a"],
+                           ["sub-002", "8", "1.7", "n/a"]]
+
+
+def test_merge_with_bidsme_table(tmp_path):
+    path = str(tmp_path / "participants.tsv")
+    table = ParticipantsTable()
+    table.add("sub-001", {"sex": "F", "age": 20})
+    # value cleared by plugin
+    table.add("sub-001", {"sex": None})
+    table.add("sub-002", {"sex": "M"})
+    # table written by bidsme, before plugin ExitEP
+    _writeTsv(path, [["participant_id", "sex", "age", "group"],
+                     ["sub-001", "F", "21", "patient"],
+                     ["sub-002", "n/a", "30", "control"],
+                     ["sub-003", "F", "40", "n/a"]])
+    table.load(path, update=False)
+    table.write(path)
+    assert _read(path) == [["participant_id", "sex", "age", "group"],
+                           ["sub-001", "n/a", "20", "patient"],
+                           ["sub-002", "M", "30", "control"],
+                           ["sub-003", "F", "40", "n/a"]]
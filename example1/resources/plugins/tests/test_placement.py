@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import placement  # noqa: E402
+from journal import tmpName  # noqa: E402
+
+"""
+Places files with each method, and checks content of placed
+files and absence of temporary files
+"""
+
+
+@pytest.fixture(autouse=True)
+def strategy():
+    saved = placement.strategy
+    yield
+    placement.setStrategy(saved)
+
+
+def _source(tmp_path) -> str:
+    path = str(tmp_path / "source.json")
+    with open(path, "w") as f:
+        f.write('{"a": 1}')
+    return path
+
+
+def _content(path: str) -> str:
+    with open(path, "r") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("method", ("auto", "hardlink", "copy"))
+def test_place(tmp_path, method):
+    placement.setStrategy(method)
+    source = _source(tmp_path)
+    out = tmp_path / "out"
+    out.mkdir()
+    dest = placement.place(source, str(out))
+    assert dest == str(out / "source.json")
+    assert _content(dest) == _content(source)
+    # placing again replaces file
+    assert placement.place(source, dest) == dest
+    assert sorted(os.listdir(str(out))) == ["source.json"]
+    if method == "hardlink":
+        assert os.path.samefile(source, dest)
+    elif method == "copy":
+        assert not os.path.samefile(source, dest)
+
+
+def test_replace_with_other_content(tmp_path):
+    placement.setStrategy("copy")
+    source = _source(tmp_path)
+    dest = str(tmp_path / "dest.json")
+    with open(dest, "w") as f:
+        f.write("old")
+    placement.place(source, dest)
+    assert _content(dest) == '{"a": 1}'
+    assert not os.path.lexists(tmpName(dest))
+
+
+def test_invalid_strategy():
+    with pytest.raises(ValueError):
+        placement.setStrategy("move")
+
+
+def test_failed_placement(tmp_path):
+    placement.setStrategy("hardlink")
+    with pytest.raises(OSError):
+        placement.place(str(tmp_path / "missing"),
+                        str(tmp_path / "dest"))
+    assert not os.path.lexists(tmpName(str(tmp_path / "dest")))
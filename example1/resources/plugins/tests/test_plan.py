@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import plan  # noqa: E402
+import crawler  # noqa: E402
+from definitions import Series  # noqa: E402
+
+"""
+Builds plan of prepared sessions, and checks that stored plan is
+reused until session MRI folder changes
+"""
+
+
+def _session(tmp_path, session: str, series: tuple = None) -> str:
+    path = tmp_path / "sub-001" / session
+    for ind, name in enumerate(series or Series[session], 1):
+        (path / "MRI" / "{:03d}-{}".format(ind, name)).mkdir(parents=True)
+    return str(path)
+
+
+def _noBuild(*args):
+    raise AssertionError("plan built again")
+
+
+def test_resolve():
+    sequences = plan.resolve(list(Series["ses-HCL"]), "ses-HCL")
+    roles = [(s["name"], s["role"], s["intended_for"]) for s in sequences]
+    assert roles[1] == ("cmrr_mbep2d_bold_mb2_invertpe", "reversed",
+                        "nBack")
+    assert roles[3] == ("cmrr_mbep2d_bold_mb2_invertpe", "reversed",
+                        "rest")
+    assert roles[5] == ("gre_field_mapping", "fieldmap", "HCL/LCL")
+
+    sequences = plan.resolve(list(Series["ses-STROOP"]), "ses-STROOP")
+    assert [s["intended_for"] for s in sequences[1:3]] == ["PDw", "PDw"]
+    assert sequences[1]["reference"] == "al_mtflash3d_PDw"
+    # identifying sequence missing at end of session
+    sequences = plan.resolve(["cmrr_mbep2d_bold_mb2_invertpe"], "ses-LCL")
+    assert sequences[0]["intended_for"] == plan.invalid
+
+
+@pytest.mark.parametrize("use_tree", (False, True))
+def test_load(tmp_path, monkeypatch, use_tree):
+    path = _session(tmp_path, "ses-HCL")
+    tree = crawler.Tree(str(tmp_path)) if use_tree else None
+    built = plan.loadPlan(path, "ses-HCL", tree=tree)
+    assert os.path.isfile(os.path.join(path, plan.plan_name))
+    assert [s["folder"] for s in built["sequences"]]\
+        == sorted(os.listdir(os.path.join(path, "MRI")))
+    assert built["validation"]["violations"] == []
+
+    monkeypatch.setattr(plan, "buildPlan", _noBuild)
+    assert plan.loadPlan(path, "ses-HCL", tree=tree) == built
+
+
+def test_outdated(tmp_path, monkeypatch):
+    path = _session(tmp_path, "ses-LCL")
+    plan.loadPlan(path, "ses-LCL")
+    plan_file = os.path.join(path, plan.plan_name)
+
+    # new sequence folder
+    os.mkdir(os.path.join(path, "MRI", "010-localizer"))
+    os.utime(os.path.join(path, "MRI"), ns=(1, 1))
+    rebuilt = plan.loadPlan(path, "ses-LCL")
+    assert rebuilt["sequences"][-1]["folder"] == "010-localizer"
+    assert rebuilt["validation"]["violations"]
+
+    # other session name and plan version
+    assert plan.loadPlan(path, "ses-HCL")["session"] == "ses-HCL"
+    with open(plan_file) as f:
+        stored = json.load(f)
+    stored["version"] -= 1
+    with open(plan_file, "w") as f:
+        json.dump(stored, f)
+    assert plan.loadPlan(path, "ses-HCL")["version"] == plan.plan_version
+
+    # invalid plan file, not saved
+    with open(plan_file, "w") as f:
+        f.write("{")
+    assert plan.loadPlan(path, "ses-HCL", save=False)["session"]\
+        == "ses-HCL"
+    with open(plan_file) as f:
+        assert f.read() == "{"
@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import shard  # noqa: E402
+import crawler  # noqa: E402
+import catalogue  # noqa: E402
+
+"""
+Merges datasets of shards, and checks merged subjects, logs and
+derived code/bidsme files
+"""
+
+
+def _write(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _shard(root: str, subject: str) -> str:
+    path = os.path.join(root, subject + "-shard")
+    func = os.path.join(path, subject, "ses-A", "func")
+    _write(os.path.join(func, subject + "_ses-A_bold.nii"), subject)
+    _write(os.path.join(func, subject + "_ses-A_bold.json"),
+           json.dumps({"RepetitionTime": 2.0}))
+    _write(os.path.join(path, "participants.tsv"),
+           "participant_id\n{}\n".format(subject))
+    _write(os.path.join(path, "dataset_description.json"), "{}")
+    code = os.path.join(path, "code", "bidsme")
+    _write(os.path.join(code, "bidsify_plugin.log"), subject + "\n")
+    crawler.Tree(path).save(os.path.join(code, crawler.tree_name))
+    catalogue.build(path, workers=1)
+    return path
+
+
+def test_split(tmp_path):
+    source = tmp_path / "source"
+    for sub in ("001", "002", "003"):
+        (source / sub).mkdir(parents=True)
+    shards = shard.split(str(source), str(tmp_path / "shards"), 2,
+                         "folder")
+    assert sorted(sum(shards.values(), [])) == ["001", "002", "003"]
+    for name, subs in shards.items():
+        assert sorted(os.listdir(str(tmp_path / "shards" / name
+                                     / "source"))) == subs
+
+
+def test_merge(tmp_path, caplog):
+    shards = [_shard(str(tmp_path), sub) for sub in ("sub-001", "sub-002")]
+    dest = str(tmp_path / "bids")
+    with caplog.at_level(logging.WARNING):
+        res = shard.merge(shards, dest)
+    assert not caplog.records
+    assert res["subjects"] == 2
+    for sub in ("sub-001", "sub-002"):
+        assert os.path.isfile(os.path.join(dest, sub, "ses-A", "func",
+                                           sub + "_ses-A_bold.nii"))
+    with open(os.path.join(dest, "participants.tsv")) as f:
+        assert [line.split("\t")[0].strip() for line in f] ==\
+            ["participant_id", "sub-001", "sub-002"]
+
+    code = os.path.join(dest, "code", "bidsme")
+    with open(os.path.join(code, "bidsify_plugin.log")) as f:
+        assert f.read() == "sub-001\nsub-002\n"
+    # tree and catalogue describe merged dataset
+    tree = crawler.Tree.load(os.path.join(code, crawler.tree_name), dest)
+    assert tree is not None
+    assert tree.isdir(os.path.join(dest, "sub-002", "ses-A", "func"))
+    cat = catalogue.Catalogue.load(dest, catalogue.cataloguePath(dest))
+    for sub in ("sub-001", "sub-002"):
+        sidecar = os.path.join(dest, sub, "ses-A", "func",
+                               sub + "_ses-A_bold.json")
+        assert cat.get(sidecar, *tree.stat(sidecar)) is not None
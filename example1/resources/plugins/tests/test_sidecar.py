@@ -0,0 +1,111 @@
+import os
+import sys
+import glob
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import sidecar  # noqa: E402
+
+"""
+Compares values read by sidecar.readPaths with values decoded by
+json.load, for different sizes of read chunks
+"""
+
+source = os.path.join(os.path.dirname(__file__), "..", "..", "..",
+                      "source")
+
+chunk_sizes = (1, 2, 3, 7, 64, 4096)
+
+documents = [
+        {"a": [1, 2, 3], "b": 2},
+        {"a": {"b": 1, "c": [1, {"d": "x"}]}, "e": "f, \"a\": 3"},
+        {"x\"a": 1, "a": 2, "s": "x \"a\": 5", "l": [[1], {"a": 4}]},
+        {"a": {}, "b": [], "c": [{}], "d": None, "e": True, "f": -1.5e3},
+        [{"a": 1}, [2, 3], "4"],
+        ]
+
+
+def _paths(value, prefix=()) -> list:
+    """
+    Returns all key paths of decoded value, with some
+    missing ones
+    """
+    paths = [prefix + ("missing",), prefix + (7,)]
+    if prefix:
+        paths.append(prefix)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            paths.extend(_paths(v, prefix + (k,)))
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            paths.extend(_paths(v, prefix + (i,)))
+    return paths
+
+
+def _get(value, path: tuple):
+    for key in path:
+        if isinstance(key, str) and isinstance(value, dict)\
+                and key in value:
+            value = value[key]
+        elif isinstance(key, int) and isinstance(value, list)\
+                and key < len(value):
+            value = value[key]
+        else:
+            raise KeyError(path)
+    return value
+
+
+def _expected(value, paths: list) -> dict:
+    result = dict()
+    for path in paths:
+        try:
+            result[path] = _get(value, path)
+        except KeyError:
+            pass
+    return result
+
+
+def _check(path: str, value, paths: list, monkeypatch) -> None:
+    expected = _expected(value, paths)
+    for size in chunk_sizes:
+        monkeypatch.setattr(sidecar, "chunk_size", size)
+        assert sidecar.readPaths(path, paths) == expected, size
+
+
+@pytest.mark.parametrize("doc", documents)
+def test_all_paths(doc, tmp_path, monkeypatch):
+    path = str(tmp_path / "doc.json")
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=1)
+    paths = _paths(doc)
+    _check(path, doc, paths, monkeypatch)
+    # each path alone, and each path with its sub-paths
+    for p in paths:
+        _check(path, doc, [p], monkeypatch)
+        _check(path, doc, [q for q in paths if q[:len(p)] == p],
+               monkeypatch)
+
+
+def test_sub_path_of_flat_list(tmp_path, monkeypatch):
+    path = str(tmp_path / "doc.json")
+    with open(path, "w") as f:
+        f.write('{"a":[1,2,3],"b":2}')
+    for size in chunk_sizes:
+        monkeypatch.setattr(sidecar, "chunk_size", size)
+        assert sidecar.readPaths(path, [("a", 1)]) == {("a", 1): 2}
+        assert sidecar.readPaths(path, [("a",), ("a", 1)])\
+            == {("a",): [1, 2, 3], ("a", 1): 2}
+
+
+@pytest.mark.parametrize("path", sorted(glob.glob(
+        os.path.join(source, "*", "*", "nii", "*.json")))[:4])
+def test_hmri_sidecars(path, monkeypatch):
+    with open(path, "r") as f:
+        value = json.load(f)
+    paths = [sidecar.acqpar_root + (f,) for f in sidecar.hmri_fields]
+    paths += [("acqpar",), ("acqpar", 0, "ImageType", 1),
+              ("history",)]
+    _check(path, value, paths, monkeypatch)
@@ -0,0 +1,73 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import definitions  # noqa: E402
+import plan  # noqa: E402
+from definitions import Series, validateFolders  # noqa: E402
+
+"""
+Checks that validation of session series is stored in session plan,
+and redone only if series or their definitions change
+"""
+
+
+def _folders(series: tuple) -> list:
+    return ["{:03d}-{}".format(ind, name)
+            for ind, name in enumerate(series, 1)]
+
+
+def _counting(monkeypatch) -> list:
+    calls = list()
+    validate = definitions.validateSeries
+
+    def counted(series, session):
+        calls.append(session)
+        return validate(series, session)
+
+    monkeypatch.setattr(definitions, "validateSeries", counted)
+    return calls
+
+
+def test_validate_folders(monkeypatch):
+    calls = _counting(monkeypatch)
+    cache = dict()
+    folders = _folders(Series["ses-STROOP"])
+    assert validateFolders(folders, "ses-STROOP", cache) == []
+    assert validateFolders(folders, "ses-STROOP", cache) == []
+    assert len(calls) == 1
+
+    # changed series
+    folders = folders[:-1]
+    violations = validateFolders(folders, "ses-STROOP", cache)
+    assert violations and len(calls) == 2
+    # cached violations are same as computed ones
+    assert validateFolders(folders, "ses-STROOP", cache) == violations
+    assert len(calls) == 2
+
+    # changed definitions
+    monkeypatch.setattr(definitions, "definitions_digest", "other")
+    assert validateFolders(folders, "ses-STROOP", cache) == violations
+    assert len(calls) == 3
+
+
+def test_plan_validation(tmp_path, monkeypatch):
+    path = tmp_path / "ses-HCL"
+    for folder in _folders(Series["ses-HCL"]):
+        (path / "MRI" / folder).mkdir(parents=True)
+    calls = _counting(monkeypatch)
+    plan.loadPlan(str(path), "ses-HCL")
+    plan.loadPlan(str(path), "ses-HCL")
+    assert len(calls) == 1
+
+    # plan is kept, only validation is redone
+    monkeypatch.setattr(definitions, "definitions_digest", "other")
+    monkeypatch.setattr(plan, "buildPlan", None)
+    stored = plan.loadPlan(str(path), "ses-HCL")
+    assert len(calls) == 2
+    assert stored["validation"]["key"]\
+        == definitions.validationKey(_folders(Series["ses-HCL"]),
+                                     "ses-HCL")
+    plan.loadPlan(str(path), "ses-HCL")
+    assert len(calls) == 2
@@ -0,0 +1,88 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from verify import verify  # noqa: E402
+
+"""
+Verifies bidsified datasets built from a prepared one, with missing,
+extra and corrupted outputs
+"""
+
+
+def _write(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def datasets(tmp_path):
+    prepared = str(tmp_path / "renamed")
+    bids = str(tmp_path / "bids")
+    ses = os.path.join(prepared, "sub-001", "ses-HCL")
+    out = os.path.join(bids, "sub-001", "ses-HCL")
+    # two diffusion runs with identical gradient tables
+    for run in (1, 2):
+        mri = os.path.join(ses, "MRI", "00{}-dwi".format(run))
+        _write(os.path.join(mri, "4D.nii"), "image {}".format(run))
+        _write(os.path.join(mri, "4D.bval"), "0 1000")
+        dwi = os.path.join(out, "dwi", "sub-001_ses-HCL_run-{}_dwi"
+                           .format(run))
+        _write(dwi + ".nii", "image {}".format(run))
+        _write(dwi + ".bval", "0 1000")
+    _write(os.path.join(ses, "auxiliary", "VAS.tsv"), "a\tb\n")
+    _write(os.path.join(out, "beh", "sub-001_ses-HCL_task-rest_beh.tsv"),
+           "a\tb\n")
+    _write(os.path.join(out, "sub-001_ses-HCL_scans.tsv"), "scans\n")
+    return prepared, bids, out
+
+
+def _outputs(report: dict, kind: str) -> list:
+    return sorted(os.path.basename(item.get("output") or item["source"])
+                  for item in report[kind])
+
+
+def test_passed(datasets):
+    prepared, bids, out = datasets
+    report = verify(prepared, bids, 2)
+    assert report["passed"], report
+    assert report["sessions"] == 1
+
+
+def test_duplicate_sources(datasets):
+    prepared, bids, out = datasets
+    os.remove(os.path.join(out, "dwi", "sub-001_ses-HCL_run-2_dwi.bval"))
+    report = verify(prepared, bids, 2)
+    assert not report["passed"]
+    assert _outputs(report, "missing") == ["4D.bval"]
+    assert report["extra"] == []
+
+
+def test_extra_and_corrupted(datasets):
+    prepared, bids, out = datasets
+    shutil.copy(os.path.join(out, "dwi", "sub-001_ses-HCL_run-1_dwi.bval"),
+                os.path.join(out, "dwi", "sub-001_ses-HCL_run-3_dwi.bval"))
+    _write(os.path.join(out, "beh", "sub-001_ses-HCL_task-rest_beh.tsv"),
+           "a\tc\n")
+    _write(os.path.join(out, "anat", "sub-001_ses-HCL_T1w.nii"), "new")
+    report = verify(prepared, bids, 2)
+    assert _outputs(report, "extra")\
+        == ["sub-001_ses-HCL_T1w.nii", "sub-001_ses-HCL_run-3_dwi.bval"]
+    assert _outputs(report, "corrupted")\
+        == ["sub-001_ses-HCL_task-rest_beh.tsv"]
+    assert report["missing"] == []
+
+
+def test_missing_session(datasets):
+    prepared, bids, out = datasets
+    shutil.rmtree(out)
+    _write(os.path.join(bids, "sub-002", "ses-LCL", "anat", "a.nii"), "x")
+    report = verify(prepared, bids, 2)
+    assert report["sessions"] == 2
+    assert len(report["missing"]) == 5
+    assert _outputs(report, "extra") == ["a.nii"]
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import mmap
+import hashlib
+import logging
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import crawler
+from definitions import aux_files
+
+"""
+verify checks the bidsified dataset against the prepared dataset
+it was produced from.
+
+A provenance map is built from both datasets: auxiliary files are
+expected at their bids place (see definitions.aux_files), and data
+files (images and gradient tables of MRI folder) are expected to be
+found, under any name, in the bidsified session, one output for each
+source, so identical sources (ex. gradient tables of several runs)
+need as many outputs. Files are compared by content: only files which
+size is present in both datasets are hashed, by a pool of threads
+reading them with mmap.
+
+    python3 resources/plugins/verify.py -j 8 -o report.json renamed/ bids/
+
+Report lists the missing outputs (source content not found in
+bidsified dataset), the extra outputs (content not coming from
+any source) and the corrupted ones (auxiliary file differing from
+its source)
+"""
+
+# defined this way, log messages will be formatted correctly
+# and appear with this file-name
+logger = logging.getLogger(__name__)
+
+# extensions of verified files
+data_exts = (".nii", ".nii.gz", ".bval", ".bvec", ".tsv")
+
+# files created by bidsme, that have no source
+generated_suffixes = ("_scans.tsv",)
+
+# folders of prepared session containing source files
+source_datadirs = ("MRI", "auxiliary")
+
+# size of hashed chunks
+chunk_size = 1 << 24
+
+
+def hashFile(path: str) -> str:
+    """
+    Returns blake2b hexdigest of file content, file is read
+    through memory map
+    """
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,\
+                memoryview(mm) as view:
+            for start in range(0, size, chunk_size):
+                h.update(view[start:start + chunk_size])
+    return h.hexdigest()
+
+
+def _isData(name: str) -> bool:
+    return name.endswith(data_exts) and not name.endswith(generated_suffixes)
+
+
+def _sessionFiles(tree: crawler.Tree, session: str,
+                  folders: tuple = None) -> list:
+    """
+    Returns (path, size) of data files of session, optionally
+    limited to given sub-folders
+    """
+    files = list()
+    for folder in tree.lsdirs(session):
+        if folders and os.path.basename(folder) not in folders:
+            continue
+        for rel, size, mtime in tree.files(folder):
+            if _isData(rel):
+                files.append((os.path.join(folder, rel), size))
+    return files
+
+
+def provenance(prepared: str, bids: str,
+               prepared_tree: crawler.Tree = None,
+               bids_tree: crawler.Tree = None) -> dict:
+    """
+    Builds provenance map of bidsified dataset
+
+    Returns:
+    --------
+    dict:
+        (subject, session): dictionary with
+            "sources": list of (path, size) of prepared files
+            "outputs": list of (path, size) of bidsified files
+            "expected": dictionary source path: expected output
+            path, for files with known destination
+    """
+    if prepared_tree is None:
+        prepared_tree = crawler.Tree(prepared)
+    if bids_tree is None:
+        bids_tree = crawler.Tree(bids)
+    sessions = dict()
+    for sub in prepared_tree.lsdirs(prepared, "sub-*"):
+        subject = os.path.basename(sub)
+        for ses in prepared_tree.lsdirs(sub, "ses-*"):
+            session = os.path.basename(ses)
+            entry = {"sources": _sessionFiles(prepared_tree, ses,
+                                              source_datadirs),
+                     "outputs": [],
+                     "expected": dict()}
+            out = os.path.join(bids, subject, session)
+            if bids_tree.isdir(out):
+                entry["outputs"] = _sessionFiles(bids_tree, out)
+            for old, new in aux_files.get(session, ()):
+                source = os.path.join(ses, "auxiliary", old)
+                if not _isData(old) or not prepared_tree.isfile(source):
+                    continue
+                entry["expected"][source] = os.path.join(
+                        out, "beh", "{}_{}_{}".format(subject, session, new))
+            sessions[(subject, session)] = entry
+
+    # bidsified sessions without prepared session
+    for sub in bids_tree.lsdirs(bids, "sub-*"):
+        subject = os.path.basename(sub)
+        for ses in bids_tree.lsdirs(sub, "ses-*"):
+            key = (subject, os.path.basename(ses))
+            if key not in sessions:
+                sessions[key] = {"sources": [],
+                                 "outputs": _sessionFiles(bids_tree, ses),
+                                 "expected": dict()}
+    return sessions
+
+
+def verify(prepared: str, bids: str, workers: int = 0) -> dict:
+    """
+    Verifies bidsified dataset against prepared dataset
+
+    Parameters:
+    -----------
+    prepared: str
+        path to prepared dataset
+    bids: str
+        path to bidsified dataset
+    workers: int
+        number of hashing threads, 0 for number of cores
+
+    Returns:
+    --------
+    dict:
+        report
+    """
+    workers = workers or os.cpu_count() or 1
+    sessions = provenance(prepared, bids)
+
+    # only files that can match by size are hashed
+    sizes = dict()
+    to_hash = set()
+    for entry in sessions.values():
+        sizes.update(entry["sources"])
+        sizes.update(entry["outputs"])
+        out_sizes = set(s for f, s in entry["outputs"])
+        src_sizes = set(s for f, s in entry["sources"])
+        to_hash.update(f for f, s in entry["sources"] if s in out_sizes)
+        to_hash.update(f for f, s in entry["outputs"] if s in src_sizes)
+        for source, dest in entry["expected"].items():
+            if dest in sizes:
+                to_hash.update((source, dest))
+    to_hash = sorted(to_hash)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = dict(zip(to_hash, pool.map(hashFile, to_hash)))
+
+    missing = list()
+    extra = list()
+    corrupted = list()
+    for (subject, session), entry in sorted(sessions.items()):
+        # contents are counted, each output accounts for only one
+        # source, so identical sources need as many outputs
+        expected = set(entry["expected"].values())
+        out_hashes = Counter(digests.get(f) for f, s in entry["outputs"]
+                             if f not in expected)
+        src_hashes = Counter(digests.get(f) for f, s in entry["sources"]
+                             if f not in entry["expected"])
+        for f, s in entry["sources"]:
+            if f in entry["expected"]:
+                dest = entry["expected"][f]
+                if dest not in sizes:
+                    missing.append({"source": f, "output": dest})
+                elif digests[dest] != digests[f]:
+                    corrupted.append({"source": f, "output": dest})
+            elif not _take(out_hashes, digests.get(f)):
+                missing.append({"source": f, "output": None})
+        for f, s in entry["outputs"]:
+            if f not in expected and not _take(src_hashes, digests.get(f)):
+                extra.append({"output": f})
+
+    for kind, items in (("Missing", missing), ("Extra", extra),
+                        ("Corrupted", corrupted)):
+        for item in items:
+            logger.error("{}: {}".format(kind, item.get("output")
+                                         or item.get("source")))
+    return {"prepared": os.path.abspath(prepared),
+            "bids": os.path.abspath(bids),
+            "sessions": len(sessions),
+            "hashed": len(to_hash),
+            "hashed_bytes": sum(sizes[f] for f in to_hash),
+            "missing": missing,
+            "extra": extra,
+            "corrupted": corrupted,
+            "passed": not (missing or extra or corrupted)
+            }
+
+
+def _take(counts: Counter, digest: str) -> bool:
+    """
+    Removes one file of given content from counts, returns
+    False if there is none left or content is unknown
+    """
+    if digest is None or counts[digest] <= 0:
+        return False
+    counts[digest] -= 1
+    return True
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+            description="Verifies bidsified dataset against prepared "
+                        "dataset")
+    parser.add_argument("prepared", help="path to prepared dataset")
+    parser.add_argument("bids", help="path to bidsified dataset")
+    parser.add_argument("-j", "--workers", type=int,
+                        default=os.cpu_count(),
+                        help="number of hashing threads")
+    parser.add_argument("-o", "--output", default="",
+                        help="path to json report, printed if not given")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(levelname)s %(name)s: %(message)s")
+    report = verify(args.prepared, args.bids, args.workers)
+    logger.info("{} sessions, {} files hashed: {} missing, {} extra, "
+                "{} corrupted"
+                .format(report["sessions"], report["hashed"],
+                        len(report["missing"]), len(report["extra"]),
+                        len(report["corrupted"])))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())